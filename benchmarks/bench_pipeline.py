@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+from benchmarks.synthetic_traces import generate_trace_folder
+from src.cnn_multi_pixel.preprocessing.preprocessing_array import create_raw_traces
+from src.cnn_multi_pixel.preprocessing.preprocessing_pipeline import create_training_matrix
+from src.cnn_multi_pixel.dataset.dataset_raw import create_and_save_raw_datasets, load_raw_datasets
+from src.cnn_multi_pixel.dataset.dataset_sampled import create_and_save_sampled_datasets, load_sampled_dataset
+from src.cnn_multi_pixel.helper_functions.normalizer import LogNormalizer
+from src.cnn_multi_pixel.helper_functions.codec import Codec
+from src.cnn_multi_pixel.helper_functions.profiler import Profiler
+from src.cnn_multi_pixel.dataloader.dataloader import TraceDatasetBuilder, compute_bit_labels, create_batch_dataloader
+from src.cnn_multi_pixel.training.models import MultiHeadCNN, create_backbone
+from src.cnn_multi_pixel.training.train import train_model
+
+MB = 1 << 20
+
+# Total size in bytes of every file under path
+def tree_bytes(path):
+    return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(path) for name in names)
+
+# Runs func as a stage of profiler; returns its result and the stage record
+def run_stage(profiler, name, func, *args, **kwargs):
+    with profiler.stage(name) as record:
+        result = func(*args, **kwargs)
+    return result, record
+
+# Adds counts to a finished stage record and turns them into per-second rates, ex) files, points, read_bytes, samples
+# Counts ending in _bytes are data sizes(ex. trace files, stored datasets), rated in MB/s
+def count(record, **counts):
+    record.update(counts)
+    wall = max(record["wall_s"], 1e-12)
+    for key, value in counts.items():
+        if key.endswith("_bytes"):
+            record[f"mb_{key[:-len('_bytes')]}_per_s"] = value / MB / wall
+        else:
+            record[f"{key}_per_s"] = value / wall
+
+# Rates of every benchmark stage, one line per stage
+def rates_table(stages):
+    return "\n".join(f"{stage['stage']:<22}" + ", ".join(f"{key[:-len('_per_s')]}/s={value:,.1f}" for key, value in stage.items()
+                                                         if key.endswith("_per_s")) for stage in stages)
+
+# Commit of the tree being benchmarked; None outside a git checkout
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+'''
+Function that runs every pipeline stage once on synthetic trace folders
+Every stage is a Profiler stage; functions decorated with profiled inside it are recorded as nested stages.
+Counts of the benchmark(files, points, data sizes, ...) and their rates are added to the top-level records.
+Stages, in pipeline order:
+    generate -> ingest(create_raw_traces) -> save_raw -> load_raw -> sample_and_save -> load_sampled
+    -> normalize(fit + transform) -> fused_matrix(create_training_matrix) -> builder(TraceDatasetBuilder.build)
+    -> dataloader(bit_dataloader iteration) -> train(one epoch of a resnet1d MultiHeadCNN)
+Input:
+    1) args: argparse.Namespace; see main
+    2) work_dir: string; Folder for trace files and datasets
+Returns:
+    1) profiler: Profiler; disabled, holding the records of every stage
+'''
+def run_benchmarks(args, work_dir):
+    profiler = Profiler().enable()
+    try:
+        return benchmark_stages(args, work_dir, profiler)
+    finally:
+        profiler.disable()
+
+def benchmark_stages(args, work_dir, profiler):
+    codec = Codec.parse(args.codec) if args.codec else None
+    trace_root = os.path.join(work_dir, "trace_files")
+    raw_root = os.path.join(work_dir, "datasets_raw")
+    sampled_root = os.path.join(work_dir, "datasets_sampled")
+    for folder in (trace_root, raw_root, sampled_root):
+        os.makedirs(folder, exist_ok=True)
+
+    folder_names = [f"bench_{i}" for i in range(args.folders)]
+
+    def generate():
+        return {folder_name: generate_trace_folder(trace_root, folder_name, args.files, args.points, args.duration,
+                                                   args.adc_num, args.adc_bits, seed=args.seed + i)
+                for i, folder_name in enumerate(folder_names)}
+    target_dict, record = run_stage(profiler, "generate", generate)
+    for folder_dict in target_dict.values():
+        folder_dict.update({"sample_modes": args.modes, "sample_interval": args.interval, "sample_duration": args.duration})
+    n_files = args.folders * args.files
+    n_points = n_files * args.points
+    trace_bytes = tree_bytes(trace_root)
+    count(record, files=n_files, points=n_points, written_bytes=trace_bytes)
+
+    raw_dict, record = run_stage(profiler, "ingest", create_raw_traces, trace_root, target_dict, bulk=True, workers=args.workers)
+    count(record, files=n_files, points=n_points, read_bytes=trace_bytes)
+
+    _, record = run_stage(profiler, "save_raw", create_and_save_raw_datasets, raw_root, raw_dict, codec=codec)
+    count(record, files=n_files, points=n_points, written_bytes=tree_bytes(raw_root))
+    del raw_dict
+
+    raw_datasets, record = run_stage(profiler, "load_raw", load_raw_datasets, raw_root, folder_names, mmap=False)
+    count(record, files=n_files, points=n_points, read_bytes=tree_bytes(raw_root))
+
+    _, record = run_stage(profiler, "sample_and_save", create_and_save_sampled_datasets, sampled_root, raw_datasets, target_dict, codec=codec)
+    count(record, files=n_files * len(args.modes), points=n_points * len(args.modes), written_bytes=tree_bytes(sampled_root))
+
+    sampled_datasets, record = run_stage(profiler, "load_sampled", load_sampled_dataset, sampled_root, folder_names, mmap=False)
+    count(record, files=n_files * len(args.modes), read_bytes=tree_bytes(sampled_root))
+
+    matrices = [dataset.get_sample_matrix() for dataset in sampled_datasets]
+    n_values = sum(matrix.size for matrix in matrices)
+    normalizer = LogNormalizer()
+
+    def normalize():
+        normalizer.fit_iter(matrices)
+        return [normalizer.transform(matrix, dtype=np.float32) for matrix in matrices]
+    _, record = run_stage(profiler, "normalize", normalize)
+    count(record, values=n_values, read_bytes=sum(matrix.nbytes for matrix in matrices))
+
+    (train_matrix, digital_values, _), record = run_stage(profiler, "fused_matrix", create_training_matrix, raw_datasets, args.interval,
+                                                          args.duration, args.modes[0], normalizer)
+    count(record, files=n_files, points=n_points, written_bytes=train_matrix.nbytes)
+
+    builder = TraceDatasetBuilder(adc_bitwidth=args.adc_bits, adc_num=args.adc_num, normalized_digital=True)
+
+    def build():
+        for folder_name in folder_names:
+            builder.add_files(os.path.join(trace_root, folder_name), target_dict[folder_name]["file_name_pattern"], 0)
+        builder.build()
+        builder.build_dataloaders(batch_size=args.batch_size, shuffle=True)
+    _, record = run_stage(profiler, "builder", build)
+    count(record, files=n_files, points=n_points, read_bytes=trace_bytes)
+
+    def iterate(dataloader):
+        batches = samples = 0
+        for _ in range(args.epochs):
+            for traces, _ in dataloader:
+                batches += 1
+                samples += len(traces)
+        return batches, samples
+    (batches, samples), record = run_stage(profiler, "dataloader", iterate, builder.bit_dataloader)
+    count(record, batches=batches, samples=samples)
+
+    traces = torch.from_numpy(train_matrix)
+    bit_labels = torch.from_numpy(compute_bit_labels(digital_values.reshape(-1, 1), args.adc_num, args.adc_bits, False))
+    dataloader = create_batch_dataloader(TensorDataset(traces, bit_labels), batch_size=args.batch_size, shuffle=True)
+    model = MultiHeadCNN(*create_backbone("resnet1d"), bit_labels.shape[1])
+    params = {"num_epochs": args.epochs, "max_grad_norm": 1.0, "lr": 1e-4, "target_acc": 2.0}
+    _, record = run_stage(profiler, "train", train_model, model, dataloader, None, params, False)
+    count(record, batches=len(dataloader) * args.epochs, samples=len(traces) * args.epochs)
+    return profiler
+
+'''
+Function that prints the relative change of every stage rate between two result files
+'''
+def compare(baseline_path, current):
+    with open(baseline_path, "r") as f:
+        baseline = {stage["stage"]: stage for stage in json.load(f)["stages"]}
+    print(f"\nCompared to {baseline_path}:")
+    for stage in current["stages"]:
+        old = baseline.get(stage["stage"])
+        if old is None:
+            continue
+        changes = [f"{key[:-len('_per_s')]}/s {100 * (value / old[key] - 1):+.1f}%"
+                   for key, value in stage.items() if key.endswith("_per_s") and old.get(key)]
+        print(f"\t{stage['stage']:<22}wall {100 * (stage['wall_s'] / max(old['wall_s'], 1e-12) - 1):+.1f}%  {', '.join(changes)}")
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_pipeline.py", description="Benchmark every pipeline stage on synthetic ngspice traces")
+    parser.add_argument("--folders", type=int, default=2, help="Number of synthetic trace folders")
+    parser.add_argument("--files", type=int, default=64, help="Trace files per folder")
+    parser.add_argument("--points", type=int, default=20000, help="Points per trace file")
+    parser.add_argument("--duration", type=float, default=260e-6, help="Simulated and sampled time of each trace")
+    parser.add_argument("--interval", type=float, default=0.1e-6, help="Sample interval")
+    parser.add_argument("--modes", type=str, nargs="+", default=["AVG", "MIN", "MAX"], help="Sample modes")
+    parser.add_argument("--adc-num", type=int, default=5, help="Number of ADCs")
+    parser.add_argument("--adc-bits", type=int, default=8, help="Bits per ADC")
+    parser.add_argument("--batch-size", type=int, default=32, help="Dataloader and training batch size")
+    parser.add_argument("--epochs", type=int, default=1, help="Epochs of the dataloader and train stages")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes of the ingest stage")
+    parser.add_argument("--codec", type=str, default=None, help="Codec of stored datasets, ex) zlib:1, zstd:3, lzma:6:shuffle; plain .npy if not given")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic traces")
+    parser.add_argument("--work-dir", type=str, default=None, help="Folder for traces and datasets; a temporary folder if not given")
+    parser.add_argument("-o", "--output", type=str, default=None, help="JSON result file; default benchmark_results/{commit}.json")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier JSON result file to compare against")
+    args = parser.parse_args()
+
+    if args.work_dir is None:
+        with tempfile.TemporaryDirectory() as work_dir:
+            profiler = run_benchmarks(args, work_dir)
+    else:
+        profiler = run_benchmarks(args, args.work_dir)
+    stages = [record for record in profiler.records if record["depth"] == 0]
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count(),
+                    "numpy": np.__version__, "torch": torch.__version__, "torch_threads": torch.get_num_threads()},
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "work_dir")},
+        "peak_rss": "stage" if profiler.stage_peaks else "process so far",
+        "stages": stages,
+        "totals": profiler.totals(),
+    }
+    output = args.output or os.path.join("benchmark_results", f"{(commit or 'unknown')[:12]}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(profiler.summary())
+    print("\nRates:")
+    print(rates_table(stages))
+    print(f"\nResults written to {output}")
+    if args.compare is not None:
+        compare(args.compare, report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+
+# Header line written by ngspice; skipped by convert_file and TraceDataset.load_trace
+HEADER = "time -i(vdd)"
+
+'''
+Function that returns the file name pattern of synthetic trace folders
+Same naming as the notebook: lin_s{index}_{adc value / 2^adc_bits}_..._{adc value / 2^adc_bits}.txt, MSB ADC first
+Input:
+    1) adc_num: number of ADCs
+Returns:
+    1) file_pattern: string; RegEx with one group per ADC, for create_raw_traces and TraceDatasetBuilder.add_files
+'''
+def file_pattern(adc_num=5):
+    return "lin_s\\d+_" + "_".join(["([0-9]+\\.[0-9]+)"] * adc_num) + "\\.txt"
+
+# Label function of create_raw_traces; combined digital value, same as TraceDatasetBuilder with normalized_digital and adc_bitwidth=adc_bits
+def file_label_function(adc_bits=8):
+    return f"lambda gs: sum(int(float(g) * {1 << adc_bits}) << ({adc_bits} * (len(gs) - 1 - i)) for i, g in enumerate(gs))"
+
+'''
+Function that generates one synthetic power trace
+Time steps mimic the ngspice adaptive timestep: mostly near-uniform steps, refined around clock edges,
+with occasional long steps that leave empty sample windows.
+Values are a positive supply current: baseline, one switching spike per clock edge scaled by the bit
+being converted, and noise.
+Input:
+    1) digital_values: list of int; Value of each ADC
+    2) n_points: int; Number of points of the trace
+    3) duration: float; Simulated time
+    4) rng: np.random.Generator
+    5) adc_bits: bits per ADC
+Returns:
+    1) times: np.ndarray; np.float64; Non-decreasing time values starting at 0
+    2) values: np.ndarray; np.float64; Trace values
+'''
+def generate_trace(digital_values, n_points, duration, rng, adc_bits=8):
+    steps = rng.lognormal(mean=0.0, sigma=0.6, size=n_points - 1)
+    steps[rng.random(n_points - 1) < 0.002] *= 40
+    times = np.zeros(n_points, dtype=np.float64)
+    np.cumsum(steps, out=times[1:])
+    times *= duration / times[-1]
+
+    n_edges = len(digital_values) * adc_bits
+    edge = np.minimum((times / duration * n_edges).astype(np.int64), n_edges - 1)
+    bits = np.array([(value >> bit) & 1 for value in digital_values for bit in range(adc_bits - 1, -1, -1)])
+    phase = times / duration * n_edges - edge
+    spike = np.exp(-phase * 25.0) * (1e-4 + 2e-4 * bits[edge])
+    values = 2e-5 + spike + rng.normal(0.0, 2e-6, n_points)
+    return times, np.abs(values) + 1e-9
+
+'''
+Function that writes a trace in the ngspice output format read by convert_file and TraceDataset.load_trace
+'''
+def write_trace_file(file_path, times, values):
+    np.savetxt(file_path, np.column_stack([times, values]), fmt="%.8e", delimiter="\t", header=HEADER, comments="")
+
+'''
+Function that generates a folder of synthetic trace files
+Input:
+    1) trace_root: string; Folder to create the trace folder in
+    2) folder_name: string; Name of the trace folder
+    3) n_files: int; Number of trace files
+    4) n_points: int; Points per trace; the same for every file so TraceDatasetBuilder can stack them
+    5) duration: float; Simulated time of each trace
+    6) adc_num, adc_bits: number of ADCs and bits per ADC
+    7) seed: int; Seed of the generator; the same seed gives the same folder
+Returns:
+    1) folder_dict: dictionary; file settings of the folder, see create_raw_traces
+'''
+def generate_trace_folder(trace_root, folder_name, n_files, n_points, duration=260e-6, adc_num=5, adc_bits=8, seed=0):
+    rng = np.random.default_rng(seed)
+    folder_path = os.path.join(trace_root, folder_name)
+    os.makedirs(folder_path, exist_ok=True)
+    # Distinct combined values, so every file keeps its own label in raw datasets
+    combined = rng.choice(1 << min(adc_num * adc_bits, 62), size=n_files, replace=False)
+    for index, value in enumerate(combined):
+        digital_values = [(int(value) >> (adc_bits * adc)) & ((1 << adc_bits) - 1) for adc in range(adc_num - 1, -1, -1)]
+        # adc_bits decimals represent adc_value / 2^adc_bits exactly
+        file_name = f"lin_s{index}_" + "_".join(f"{adc_value / (1 << adc_bits):.{max(adc_bits, 8)}f}" for adc_value in digital_values) + ".txt"
+        write_trace_file(os.path.join(folder_path, file_name), *generate_trace(digital_values, n_points, duration, rng, adc_bits))
+    return {"file_name_pattern": file_pattern(adc_num), "file_label_function": file_label_function(adc_bits)}
@@ -15,9 +15,8 @@ import matplotlib.pyplot as plt
 
 # 1) File imports
 from src.cnn_multi_pixel.setup.setup_directories import create_directories
-from src.cnn_multi_pixel.preprocessing.preprocessing_array import create_raw_traces
-from src.cnn_multi_pixel.dataset.dataset_raw import create_and_save_raw_datasets
-from src.cnn_multi_pixel.dataset.dataset_sampled import create_and_save_sampled_datasets
+from src.cnn_multi_pixel.dataset.dataset_cache import update_datasets
+from src.cnn_multi_pixel.helper_functions.profiler import Profiler, start_py_spy, stop_py_spy
 
 
 # Plot settings
@@ -37,6 +36,9 @@ parser.add_argument("-r", "--repeat", type=int, default=1, help="Rerun training/
 parser.add_argument("--nndebug", const=True, default=False, action='store_const', help="Print information about cnn creation.")
 parser.add_argument("-i", "--json",   type=str, default='regression.json', help="JSON description of CNNs")
 parser.add_argument("-o", "--output", type=str, default='outputs', help="Directory for output files")
+parser.add_argument("--profile", const=True, default=False, action='store_const', help="Time every pipeline stage; writes profile.json and profile_trace.json(Chrome trace) to the output directory")
+parser.add_argument("--cprofile", const=True, default=False, action='store_const', help="With --profile, also run cProfile; writes profile.prof to the output directory")
+parser.add_argument("--pyspy", const=True, default=False, action='store_const', help="With --profile, also record a py-spy flame graph(profile_pyspy.svg); needs py-spy installed")
 
 # Base Paths
 pwd      = os.path.dirname(os.path.abspath(__file__))
@@ -48,6 +50,12 @@ if __name__ == "__main__":
     args = parser.parse_args()
     if not args.nowrite:
         os.makedirs(args.output, exist_ok=True)
+    # Per-stage timing of steps 1-11; see helper_functions/profiler.py
+    profiler, pyspy = None, None
+    if args.profile:
+        os.makedirs(args.output, exist_ok=True)
+        profiler = Profiler(os.path.join(args.output, "profile.prof") if args.cprofile else None).enable()
+        pyspy = start_py_spy(os.path.join(args.output, "profile_pyspy.svg")) if args.pyspy else None
     
     # DIRECTORY PATH SETTER
     # NEED ADDITIONAL FUNCTION; DO AT END AFTER ALL LOGIC IS FINALIZED
@@ -62,19 +70,11 @@ if __name__ == "__main__":
     is_initial = True
     
     # 1) Check if there are any saved raw or subsampled datasets that correspond to required folder
-    # NEED ADDITIONAL FUNCTION; ADD SAVED-NEW CHECKER FUNCTION
-    train_folders_saved = {}
-    train_folders_new = {}
-    test_folders_saved = {}
-    test_folders_new = {}
-    # 2) Convert all training/testing folders into raw traces
-    train_new_dict = create_raw_traces(trace_root, train_folders_new)
-    test_new_dict = create_raw_traces(trace_root, test_folders_new)
-    # 3) Create and save raw datasets
-    train_datasets_new = create_and_save_raw_datasets(datasets_raw_root, train_new_dict)
-    test_datasets_new = create_and_save_raw_datasets(datasets_raw_root, test_new_dict)
-    # 4) For each new raw dataset, create and save a subsampled dataset
-    train_datasets_new_sampled, test_datasets_new_sampled = create_and_save_sampled_datasets(datasets_sampled_root, train_datasets_new, test_datasets_new)
+    # 2) Convert new/changed training/testing folders or files into raw traces
+    # 3) Create, update and save raw datasets
+    # 4) For each new or updated raw dataset, create, update and save subsampled datasets
+    train_datasets_raw, train_datasets_sampled = update_datasets(trace_root, datasets_raw_root, datasets_sampled_root, train_dict)
+    test_datasets_raw, test_datasets_sampled = update_datasets(trace_root, datasets_raw_root, datasets_sampled_root, test_dict)
     # 5) Form both training and testing by combining both saved and new datasets
     # 6) Normalize all datasets
     # 7) Create dataloader - APPLY BITWISE/SINGLE MODE SETTER HERE
@@ -83,4 +83,11 @@ if __name__ == "__main__":
     # 8) Create CNN
     # 9) Run training
     # 10) Run testing
-    # 11) Print results
\ No newline at end of file
+    # 11) Print results
+
+    if profiler is not None:
+        stop_py_spy(pyspy)
+        profiler.disable()
+        print(profiler.summary())
+        profiler.save_json(os.path.join(args.output, "profile.json"))
+        profiler.save_chrome_trace(os.path.join(args.output, "profile_trace.json"))
\ No newline at end of file
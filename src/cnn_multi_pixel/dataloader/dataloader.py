@@ -1,6 +1,10 @@
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+import torch
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import re
+import os
+from src.cnn_multi_pixel.dataloader.trace_cache import TraceCache
+from src.cnn_multi_pixel.helper_functions.profiler import profiled
 
 ''' 
 Helper function used to normalize string values with given average exponent value
@@ -36,6 +40,103 @@ def process_string(strip_val, e_val, avg_exp):
 
     return new_number * -1 if is_neg else new_number
 
+''' 
+Helper function used to normalize a single value string the same way TraceDataset.load_trace always has
+Input:
+    1) value: string; value column of a trace file line, ex) "-2.17498915e-03"
+    2) avg_exp: obtained average exponent value.
+Returns:
+    1) new_number: normalized float32 value; None if value is skipped
+'''
+def process_value(value, avg_exp):
+    # Edge case: value is "-0.00000000e+00" or "0.00000000e+00"
+    # Add more edge cases if needed
+    if value in ["-0.00000000e+00", "0.00000000e+00"]:
+        return np.float32(0)
+    try:
+        match = re.search(r"(?<=e-)\d+", value)
+        if match:
+            if value[0] == "-":
+                strip_val = value[0:11]
+                strip_val_e = value[12:15]
+            else:
+                strip_val = value[0:10]
+                strip_val_e = value[11:14]
+            return process_string(strip_val, strip_val_e, avg_exp)
+    except ValueError as e:
+        print(f"Error parsing value '{value}': {e}")
+    return None
+
+# Exact powers of ten; 10**k is exactly representable in np.float64 up to k = 22
+POW10 = np.array([10.0 ** k for k in range(23)], dtype=np.float64)
+
+''' 
+Vectorized version of process_value over a whole value column
+Values in the fixed ngspice format "d.dddddddde-dd" (optionally signed) are shifted numerically:
+the 9 mantissa digits D and exponent are read as integers, and D * 10^k is computed in np.float64
+then rounded to np.float32. k follows process_string, including its extra 10^-2 when the shifted exponent is negative.
+The rare rows where that double rounding could differ from np.float32(string), and any value not in the
+fixed format, go through process_value, so the output matches process_value element by element.
+Input:
+    1) values: np.ndarray; bytes; value column of a trace file
+    2) avg_exp: obtained average exponent value.
+Returns:
+    1) trace: np.ndarray; np.float32; normalized values, skipped values removed
+'''
+def process_values(values, avg_exp):
+    values = np.asarray(values, dtype=np.bytes_)
+    n = len(values)
+    width = max(values.dtype.itemsize, 17)
+    chars = np.zeros((n, width), dtype=np.uint8)
+    if n:
+        chars[:, :values.dtype.itemsize] = values.view(np.uint8).reshape(n, values.dtype.itemsize)
+
+    # Align negative values with positive ones: aligned = "d.dddddddde-dd"
+    is_neg = chars[:, 0] == ord('-')
+    aligned = np.where(is_neg[:, None], chars[:, 1:16], chars[:, 0:15])
+    digit_cols = [0, 2, 3, 4, 5, 6, 7, 8, 9, 12, 13]
+    digits = aligned[:, digit_cols].astype(np.int64) - ord('0')
+    standard = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    standard &= (aligned[:, 1] == ord('.')) & (aligned[:, 10] == ord('e')) & (aligned[:, 11] == ord('-'))
+    standard &= np.where(is_neg, chars[:, 16], chars[:, 15]) == 0
+
+    # D * 10^k, k per process_string
+    mantissa = digits[:, :9] @ (10 ** np.arange(8, -1, -1, dtype=np.int64))
+    e_diff = avg_exp - (digits[:, 9] * 10 + digits[:, 10])
+    k = np.where(e_diff < 0, e_diff - 10, e_diff - 8)
+    # 10^|k| applied as two exact powers; at most two roundings, so the float64 value is within 2 ulp
+    k_abs = np.where(standard, np.abs(k), 0)
+    standard &= k_abs < 2 * len(POW10) - 1
+    power_lo = POW10[np.minimum(k_abs, len(POW10) - 1)]
+    power_hi = POW10[np.clip(k_abs - (len(POW10) - 1), 0, len(POW10) - 1)]
+    with np.errstate(over='ignore', under='ignore'):
+        shifted = np.where(k >= 0, mantissa * power_lo * power_hi, mantissa / power_lo / power_hi)
+        trace = shifted.astype(np.float32)
+
+    # Rounding to float32 can only differ from np.float32(string) when the float64 value is near a float32 midpoint
+    low_bits = (shifted.view(np.uint64) & np.uint64((1 << 29) - 1)).astype(np.int64)
+    exact = standard & (np.abs(low_bits - (1 << 28)) > 4) & ((shifted == 0) | (shifted >= np.finfo(np.float32).tiny))
+    trace = np.where(is_neg, -trace, trace)
+
+    keep = exact.copy()
+    for row in np.flatnonzero(~exact):
+        new_number = process_value(values[row].decode(), avg_exp)
+        if new_number is not None:
+            trace[row] = new_number
+            keep[row] = True
+    return trace[keep]
+
+# True if every line of data holds exactly two whitespace separated tokens; the last line may lack its newline
+def two_tokens_per_line(data):
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if len(buf) == 0:
+        return True
+    is_ws = buf <= 32
+    starts = np.flatnonzero(~is_ws & np.concatenate(([True], is_ws[:-1])))
+    newlines = np.flatnonzero(buf == ord('\n'))
+    n_lines = len(newlines) + int(buf[-1] != ord('\n'))
+    return np.array_equal(np.bincount(np.searchsorted(newlines, starts), minlength=n_lines), np.full(n_lines, 2))
+
 ''' 
 Class that creates a dataset with given traces
 Input for initialization:
@@ -48,59 +149,71 @@ Returns:
     1) new_number: normalized float64 of string
 '''
 class TraceDataset(Dataset):
-    # cached_traces, trace_list = used to store already created traces
-    # reused based on digital value, prevents rep calls on load_traces
-    cached_traces = {}
-    trace_list    = []
-
     # file_list: list of FILE NAMES that have been converted
-    # cache: actual traces saved that can be reused
-    def __init__(self, file_list, avg_exp, cache=True):
-        self.file_list = file_list
-        self.cache     = cache
-        self.avg_exp   = avg_exp
+    # cache: actual traces saved that can be reused, keyed by file path
+    # trace_cache: TraceCache to use; pass the same one to share it between datasets
+    #   default: a TraceCache of this instance only, bounded to DEFAULT_CACHE_BYTES
+    # traces, labels: shared (N, L) trace tensor and (N, ...) label tensor set by TraceDatasetBuilder
+    #   if given, items are tensor views, no file is opened and nothing is cached
+    def __init__(self, file_list, avg_exp, cache=True, traces=None, labels=None, trace_cache=None):
+        self.file_list   = file_list
+        self.cache       = cache and traces is None
+        self.avg_exp     = avg_exp
+        self.traces      = traces
+        self.labels      = labels
+        self.trace_cache = (trace_cache if trace_cache is not None else TraceCache()) if self.cache else None
     
     def __len__(self):
         return len(self.file_list)
 
     # input: index, used for finding file in file_list
+    #   a list/array of indices(ex. from a BatchSampler) returns a whole batch; see get_batch
     def __getitem__(self, index):
+        if not isinstance(index, (int, np.integer)):
+            return self.get_batch(index)
+        if self.traces is not None:
+            return self.traces[index], self.labels[index]
         fname, fpath, label = self.file_list[index]
         label = self.process_label(label)
 
-        if self.cache and fname in self.cached_traces:
-            return self.cached_traces[fname], label
-        else:
-            return self.load_trace(fname, fpath), label
+        return self.get_trace(fname, fpath), label
+
+    # (B, L) traces and (B, ...) labels of a batch of indices
+    # with shared tensors this is one tensor indexing operation per tensor; no per-sample calls
+    def get_batch(self, indices):
+        if self.traces is not None:
+            indices = torch.as_tensor(indices, dtype=torch.long)
+            return self.traces[indices], self.labels[indices]
+        items = [self[int(index)] for index in indices]
+        traces = torch.from_numpy(np.stack([np.asarray(trace) for trace, _ in items]))
+        return traces, torch.as_tensor([label for _, label in items])
+
+    # cached trace of file if available, else load_trace
+    def get_trace(self, fname, fpath):
+        if self.cache:
+            trace = self.trace_cache.get(fpath)
+            if trace is not None:
+                return trace
+        return self.load_trace(fname, fpath)
 
     def get_info(self, index):
         return self.file_list[index]
 
     # opens single trace file, creates valu_arr, patches as tensor
     def load_trace(self, fname, fpath):
-        with open(fpath, 'r') as file:
+        with open(fpath, 'rb') as file:
             header = file.readline()
             #time_arr = []
-            valu_arr = []
-            for line in file.readlines():
+            lines = file.read()
+        # Every line holds exactly (time, value); otherwise parse line by line, which fails on the first bad line
+        if two_tokens_per_line(lines):
+            values = lines.split()[1::2]
+        else:
+            values = []
+            for line in lines.decode().splitlines():
                 _, value = line.strip().split()
-                # Edge case: value is "-0.00000000e+00" or "0.00000000e+00"
-                # Add more edge cases if needed
-                if value in ["-0.00000000e+00", "0.00000000e+00"]:
-                    valu_arr.append(np.float32(0))
-                else:
-                    try:
-                        match = re.search(r"(?<=e-)\d+", value)
-                        if match:
-                            if value[0] == "-":
-                                strip_val = value[0:11]
-                                strip_val_e = value[12:15]
-                            else:
-                                strip_val = value[0:10]
-                                strip_val_e = value[11:14]
-                            valu_arr.append(process_string(strip_val, strip_val_e))
-                    except ValueError as e:
-                        print(f"Error parsing value '{value}': {e}")
+                values.append(value.encode())
+        valu_arr = process_values(values, self.avg_exp)
 
         trace = np.array(valu_arr, dtype=np.float32)
         '''
@@ -111,8 +224,7 @@ class TraceDataset(Dataset):
         '''
 
         if self.cache: 
-            self.cached_traces[fname] = trace
-            self.trace_list.append(trace)
+            self.trace_cache.put(fpath, trace)
 
         return trace
     
@@ -125,13 +237,15 @@ class TraceDataset(Dataset):
         
         print("Caching all traces")
         for fname, fpath, label in self.file_list:
-            self.load_trace(fname, fpath)
+            self.get_trace(fname, fpath)
         print("DONE Caching all traces")
 
 class TraceDatasetBW(TraceDataset):
     # bit_select = 0-7, 0 = LSB, 7 = MSB
     # adc_select = 0-4, 0 = ADC storing LSB, 4 = ADC storing MSB
-    def __init__(self, file_list, bit_select, adc_select, cache=True, split_digital=False, normalize_digital=False):
+    # traces, bit_labels: shared trace tensor and this dataset's column of the builder's bit label matrix
+    def __init__(self, file_list, bit_select, adc_select, cache=True, split_digital=False, normalize_digital=False,
+                 avg_exp=4, adc_bits=8, traces=None, bit_labels=None, trace_cache=None):
         # if split_digital, need to create SEPARATE dataloaders PER ADC
         if split_digital:
             self.split_digital = True
@@ -140,9 +254,9 @@ class TraceDatasetBW(TraceDataset):
         else:
             self.split_digital = False
             self.adc_num = 0
-            self.bit_mask =  1 << bit_select + adc_select * 8
+            self.bit_mask =  1 << bit_select + adc_select * adc_bits
 
-        super().__init__(file_list, cache=cache) 
+        super().__init__(file_list, avg_exp, cache=cache, traces=traces, labels=bit_labels, trace_cache=trace_cache)
     
     # Uses bitwise on COMBINED label
     def process_label(self, label):
@@ -151,25 +265,57 @@ class TraceDatasetBW(TraceDataset):
             try:
                 label_num = label[self.adc_num]
             except IndexError:
-                print(f"\tInvalid index; this may be caused due to bad hyperparameters.")
-                print(f"\tadc_num: {adc_num}")
-                print(f"\tsplit_digital: {split_digital}")
-                print(f"\tnormalized_digital: {normalized_digital}")
+                raise ValueError(f"Invalid index {self.adc_num} for label {label}; this may be caused due to bad hyperparameters.")
         else:
-            label_num = label
+            label_num = label[0]
         return 1 if label_num & self.bit_mask else 0
 
+''' 
+Function that computes every bitwise label of every file at once
+Input:
+    1) digital_values: np.ndarray; np.int64; (N, n_values) labels of add_files
+    2) adc_num: number of ADCs
+    3) adc_bits: bits per ADC
+    4) split_digital: if True, column adc of digital_values holds the value of that ADC
+Returns:
+    1) bit_labels: np.ndarray; np.uint8; (N, adc_num * adc_bits); column adc * adc_bits + bit, same as TraceDatasetBW.process_label
+'''
+def compute_bit_labels(digital_values, adc_num, adc_bits, split_digital):
+    bits = np.arange(adc_bits, dtype=np.int64)
+    if split_digital:
+        if digital_values.shape[1] < adc_num:
+            raise ValueError(f"Invalid adc_num {adc_num} for labels with {digital_values.shape[1]} values; this may be caused due to bad hyperparameters.")
+        shifted = digital_values[:, :adc_num, None] >> bits
+    else:
+        shifted = digital_values[:, :1, None] >> (np.arange(adc_num, dtype=np.int64)[:, None] * adc_bits + bits)
+    return (shifted & 1).astype(np.uint8).reshape(len(digital_values), adc_num * adc_bits)
+
 class TraceDatasetBuilder:
-    def __init__(self, adc_bitwidth=8, cache=True):
+    # adc_num: number of ADCs, adc_bitwidth: bits per ADC
+    # avg_exp: average exponent used by TraceDataset.load_trace
+    # split_digital: file name holds one value per ADC instead of one combined value
+    # normalized_digital: file name values are normalized; multiplied by 2^adc_bitwidth(256 for 8 bits) to get original value
+    # cache: kept for compatibility; every trace is held once in the stacked self.traces, so nothing goes to a TraceCache
+    def __init__(self, adc_bitwidth=8, cache=True, adc_num=5, avg_exp=4, split_digital=False, normalized_digital=False):
         self.file_list = []
         self.cache = cache
         self.adc_bits = adc_bitwidth
+        self.adc_num = adc_num
+        self.avg_exp = avg_exp
+        self.split_digital = split_digital
+        self.normalized_digital = normalized_digital
 
         self.dataset = None
         self.dataloader = None
+        self.bit_dataset = None
+        self.bit_dataloader = None
         self.datasets = []
         self.dataloaders = []
 
+        # traces: (N, L) float32 tensor of all traces; bit_labels: (N, adc_num * adc_bits) uint8 tensor
+        self.traces = None
+        self.bit_labels = None
+
     def add_files(self, directory, format, label_group):
         ''' Builds list of powertrace files
         Inputs:
@@ -188,11 +334,13 @@ class TraceDatasetBuilder:
                 # IF split_digital, return ARRAY of digital values
                 # returns: [[adc_num digital values], ...] (2D array)
                 # ORDER: MSB values FIRST
-                if split_digital:
+                # adc_range: 2^adc_bits; 256 for 8 bits
+                adc_range = 1 << self.adc_bits
+                if self.split_digital:
                     # dvalue: ordered by FILE NAMING order
-                    # if normalized, multiply 256 to get original value
-                    if normalized_digital:
-                        dvalue = [int(np.float64(i) * 256) for i in match.groups()]
+                    # if normalized, multiply adc_range to get original value
+                    if self.normalized_digital:
+                        dvalue = [int(np.float64(i) * adc_range) for i in match.groups()]
                     # else, append as int
                     else:
                         dvalue = [int(i) for i in match.groups()]
@@ -200,30 +348,84 @@ class TraceDatasetBuilder:
                 # returns: [combined digital value, ...] (1D array)
                 else:
                     dvalue = [0]
-                    # if normalized, multiply 256 to get original value
-                    if normalized_digital:
+                    # if normalized, multiply adc_range to get original value
+                    if self.normalized_digital:
                         for i in match.groups():
-                            dvalue[0] = dvalue[0] * 256 + int(np.float64(i) * 256)
+                            dvalue[0] = dvalue[0] * adc_range + int(np.float64(i) * adc_range)
                     # else, append as int 
                     else:
                         for i in match.groups():
-                            dvalue[0]  = dvalue[0] * 256 + int(i)
+                            dvalue[0]  = dvalue[0] * adc_range + int(i)
                 
                 self.file_list.append((fname, fpath, dvalue))
 
+    # Loads every trace once into one contiguous (N, L) float32 tensor; traces are not cached on the way
+    def load_traces(self):
+        loader = TraceDataset(self.file_list, self.avg_exp, cache=False)
+        trace_list = [loader.get_trace(fname, fpath) for fname, fpath, _ in self.file_list]
+        lengths = {len(trace) for trace in trace_list}
+        if len(lengths) > 1:
+            raise ValueError(f"ERROR - Traces have different lengths {sorted(lengths)}; cannot stack into one tensor")
+        trace_len = lengths.pop() if lengths else 0
+        traces = np.empty((len(trace_list), trace_len), dtype=np.float32)
+        for row, trace in enumerate(trace_list):
+            traces[row] = trace
+        return torch.from_numpy(traces)
+
+    @profiled("TraceDatasetBuilder.build")
     def build(self):
+        digital_values = np.array([dvalue for _, _, dvalue in self.file_list], dtype=np.int64).reshape(len(self.file_list), -1)
+        self.traces = self.load_traces()
+        self.bit_labels = torch.from_numpy(compute_bit_labels(digital_values, self.adc_num, self.adc_bits, self.split_digital))
+
         # dataset = TraceDataset, trace - digital value label ONLY
-        self.dataset = TraceDataset(self.file_list, cache=self.cache)
+        self.dataset = TraceDataset(self.file_list, self.avg_exp, cache=False,
+                                    traces=self.traces, labels=torch.from_numpy(digital_values))
+        # bit_dataset = TraceDataset, trace - all adc_num * adc_bits bit labels; used by multi-head training
+        self.bit_dataset = TraceDataset(self.file_list, self.avg_exp, cache=False,
+                                        traces=self.traces, labels=self.bit_labels)
         # Append dataloaders IN LSB ORDER; dataloader[0] = adc[0], bit[0]
         # dataloader[39] = adc[4], bit[7]
         # adc_dataloader[adc_num] = [dataloader[adc_num*8+0], dataloader[adc_num*8+1], ..., dataloader[adc_num*8+7]]
-        for adc in range(adc_num):
+        # Every TraceDatasetBW shares self.traces; its labels are a column view of self.bit_labels
+        for adc in range(self.adc_num):
             for bit in range(self.adc_bits):
-                self.datasets.append(TraceDatasetBW(self.file_list, bit, adc, cache=self.cache))
-                
-        if self.cache:
-            self.dataset.cache_all()
+                self.datasets.append(TraceDatasetBW(self.file_list, bit, adc, cache=False, split_digital=self.split_digital,
+                                                    normalize_digital=self.normalized_digital, avg_exp=self.avg_exp, adc_bits=self.adc_bits,
+                                                    traces=self.traces, bit_labels=self.bit_labels[:, adc * self.adc_bits + bit]))
+
+    # batched: each batch is fetched with one get_batch call instead of batch_size __getitem__ calls + collate
+    def build_dataloaders(self, batched=True, **kwargs): # batch_size=256, shuffle=True
+        make_loader = create_batch_dataloader if batched else DataLoader
+        if batched and kwargs.get("num_workers", 0) > 0:
+            # Workers read the shared tensors from shared memory instead of each receiving a copy
+            self.traces.share_memory_()
+            self.bit_labels.share_memory_()
+            self.dataset.labels.share_memory_()
+        self.dataloader = make_loader(self.dataset, **kwargs)
+        self.bit_dataloader = make_loader(self.bit_dataset, **kwargs)
+        self.dataloaders = [make_loader(dataset, **kwargs) for dataset in self.datasets]
+
+# Collate for create_batch_dataloader; batches already come out of TraceDataset.get_batch as tensors
+def collate_batch(batch):
+    traces, labels = batch
+    return torch.as_tensor(traces), torch.as_tensor(labels)
 
-    def build_dataloaders(self, **kwargs): # batch_size=256, shuffle=True
-        self.dataloader = DataLoader(self.dataset, **kwargs)
-        self.dataloaders = [DataLoader(dataset, **kwargs) for dataset in self.datasets]
\ No newline at end of file
+def create_batch_dataloader(dataset, batch_size=1, shuffle=False, drop_last=False, generator=None,
+                            num_workers=0, pin_memory=False, persistent_workers=None, **kwargs):
+    ''' Builds a DataLoader that fetches whole batches from a TraceDataset
+    A BatchSampler is used as the sampler, so the dataset receives one list of indices per batch
+    Inputs:
+        dataset             : TraceDataset or TraceDatasetBW
+        batch_size, shuffle, drop_last, generator : same as DataLoader
+        num_workers, pin_memory : same as DataLoader
+        persistent_workers  : same as DataLoader; default keeps workers alive between epochs when num_workers > 0
+    Outputs:
+        dataloader          : DataLoader yielding (traces, labels) tensors
+    '''
+    sampler = RandomSampler(dataset, generator=generator) if shuffle else SequentialSampler(dataset)
+    if persistent_workers is None:
+        persistent_workers = num_workers > 0
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None,
+                      collate_fn=collate_batch, num_workers=num_workers, pin_memory=pin_memory,
+                      persistent_workers=persistent_workers, **kwargs)
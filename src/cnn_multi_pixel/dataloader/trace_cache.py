@@ -0,0 +1,101 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+
+# Default memory limit of a TraceCache; 1 GiB
+DEFAULT_CACHE_BYTES = 1 << 30
+
+class TraceCache:
+    '''
+    Class used to cache loaded traces, keyed by file path.
+    Bounded in bytes; the least recently used traces are evicted first.
+    Evicted traces can be spilled to a backing file and served back as read-only np.memmap views.
+    One TraceCache may be shared by several datasets(ex. train and test) by passing it explicitly.
+    Attributes:
+        1) self.max_bytes: int; Memory limit; None for no limit
+        2) self.spill_path: string; Full path to backing file of evicted traces; None to drop evicted traces
+        3) self.entries: OrderedDict; File path to trace, least recently used first
+        4) self.nbytes: int; Total bytes of cached traces
+        5) self.hits, self.misses, self.evictions, self.spill_hits: int; Counters
+    Input for initialization:
+        1) max_bytes: int; Memory limit; None for no limit
+        2) spill_path: string; Full path to backing file; created or truncated
+    '''
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, spill_path=None):
+        self.max_bytes  = max_bytes
+        self.spill_path = spill_path
+        self.entries    = OrderedDict()
+        self.nbytes     = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self.spill_hits = 0
+        # spill_index: file path -> (offset, shape, dtype) in backing file
+        self.spill_index = {}
+        self.spill_size  = 0
+        self.lock        = threading.Lock()
+        if spill_path is not None:
+            open(spill_path, "wb").close()
+
+    # Number of traces held in memory
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.spill_index
+
+    # Get trace of key; None on a miss
+    def get(self, key):
+        with self.lock:
+            trace = self.entries.get(key)
+            if trace is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return trace
+            if key in self.spill_index:
+                offset, shape, dtype = self.spill_index[key]
+                self.spill_hits += 1
+                return np.memmap(self.spill_path, dtype=dtype, mode="r", offset=offset, shape=shape)
+            self.misses += 1
+            return None
+
+    # Add or replace trace of key, then evict down to max_bytes; traces larger than max_bytes are not kept in memory
+    # A spilled copy of key is dropped, so a replaced trace is spilled again on its next eviction
+    def put(self, key, trace):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key).nbytes
+            self.spill_index.pop(key, None)
+            self.entries[key] = trace
+            self.nbytes += trace.nbytes
+            while self.max_bytes is not None and self.nbytes > self.max_bytes and self.entries:
+                evict_key, evict_trace = self.entries.popitem(last=False)
+                self.nbytes -= evict_trace.nbytes
+                self.evictions += 1
+                self.spill(evict_key, evict_trace)
+
+    # Append evicted trace to backing file; a key already spilled since its last put is not written again
+    # Bytes of dropped copies stay in the file until clear()
+    def spill(self, key, trace):
+        if self.spill_path is None or trace.nbytes == 0 or key in self.spill_index:
+            return
+        trace = np.ascontiguousarray(trace)
+        with open(self.spill_path, "ab") as f:
+            trace.tofile(f)
+        self.spill_index[key] = (self.spill_size, trace.shape, trace.dtype)
+        self.spill_size += trace.nbytes
+
+    # Drop every cached trace; counters are kept
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.spill_index.clear()
+            self.spill_size = 0
+            if self.spill_path is not None:
+                open(self.spill_path, "wb").close()
+
+    # Get counters and sizes as a dictionary
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "spill_hits": self.spill_hits,
+                "entries": len(self.entries), "bytes": self.nbytes, "spilled": len(self.spill_index), "spill_bytes": self.spill_size}
@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import hashlib
+from src.cnn_multi_pixel.helper_functions.profiler import profiled
+from src.cnn_multi_pixel.preprocessing.preprocessing_array import list_folder_files, convert_file_bulk, create_raw_traces
+from src.cnn_multi_pixel.helper_functions.subsampler import sample_raw_dataset_modes
+from src.cnn_multi_pixel.dataset.dataset_raw import TraceDatasetRaw, create_and_save_raw_datasets, load_raw_datasets, upsert_raw_packed
+from src.cnn_multi_pixel.dataset.dataset_sampled import create_and_save_sampled_datasets, load_sampled_dataset, upsert_sampled_packed
+
+# Name of the manifest file kept in each dataset root directory
+MANIFEST_NAME = "manifest.json"
+
+class DatasetCache():
+    '''
+    Class used to keep track of which stored datasets are up to date.
+    Backed by a manifest file within a dataset root directory(datasets_raw_root or datasets_sampled_root).
+    Each manifest entry maps a dataset key to the fingerprint digest of the inputs it was built from.
+    Raw dataset roots also keep the per-file fingerprints of each folder, used for per-file updates.
+    Attributes:
+        1) self.root: string; Full path to dataset root directory
+        2) self.manifest_path: string; Full path to manifest file
+        3) self.entries: dictionary;
+            Key: string; Dataset key; folder name for raw datasets, "{folder_name}_{sample_mode}" for sampled datasets
+            Value: string; Fingerprint digest of stored dataset
+        4) self.files: dictionary; Folder name to folder fingerprint of stored raw dataset; see folder_fingerprint
+        5) self.scanned: dictionary; Folder name to folder fingerprint found by the current run, not yet recorded
+    Input for initialization:
+        1) root: string; Full path to dataset root directory
+    '''
+    def __init__(self, root):
+        self.root           = root
+        self.manifest_path  = os.path.join(root, MANIFEST_NAME)
+        self.entries        = {}
+        self.files          = {}
+        self.scanned        = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            self.entries = manifest["datasets"]
+            self.files   = manifest["files"]
+
+    # Check if stored dataset of key was built from inputs with given digest and still exists
+    def is_current(self, key, digest, dataset_names):
+        if self.entries.get(key) != digest:
+            return False
+        return any(os.path.exists(os.path.join(self.root, name)) for name in dataset_names)
+
+    # Record digest of a newly stored dataset, plus its folder fingerprint for raw datasets
+    def record(self, key, digest, files=None):
+        self.entries[key] = digest
+        if files is not None:
+            self.files[key] = files
+
+    # Write manifest; replaced atomically so an interrupted run never leaves a corrupt manifest
+    def save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"datasets": self.entries, "files": self.files}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+'''
+Function that fingerprints a single trace file
+Input:
+    1) file_path: string; full path to file
+    2) content_hash: bool; If True, also hash the file contents
+Returns:
+    1) fingerprint: list; [size in bytes, mtime in ns, sha256 of contents or None]
+'''
+def file_fingerprint(file_path, content_hash=False):
+    stat = os.stat(file_path)
+    digest = None
+    if content_hash:
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+    return [stat.st_size, stat.st_mtime_ns, digest]
+
+'''
+Function that fingerprints all trace files of a single trace folder
+Input:
+    1) trace_root: string; Full path to trace folder directory
+    2) folder_name: string; Name of target folder
+    3) folder_dict: dictionary; see create_raw_traces
+        folder_dict["file_name_pattern"]: string; RegEx pattern for correct file name with group(s)
+        folder_dict["file_label_function"]: string; label function to get digital value from file name
+    4) content_hash: bool; If True, also hash the file contents
+Returns:
+    1) fingerprint: dictionary;
+        fingerprint["files"]: dictionary; File name to file_fingerprint of every matching file
+        fingerprint["file_name_pattern"], fingerprint["file_label_function"]: same as folder_dict
+'''
+def folder_fingerprint(trace_root, folder_name, folder_dict, content_hash=False):
+    folder_path = os.path.join(trace_root, folder_name)
+    if not os.path.exists(folder_path):
+        raise FileNotFoundError(f"ERROR - The following trace folder is missing: {folder_name} ")
+    files = {}
+    for file in sorted(os.listdir(folder_path)):
+        if re.search(folder_dict["file_name_pattern"], file):
+            files[file] = file_fingerprint(os.path.join(folder_path, file), content_hash)
+    return {"files": files, "file_name_pattern": folder_dict["file_name_pattern"],
+            "file_label_function": folder_dict["file_label_function"]}
+
+'''
+Function that digests a folder fingerprint into a raw dataset digest
+Input:
+    1) fingerprint: dictionary; see folder_fingerprint
+Returns:
+    1) digest: string; sha256 over file names, file fingerprints, file name pattern and label function
+'''
+def raw_digest(fingerprint):
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+'''
+Function that fingerprints a sampled dataset
+Input:
+    1) raw_digest: string; Digest of raw dataset the sampled dataset is built from
+    2) sample_interval: float; Sample interval
+    3) sample_duration: float; Sample duration
+    4) sample_mode: string; SINGLE sample mode
+Returns:
+    1) digest: string; sha256 over raw digest and sample parameters
+'''
+def sampled_digest(raw_digest, sample_interval, sample_duration, sample_mode):
+    key_data = [raw_digest, repr(float(sample_interval)), repr(float(sample_duration)), sample_mode]
+    return hashlib.sha256(json.dumps(key_data).encode()).hexdigest()
+
+def split_raw_folders(raw_cache, trace_root, target_dict, content_hash=False):
+    '''
+    Function that splits target folders into folders with an up to date stored raw dataset and folders to (re)build
+    Input:
+        1) raw_cache: DatasetCache; Cache over datasets_raw_root
+        2) trace_root: string; Full path to trace folder directory
+        3) target_dict: dictionary; see create_raw_traces
+        4) content_hash: bool; If True, file contents are hashed as well as size and mtime
+    Returns:
+        1) folders_saved: dictionary; Entries of target_dict whose raw dataset is up to date
+        2) folders_new: dictionary; Entries of target_dict that have to be parsed again
+        3) raw_digests: dictionary; Folder name to raw digest, for all target folders
+    '''
+    folders_saved, folders_new, raw_digests = {}, {}, {}
+    for folder_name, folder_dict in target_dict.items():
+        raw_cache.scanned[folder_name] = folder_fingerprint(trace_root, folder_name, folder_dict, content_hash)
+        raw_digests[folder_name] = raw_digest(raw_cache.scanned[folder_name])
+        if raw_cache.is_current(folder_name, raw_digests[folder_name], [f"{folder_name}_raw", f"{folder_name}_raw.gz"]):
+            folders_saved[folder_name] = folder_dict
+        else:
+            folders_new[folder_name] = folder_dict
+    return folders_saved, folders_new, raw_digests
+
+def split_sampled_folders(sampled_cache, target_dict, raw_digests):
+    '''
+    Function that splits target folders by the sample modes that have an up to date stored sampled dataset
+    Input:
+        1) sampled_cache: DatasetCache; Cache over datasets_sampled_root
+        2) target_dict: dictionary; Same as create_and_save_sampled_datasets' folder_dict
+        3) raw_digests: dictionary; Folder name to raw digest; see split_raw_folders
+    Returns:
+        1) sampled_saved: dictionary; Folder name to list of up to date sample modes
+        2) sampled_new: dictionary; Copies of target_dict entries with "sample_modes" reduced to modes to (re)build
+                        Folders with every mode up to date are left out
+    '''
+    sampled_saved, sampled_new = {}, {}
+    for folder_name, folder_dict in target_dict.items():
+        saved_modes, new_modes = [], []
+        for sample_mode in folder_dict["sample_modes"]:
+            digest = sampled_digest(raw_digests[folder_name], folder_dict["sample_interval"], folder_dict["sample_duration"], sample_mode)
+            dataset_names = [f"{folder_name}_{sample_mode}_sam", f"{folder_name}_{sample_mode}_sam.gz"]
+            if sampled_cache.is_current(f"{folder_name}_{sample_mode}", digest, dataset_names):
+                saved_modes.append(sample_mode)
+            else:
+                new_modes.append(sample_mode)
+        sampled_saved[folder_name] = saved_modes
+        if new_modes:
+            sampled_new[folder_name] = dict(folder_dict, sample_modes=new_modes)
+    return sampled_saved, sampled_new
+
+def changed_folder_files(raw_cache, trace_root, folder_name, folder_dict):
+    '''
+    Function that finds the trace files of a folder that changed since its raw dataset was stored
+    Per-file updates need a stored packed raw dataset, the same file name pattern and label function,
+    and no removed files; otherwise the folder has to be rebuilt
+    Input:
+        1) raw_cache: DatasetCache; Cache over datasets_raw_root, after split_raw_folders
+        2) trace_root: string; Full path to trace folder directory
+        3) folder_name: string; Name of target folder
+        4) folder_dict: dictionary; see create_raw_traces
+    Returns:
+        1) changed_files: list of tuples; (digital value, full path to file) of new or changed files; None if folder must be rebuilt
+    '''
+    stored, scanned = raw_cache.files.get(folder_name), raw_cache.scanned[folder_name]
+    if stored is None or not os.path.isdir(os.path.join(raw_cache.root, f"{folder_name}_raw")):
+        return None
+    if stored["file_name_pattern"] != scanned["file_name_pattern"] or stored["file_label_function"] != scanned["file_label_function"]:
+        return None
+    if set(stored["files"]) - set(scanned["files"]):
+        return None
+    # Same file per digital value as convert_folder; the last file name in sorted order wins
+    label_files = dict(list_folder_files(trace_root, folder_name, folder_dict["file_name_pattern"], folder_dict["file_label_function"]))
+    return [(digital_val, file_path) for digital_val, file_path in label_files.items()
+            if stored["files"].get(os.path.basename(file_path)) != scanned["files"][os.path.basename(file_path)]]
+
+def record_raw_folders(raw_cache, folder_names, raw_digests):
+    '''
+    Function that records newly stored raw datasets in the manifest and saves it
+    Input:
+        1) raw_cache: DatasetCache; Cache over datasets_raw_root
+        2) folder_names: list of strings; Folders whose raw datasets were just stored
+        3) raw_digests: dictionary; Folder name to raw digest; see split_raw_folders
+    '''
+    for folder_name in folder_names:
+        raw_cache.record(folder_name, raw_digests[folder_name], raw_cache.scanned.get(folder_name))
+    raw_cache.save()
+
+def record_sampled_folders(sampled_cache, sampled_new, raw_digests):
+    '''
+    Function that records newly stored sampled datasets in the manifest and saves it
+    Input:
+        1) sampled_cache: DatasetCache; Cache over datasets_sampled_root
+        2) sampled_new: dictionary; see split_sampled_folders
+        3) raw_digests: dictionary; Folder name to raw digest; see split_raw_folders
+    '''
+    for folder_name, folder_dict in sampled_new.items():
+        for sample_mode in folder_dict["sample_modes"]:
+            digest = sampled_digest(raw_digests[folder_name], folder_dict["sample_interval"], folder_dict["sample_duration"], sample_mode)
+            sampled_cache.record(f"{folder_name}_{sample_mode}", digest)
+    sampled_cache.save()
+
+@profiled("update_datasets")
+def update_datasets(trace_root, datasets_raw_root, datasets_sampled_root, target_dict, content_hash=False, workers=1, codec=None):
+    '''
+    Function that brings the stored raw and sampled datasets of all target folders up to date
+    Unchanged folders are not touched. Folders with only new or changed files are updated per file:
+    only those files are parsed and subsampled, and their rows are upserted into the stored datasets.
+    All other outdated folders are rebuilt.
+    Input:
+        1) trace_root: string; Full path to trace folder directory
+        2) datasets_raw_root: string; Full path to directory where all raw datasets are stored
+        3) datasets_sampled_root: string; Full path to directory where all sampled datasets are stored
+        4) target_dict: dictionary; Folder name to folder_dict with both file settings(see create_raw_traces)
+                                    and sample settings(see create_and_save_sampled_datasets)
+        5) content_hash: bool; If True, file contents are hashed as well as size and mtime
+        6) workers: int; Number of worker processes used to parse rebuilt folders; see create_raw_traces
+        7) codec: Codec; Codec of rebuilt datasets, see helper_functions/codec.py; None for plain .npy files
+                         Datasets updated per file keep the codec they were stored with
+    Returns:
+        1) raw_datasets: list of TraceDatasetRaw; Raw datasets of all target folders
+        2) sampled_datasets: list of TraceDatasetSampled; Sampled datasets of all target folders and sample modes
+    '''
+    raw_cache = DatasetCache(datasets_raw_root)
+    sampled_cache = DatasetCache(datasets_sampled_root)
+    stored_digests = {folder_name: raw_cache.entries.get(folder_name) for folder_name in target_dict}
+    folders_saved, folders_new, raw_digests = split_raw_folders(raw_cache, trace_root, target_dict, content_hash)
+
+    # 1) Raw datasets; upsert changed files, rebuild the rest
+    rebuild_dict, changed_dict = {}, {}
+    for folder_name, folder_dict in folders_new.items():
+        changed_files = changed_folder_files(raw_cache, trace_root, folder_name, folder_dict)
+        if changed_files is None:
+            rebuild_dict[folder_name] = folder_dict
+        else:
+            changed_dict[folder_name] = {digital_val: convert_file_bulk(file_path) for digital_val, file_path in changed_files}
+    raw_datasets = {raw_dataset.get_folder_name(): raw_dataset for raw_dataset in
+                    create_and_save_raw_datasets(datasets_raw_root, create_raw_traces(trace_root, rebuild_dict, bulk=True, workers=workers), codec=codec)}
+    for folder_name, raw_dict in changed_dict.items():
+        raw_datasets[folder_name] = upsert_raw_packed(os.path.join(datasets_raw_root, f"{folder_name}_raw"), raw_dict)
+    record_raw_folders(raw_cache, folders_new.keys(), raw_digests)
+
+    # 2) Sampled datasets; modes that were current for the stored raw dataset only need the changed rows
+    sampled_saved, sampled_new = split_sampled_folders(sampled_cache, target_dict, raw_digests)
+    for folder_name, folder_dict in sampled_new.items():
+        sample_interval, sample_duration = folder_dict["sample_interval"], folder_dict["sample_duration"]
+        upsert_modes, rebuild_modes = [], []
+        for sample_mode in folder_dict["sample_modes"]:
+            stored_digest = sampled_digest(stored_digests[folder_name], sample_interval, sample_duration, sample_mode)
+            if folder_name in changed_dict and sampled_cache.is_current(f"{folder_name}_{sample_mode}", stored_digest, [f"{folder_name}_{sample_mode}_sam"]):
+                upsert_modes.append(sample_mode)
+            else:
+                rebuild_modes.append(sample_mode)
+        if upsert_modes:
+            changed_dataset = TraceDatasetRaw(folder_name, changed_dict[folder_name])
+            for sampled_dataset in sample_raw_dataset_modes(changed_dataset, sample_interval, sample_duration, upsert_modes):
+                upsert_sampled_packed(os.path.join(datasets_sampled_root, f"{folder_name}_{sampled_dataset.sample_mode}_sam"), sampled_dataset)
+        if rebuild_modes:
+            if folder_name not in raw_datasets:
+                raw_datasets[folder_name] = load_raw_datasets(datasets_raw_root, [folder_name])[0]
+            create_and_save_sampled_datasets(datasets_sampled_root, [raw_datasets[folder_name]], {folder_name: dict(folder_dict, sample_modes=rebuild_modes)}, codec=codec)
+    record_sampled_folders(sampled_cache, sampled_new, raw_digests)
+
+    raw_datasets = load_raw_datasets(datasets_raw_root, list(target_dict))
+    sampled_datasets = [sampled_dataset for sampled_dataset in load_sampled_dataset(datasets_sampled_root, list(target_dict))
+                        if sampled_dataset.sample_mode in target_dict[sampled_dataset.get_folder_name()]["sample_modes"]]
+    return raw_datasets, sampled_datasets
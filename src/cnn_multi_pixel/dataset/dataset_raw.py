@@ -3,81 +3,278 @@ import os
 import gzip
 import pickle
 from torch.utils.data import Dataset
+from src.cnn_multi_pixel.preprocessing.preprocessing_array import trace_to_arrays
+from src.cnn_multi_pixel.helper_functions.npy_file import splice_npy
+from src.cnn_multi_pixel.helper_functions.codec import save_array, load_array, read_codec
+from src.cnn_multi_pixel.helper_functions.profiler import profiled
 
 class TraceDatasetRaw(Dataset):
     ''' 
     Class used to create a raw dataset. Each dataset represents a single trace folder.
+    Backed either by a dictionary of traces or by packed columnar arrays(see pack_raw_dict),
+    which may be np.memmap arrays opened by load_raw_packed.
     Dataset values via __getitem__:
         Index: int; Full digital value.
         Item:  list of tuples; Full list of (time, value) tuples of corresponding digital value.
+               If packed, tuple of np.ndarray; (time_arr, value_arr) views into the packed arrays.
     Attributes:
         1) self.folder_name: string; Name of folder. Used to identify raw dataset.
-        2) self.digital_dict: dictionary;
+        2) self.raw_dict: dictionary; None if packed
             Key: string; file name
             Value: list of tuples; np.float64; trace value array
+        3) self.packed: tuple of np.ndarray; (times, values, offsets, digital_values); None until packed
+        4) self.row_index: dictionary; digital value to row of packed arrays; None until packed
     Input for initialization:
         1) folder_name: string; Name of folder where traces originate
         2) label_dict; dictionary;
             Key: string; file name
             Value: list of tuples; np.float64; trace value array
+        3) packed: tuple of np.ndarray; (times, values, offsets, digital_values); used if label_dict is None
     '''
-    def __init__(self, folder_name, digital_to_time_val_dict):
+    def __init__(self, folder_name, digital_to_time_val_dict=None, packed=None):
         self.folder_name    = folder_name
         self.raw_dict       = digital_to_time_val_dict
+        self.packed         = None
+        self.row_index      = None
+        if digital_to_time_val_dict is None:
+            self.set_packed(packed)
 
     # Number of total files within folder
     def __len__(self):
-        return len(self.raw_dict.keys())
+        if self.raw_dict is not None:
+            return len(self.raw_dict.keys())
+        return len(self.row_index)
     
     # Get item via digital value
     def __getitem__(self, digital_value):
-        return self.raw_dict[digital_value]
+        if self.raw_dict is not None:
+            return self.raw_dict[digital_value]
+        return self.get_packed_trace(self.row_index[digital_value])
     
     # Get folder name
     def get_folder_name(self):
         return self.folder_name
     
-    # Get full raw_dict
+    # Get full raw_dict; if packed, values are (time_arr, value_arr) views
     def get_raw_dict(self):
-        return self.raw_dict
+        if self.raw_dict is not None:
+            return self.raw_dict
+        return {digital_value: self.get_packed_trace(row) for digital_value, row in self.row_index.items()}
+
+    # Get all traces packed into flat arrays; see pack_raw_dict
+    def get_packed_traces(self):
+        if self.packed is None:
+            self.set_packed(pack_raw_dict(self.raw_dict))
+        return self.packed
+
+    # Get (time_arr, value_arr) views of a single packed trace
+    def get_packed_trace(self, row):
+        times, values, offsets, _ = self.packed
+        start, stop = offsets[row], offsets[row + 1]
+        return times[start:stop], values[start:stop]
+
+    # Set packed arrays and the digital value to row index
+    def set_packed(self, packed):
+        self.packed    = packed
+        self.row_index = {int(digital_value): row for row, digital_value in enumerate(packed[3])}
+
+def pack_raw_dict(raw_dict):
+    ''' 
+    Function used to pack every trace of a raw dict into flat arrays.
+    Trace i occupies [offsets[i], offsets[i+1]) of times and values.
+    Input:
+        1) raw_dict: dictionary;
+            Key: int; digital value
+            Value: list of (time, value) tuples or (time_arr, value_arr) tuple; see trace_to_arrays
+    Returns:
+        1) times: np.ndarray; np.float64; time values of all traces
+        2) values: np.ndarray; np.float64; trace values of all traces
+        3) offsets: np.ndarray; np.int64; start index of each trace, plus total length
+        4) digital_values: np.ndarray; np.int64; digital value of each trace
+    '''
+    digital_values = np.fromiter(raw_dict.keys(), dtype=np.int64, count=len(raw_dict))
+    traces = [trace_to_arrays(trace) for trace in raw_dict.values()]
+    offsets = np.zeros(len(traces) + 1, dtype=np.int64)
+    np.cumsum([len(time_arr) for time_arr, _ in traces], out=offsets[1:])
+
+    if not traces:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64), offsets, digital_values
+    times  = np.concatenate([time_arr for time_arr, _ in traces])
+    values = np.concatenate([value_arr for _, value_arr in traces])
+    return times, values, offsets, digital_values
     
-def create_and_save_raw_datasets(raw_save_dir, total_raw_dict):
+# File names of the packed(columnar) raw dataset format; one directory per folder
+PACKED_FILES = ("times", "values", "offsets", "digital_values")
+# Filters applied to the time column when it is compressed; near-uniform times shrink to a few distinct bytes
+TIME_FILTERS = ("delta", "shuffle")
+
+def save_raw_packed(raw_save_dir, raw_dataset, codec=None, time_filters=TIME_FILTERS):
+    ''' 
+    Function used to save a raw dataset in the packed(columnar) format.
+    Creates directory {folder_name}_raw holding one file per array of pack_raw_dict.
+    times and values are stored with codec; offsets and digital_values are always plain .npy.
+    Input:
+        1) raw_save_dir: string; Full path to directory where all raw datasets are stored.
+        2) raw_dataset: TraceDatasetRaw; Raw dataset to save
+        3) codec: Codec; None for plain, memory-mappable .npy files; see helper_functions/codec.py
+        4) time_filters: tuple of strings; Filters of the time column, used if codec compresses
+    Returns:
+        1) dataset_dir: string; Full path to saved dataset directory
+    '''
+    dataset_dir = os.path.join(raw_save_dir, f"{raw_dataset.get_folder_name()}_raw")
+    os.makedirs(dataset_dir, exist_ok=True)
+    codecs = {"times": codec, "values": codec}
+    if codec is not None and codec.name != "none":
+        codecs["times"] = codec.with_filters(time_filters)
+    for file_name, array in zip(PACKED_FILES, raw_dataset.get_packed_traces()):
+        save_array(os.path.join(dataset_dir, file_name), array, codecs.get(file_name))
+    return dataset_dir
+
+def load_raw_packed(dataset_dir, mmap=True):
+    ''' 
+    Function used to load a raw dataset saved by save_raw_packed.
+    Input:
+        1) dataset_dir: string; Full path to dataset directory {folder_name}_raw
+        2) mmap: bool; If True, plain times and values are opened as read-only np.memmap; only touched pages are read
+                       Compressed arrays are decoded into memory with the codec recorded in their header
+    Returns:
+        1) load_dataset: TraceDatasetRaw; packed raw dataset
+    '''
+    folder_name = os.path.basename(os.path.normpath(dataset_dir))[:-len("_raw")]
+    packed = tuple(load_array(os.path.join(dataset_dir, file_name), mmap_mode=("r" if mmap and file_name in ("times", "values") else None))
+                   for file_name in PACKED_FILES)
+    return TraceDatasetRaw(folder_name, packed=packed)
+
+def upsert_raw_packed(dataset_dir, raw_dict):
+    ''' 
+    Function used to add new traces to, or replace traces of, a raw dataset saved by save_raw_packed.
+    New digital values are appended. Replaced traces of unchanged length are overwritten in place;
+    if a replaced trace changes length, times/values are rewritten from that trace onward.
+    Input:
+        1) dataset_dir: string; Full path to dataset directory {folder_name}_raw
+        2) raw_dict: dictionary; New or changed traces only
+            Key: int; digital value
+            Value: list of (time, value) tuples or (time_arr, value_arr) tuple; see trace_to_arrays
+    Returns:
+        1) load_dataset: TraceDatasetRaw; updated packed raw dataset
+    '''
+    codec = read_codec(os.path.join(dataset_dir, "values"))
+    if not codec.plain:
+        return rewrite_raw_packed(dataset_dir, raw_dict, codec)
+    paths = {file_name: os.path.join(dataset_dir, file_name + ".npy") for file_name in PACKED_FILES}
+    offsets = np.load(paths["offsets"])
+    digital_values = np.load(paths["digital_values"])
+    row_index = {int(digital_value): row for row, digital_value in enumerate(digital_values)}
+    lengths = np.diff(offsets)
+    traces = {int(digital_value): trace_to_arrays(trace) for digital_value, trace in raw_dict.items()}
+
+    # Rows from first_moved onward are rewritten; earlier replaced rows of equal length are written in place
+    first_moved = len(digital_values)
+    for digital_value, (time_arr, _) in traces.items():
+        if digital_value in row_index and len(time_arr) != lengths[row_index[digital_value]]:
+            first_moved = min(first_moved, row_index[digital_value])
+    in_place = [dv for dv in traces if dv in row_index and row_index[dv] < first_moved]
+    appended = [dv for dv in traces if dv not in row_index]
+
+    tail_times, tail_values, tail_lengths = [], [], []
+    if in_place or first_moved < len(digital_values):
+        times = np.load(paths["times"], mmap_mode="r+")
+        values = np.load(paths["values"], mmap_mode="r+")
+        for digital_value in in_place:
+            start, stop = offsets[row_index[digital_value]], offsets[row_index[digital_value] + 1]
+            times[start:stop], values[start:stop] = traces[digital_value]
+        for row in range(first_moved, len(digital_values)):
+            time_arr, value_arr = traces.get(int(digital_values[row]), (times[offsets[row]:offsets[row + 1]], values[offsets[row]:offsets[row + 1]]))
+            tail_times.append(np.array(time_arr))
+            tail_values.append(np.array(value_arr))
+            tail_lengths.append(len(time_arr))
+        times.flush()
+        values.flush()
+        del times, values
+    for digital_value in appended:
+        tail_times.append(traces[digital_value][0])
+        tail_values.append(traces[digital_value][1])
+        tail_lengths.append(len(traces[digital_value][0]))
+
+    if tail_lengths:
+        splice_npy(paths["times"], offsets[first_moved], np.concatenate(tail_times))
+        splice_npy(paths["values"], offsets[first_moved], np.concatenate(tail_values))
+        new_offsets = np.append(offsets[:first_moved + 1], offsets[first_moved] + np.cumsum(tail_lengths))
+        np.save(paths["offsets"], new_offsets.astype(np.int64))
+        np.save(paths["digital_values"], np.append(digital_values, np.asarray(appended, dtype=np.int64)))
+    return load_raw_packed(dataset_dir)
+
+def rewrite_raw_packed(dataset_dir, raw_dict, codec):
+    ''' 
+    Function used by upsert_raw_packed for compressed datasets, which can not be patched in place.
+    Replaced traces keep their row, new traces are appended, and the dataset is saved again with its codecs.
+    Input:
+        1) dataset_dir: string; Full path to dataset directory {folder_name}_raw
+        2) raw_dict: dictionary; New or changed traces only; see upsert_raw_packed
+        3) codec: Codec; Codec of the values column
+    Returns:
+        1) load_dataset: TraceDatasetRaw; updated packed raw dataset
+    '''
+    stored_dataset = load_raw_packed(dataset_dir, mmap=False)
+    merged_dict = stored_dataset.get_raw_dict()
+    merged_dict.update({int(digital_value): trace for digital_value, trace in raw_dict.items()})
+    new_dataset = TraceDatasetRaw(stored_dataset.get_folder_name(), merged_dict)
+    time_codec = read_codec(os.path.join(dataset_dir, "times"))
+    save_raw_packed(os.path.dirname(os.path.normpath(dataset_dir)), new_dataset, codec, time_codec.filters)
+    return load_raw_packed(dataset_dir)
+
+@profiled("create_and_save_raw_datasets", items=lambda datasets: sum(len(dataset) for dataset in datasets))
+def create_and_save_raw_datasets(raw_save_dir, total_raw_dict, storage="npy", codec=None):
     ''' 
     Function used to create and save raw datasets for both new training and testing trace folders.
     Input:
-        1) raw_save_dir: string; Full path to directory where all raw datasets are stored as .gz files.
+        1) raw_save_dir: string; Full path to directory where all raw datasets are stored.
         2) total_raw_dict; dictionary;
             Key: string; Target folder name
             Value: dictionary; Contents of all files within folder
                 Key: string; file name
                 Value: list of tuples; np.float64; trace value array
+        3) storage: string; "npy" for the packed format(see save_raw_packed), "gz" for a gzip-pickled raw_dict export
+        4) codec: Codec; Codec of the packed format; None for plain .npy files
     Returns:
         1) new_datasets: list of TraceDatasetRaw objects; list of newly created raw datasets
     '''
+    if storage not in ("npy", "gz"):
+        raise ValueError(f"ERROR - Unknown raw dataset storage: {storage}")
     new_raw_datasets = []
     for folder_name, raw_dict in total_raw_dict.items():
         new_dataset = TraceDatasetRaw(folder_name, raw_dict)
-        new_dataset_path = os.path.join(raw_save_dir, f"{folder_name}_raw.gz")
-        save_data = {"folder_name": new_dataset.get_folder_name(), "raw_dict": new_dataset.get_raw_dict()}
-        with gzip.open(new_dataset_path, "wb") as f:
-            pickle.dump(save_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if storage == "npy":
+            save_raw_packed(raw_save_dir, new_dataset, codec)
+        else:
+            new_dataset_path = os.path.join(raw_save_dir, f"{folder_name}_raw.gz")
+            save_data = {"folder_name": new_dataset.get_folder_name(), "raw_dict": new_dataset.get_raw_dict()}
+            with gzip.open(new_dataset_path, "wb") as f:
+                pickle.dump(save_data, f, protocol=pickle.HIGHEST_PROTOCOL)
         new_raw_datasets.append(new_dataset)
     return new_raw_datasets
 
-def load_raw_datasets(raw_save_dir, folder_list):
+@profiled("load_raw_datasets", items=lambda datasets: sum(len(dataset) for dataset in datasets))
+def load_raw_datasets(raw_save_dir, folder_list, mmap=True):
     ''' 
     Function used to load saved raw datasets.
+    Packed datasets({folder_name}_raw directories) are preferred over gzip-pickled ones({folder_name}_raw.gz).
     Input:
-        1) raw_save_dir: string; Full path to directory where all raw datasets are stored as .gz files.
+        1) raw_save_dir: string; Full path to directory where all raw datasets are stored.
         2) folder_list: list of strings; List of all raw dataset folder names to load
+        3) mmap: bool; If True, packed datasets are memory-mapped; see load_raw_packed
     Returns:
         1) load_dataset_list: list of datasets; List of all loaded raw datasets
     '''
     load_dataset_list = []
     for folder_name in folder_list:
+        load_data_dir = os.path.join(raw_save_dir, folder_name + "_raw")
+        if os.path.isdir(load_data_dir):
+            load_dataset_list.append(load_raw_packed(load_data_dir, mmap))
+            continue
         load_data_path = os.path.join(raw_save_dir, folder_name + "_raw.gz")
         with gzip.open(load_data_path, "rb") as f:
             load_data = pickle.load(f)
             load_dataset = TraceDatasetRaw(load_data["folder_name"], load_data["raw_dict"])
         load_dataset_list.append(load_dataset)
-    return load_dataset_list
\ No newline at end of file
+    return load_dataset_list
@@ -2,63 +2,165 @@ import numpy as np
 import re
 import os
 import gzip
+import json
 import pickle
 from torch.utils.data import Dataset
-from src.cnn_multi_pixel.helper_functions.subsampler import sample_raw_dataset
+from src.cnn_multi_pixel.helper_functions.subsampler import SAMPLE_MODES, sample_raw_dataset_modes
+from src.cnn_multi_pixel.helper_functions.npy_file import splice_npy
+from src.cnn_multi_pixel.helper_functions.codec import save_array, load_array, read_codec
+from src.cnn_multi_pixel.helper_functions.profiler import profiled
 
 class TraceDatasetSampled(Dataset):
     ''' 
     Class used to create sampled datasets. Each dataset represents a single trace folder.
     Dataset values via __getitem__:
         Index: int; Full digital value.
-        Item:  list of np.float32; Full list of trace values of corresponding digital value.
+        Item:  np.ndarray; np.float32; Sampled trace of corresponding digital value. View into sample_trace_val.
     Attributes:
         1) self.folder_name: string; Name of folder. Used to identify raw dataset.
-        2) self.sample_trace_val: list; List of sampled trace values.
-        3) self.sample_info: tuple;
+        2) self.sample_trace_val: np.ndarray; np.float32; (n_files, n_samples) matrix of sampled traces.
+            np.memmap if opened by load_sampled_packed.
+        3) self.digital_values: np.ndarray; np.int64; Digital value of each row of sample_trace_val.
+        4) self.sample_info: tuple;
             sample_info[0]: sample_interval
             sample_info[1]: sample_duration
             sample_info[2]: sample_mode; SINGLE sample mode
     Input for initialization:
         1) folder_name: string; Name of folder where traces originate
-        2) label_dict; dictionary;
-            Key: string; file name
-            Value: list of tuples; np.float64; trace value array
+        2) sample_trace_val: np.ndarray; (n_files, n_samples) matrix of sampled traces
+        3) sample_info: tuple; (sample_interval, sample_duration, sample_mode)
+        4) digital_values: list of ints; Digital value of each row of sample_trace_val
     '''
-    def __init__(self, folder_name, sample_trace_val, sample_info):
+    def __init__(self, folder_name, sample_trace_val, sample_info, digital_values):
         self.folder_name        = folder_name
         self.sample_trace_val   = sample_trace_val
+        self.digital_values     = np.asarray(digital_values, dtype=np.int64)
+        self.sample_info        = tuple(sample_info)
         self.sample_interval    = sample_info[0]
         self.sample_duration    = sample_info[1]
         self.sample_mode        = sample_info[2]
         self.len                = int(self.sample_duration / self.sample_interval)
+        # row_index: digital value -> row of sample_trace_val
+        self.row_index          = {int(dv): row for row, dv in enumerate(self.digital_values)}
 
     # Number of total files within folder
     def __len__(self):
-        return self.len
+        return len(self.digital_values)
     
     # Get item via digital value
     def __getitem__(self, digital_value):
-        return self.sampled_dict[digital_value]
+        return self.sample_trace_val[self.row_index[digital_value]]
     
     # Get folder name
     def get_folder_name(self):
         return self.folder_name
     
-    # Get full sampled_dict
+    # Get full sampled_dict; values are row views, no copies
     def get_sampled_dict(self):
-        return self.sampled_dict
+        return {dv: self.sample_trace_val[row] for dv, row in self.row_index.items()}
+
+    # Get (n_files, n_samples) matrix of sampled traces
+    def get_sample_matrix(self):
+        return self.sample_trace_val
+
+    # Get digital values, ordered by matrix row
+    def get_digital_values(self):
+        return self.digital_values
     
     # Get sampe_info tuple
     def get_sample_info(self):
         return self.sample_info
     
-def create_and_save_sampled_datasets(raw_sampled_dir, raw_dataset_list, folder_dict):
+def save_sampled_packed(sampled_save_dir, sampled_dataset, codec=None):
+    ''' 
+    Function used to save a sampled dataset in the fixed-width format.
+    Creates directory {folder_name}_{sample_mode}_sam holding:
+        samples.npy: np.float32; (n_files, n_samples) matrix of sampled traces; samples.npc if codec compresses
+        digital_values.npy: np.int64; digital value of each row
+        sample_info.json: folder name, sample interval, sample duration and sample mode
+    Input:
+        1) sampled_save_dir: string; Full path to directory where all sampled datasets are stored.
+        2) sampled_dataset: TraceDatasetSampled; Sampled dataset to save
+        3) codec: Codec; Codec of samples; None for a plain, memory-mappable .npy file; see helper_functions/codec.py
+    Returns:
+        1) dataset_dir: string; Full path to saved dataset directory
+    '''
+    sample_interval, sample_duration, sample_mode = sampled_dataset.get_sample_info()
+    dataset_dir = os.path.join(sampled_save_dir, f"{sampled_dataset.get_folder_name()}_{sample_mode}_sam")
+    os.makedirs(dataset_dir, exist_ok=True)
+    save_array(os.path.join(dataset_dir, "samples"), np.ascontiguousarray(sampled_dataset.get_sample_matrix(), dtype=np.float32), codec)
+    np.save(os.path.join(dataset_dir, "digital_values.npy"), sampled_dataset.get_digital_values())
+    with open(os.path.join(dataset_dir, "sample_info.json"), "w") as f:
+        json.dump({"folder_name": sampled_dataset.get_folder_name(), "sample_interval": sample_interval,
+                   "sample_duration": sample_duration, "sample_mode": sample_mode}, f)
+    return dataset_dir
+
+def load_sampled_packed(dataset_dir, mmap=True):
+    ''' 
+    Function used to load a sampled dataset saved by save_sampled_packed.
+    Input:
+        1) dataset_dir: string; Full path to dataset directory {folder_name}_{sample_mode}_sam
+        2) mmap: bool; If True, plain samples are opened as read-only np.memmap shared through the page cache
+                       Compressed samples are decoded into memory with the codec recorded in their header
+    Returns:
+        1) load_dataset: TraceDatasetSampled; sampled dataset
+    '''
+    with open(os.path.join(dataset_dir, "sample_info.json"), "r") as f:
+        info = json.load(f)
+    sample_trace_val = load_array(os.path.join(dataset_dir, "samples"), mmap_mode=("r" if mmap else None))
+    digital_values = np.load(os.path.join(dataset_dir, "digital_values.npy"))
+    return TraceDatasetSampled(info["folder_name"], sample_trace_val,
+                               (info["sample_interval"], info["sample_duration"], info["sample_mode"]), digital_values)
+
+def upsert_sampled_packed(dataset_dir, sampled_dataset):
+    ''' 
+    Function used to add new rows to, or replace rows of, a sampled dataset saved by save_sampled_packed.
+    Rows are fixed width, so replaced rows are overwritten in place and new digital values are appended.
+    Input:
+        1) dataset_dir: string; Full path to dataset directory {folder_name}_{sample_mode}_sam
+        2) sampled_dataset: TraceDatasetSampled; New or changed rows only, sampled with the same sample_info
+    Returns:
+        1) load_dataset: TraceDatasetSampled; updated sampled dataset
+    '''
+    # Only the row order and sample info are read; the samples themselves stay on disk
+    with open(os.path.join(dataset_dir, "sample_info.json"), "r") as f:
+        info = json.load(f)
+    sample_info = (info["sample_interval"], info["sample_duration"], info["sample_mode"])
+    if sample_info != tuple(sampled_dataset.get_sample_info()):
+        raise ValueError(f"ERROR - Sample info {sampled_dataset.get_sample_info()} does not match stored dataset {dataset_dir}")
+    stored_values = np.load(os.path.join(dataset_dir, "digital_values.npy"))
+    row_index = {int(dv): row for row, dv in enumerate(stored_values)}
+    digital_values = sampled_dataset.get_digital_values()
+    sample_matrix = sampled_dataset.get_sample_matrix()
+    replaced = np.array([int(dv) in row_index for dv in digital_values], dtype=bool)
+    codec = read_codec(os.path.join(dataset_dir, "samples"))
+    if not codec.plain:
+        # Compressed samples can not be patched in place; decode, replace and append rows in memory and save again
+        samples = load_array(os.path.join(dataset_dir, "samples"))
+        samples[[row_index[int(dv)] for dv in digital_values[replaced]]] = sample_matrix[replaced]
+        samples = np.concatenate([samples, np.asarray(sample_matrix[~replaced], dtype=np.float32)])
+        stored_values = np.append(stored_values, digital_values[~replaced])
+        save_sampled_packed(os.path.dirname(os.path.normpath(dataset_dir)),
+                            TraceDatasetSampled(info["folder_name"], samples, sample_info, stored_values), codec)
+        return load_sampled_packed(dataset_dir)
+    samples_path = os.path.join(dataset_dir, "samples.npy")
+    if replaced.any():
+        samples = np.load(samples_path, mmap_mode="r+")
+        samples[[row_index[int(dv)] for dv in digital_values[replaced]]] = sample_matrix[replaced]
+        samples.flush()
+        del samples
+    if not replaced.all():
+        splice_npy(samples_path, len(row_index), sample_matrix[~replaced])
+        np.save(os.path.join(dataset_dir, "digital_values.npy"), np.append(stored_values, digital_values[~replaced]))
+    return load_sampled_packed(dataset_dir)
+
+@profiled("create_and_save_sampled_datasets", items=lambda datasets: sum(len(dataset) for dataset in datasets))
+def create_and_save_sampled_datasets(raw_sampled_dir, raw_dataset_list, folder_dict, storage="npy", codec=None):
     ''' 
     Function used to create and save sampled datasets for a list of raw datasets.
     Assumed to be run right after 'create_and_save_raw_dataset'
     Input:
-        1) raw_sampled_dir: string; Full path to directory where all sampled datasets are stored as .gz files.
+        1) raw_sampled_dir: string; Full path to directory where all sampled datasets are stored.
         2) raw_dataset_list: list; List of raw datasets to sample
         3) folder_dict: dictionary;
             Key: Folder name
@@ -66,41 +168,62 @@ def create_and_save_sampled_datasets(raw_sampled_dir, raw_dataset_list, folder_d
                 folder_dict["sample_modes"] = sample modes; Possible to have mulitple modes specified
                 folder_dict["sample_interval"] = sample interval
                 folder_dict["sample_duration"] = sample duration
+        4) storage: string; "npy" for the fixed-width format(see save_sampled_packed), "gz" for a gzip-pickled export
+        5) codec: Codec; Codec of the fixed-width format; None for plain .npy files
     Returns:
         1) new_sampled_datasets: list; List of newly created sampled datasets
     '''
+    if storage not in ("npy", "gz"):
+        raise ValueError(f"ERROR - Unknown sampled dataset storage: {storage}")
     new_sampled_datasets = []
     for raw_dataset in raw_dataset_list:
         folder_name = raw_dataset.get_folder_name()
         sample_modes = folder_dict[folder_name]["sample_modes"]
         sample_interval = folder_dict[folder_name]["sample_interval"]
         sample_duration = folder_dict[folder_name]["sample_duration"]
-        max_samples = int(sample_duration / sample_interval)
-        for sample_mode in sample_modes:
-            new_dataset = sample_raw_dataset(raw_dataset, sample_interval, max_samples, sample_mode)
-            new_dataset_path = os.path.join(raw_sampled_dir, f"{raw_dataset.get_folder_name()}_{sample_mode}_sam.gz")
-            save_data = {"folder_name": new_dataset.get_folder_name(), "sampled_dict": new_dataset.get_raw_dict()}
-            with gzip.open(new_dataset_path, "wb") as f:
-                pickle.dump(save_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # All modes share one pass over the raw traces
+        for new_dataset in sample_raw_dataset_modes(raw_dataset, sample_interval, sample_duration, sample_modes):
+            if storage == "npy":
+                save_sampled_packed(raw_sampled_dir, new_dataset, codec)
+            else:
+                sample_mode = new_dataset.sample_mode
+                new_dataset_path = os.path.join(raw_sampled_dir, f"{raw_dataset.get_folder_name()}_{sample_mode}_sam.gz")
+                save_data = {"folder_name": new_dataset.get_folder_name(), "sample_trace_val": new_dataset.get_sample_matrix(),
+                             "digital_values": new_dataset.get_digital_values(), "sample_info": new_dataset.get_sample_info()}
+                with gzip.open(new_dataset_path, "wb") as f:
+                    pickle.dump(save_data, f, protocol=pickle.HIGHEST_PROTOCOL)
             new_sampled_datasets.append(new_dataset)
     return new_sampled_datasets
 
-def load_sampled_dataset(sampled_save_dir, folder_list):
+@profiled("load_sampled_dataset", items=lambda datasets: sum(len(dataset) for dataset in datasets))
+def load_sampled_dataset(sampled_save_dir, folder_list, mmap=True):
     ''' 
-    Function used to load saved raw datasets.
+    Function used to load saved sampled datasets.
+    Fixed-width datasets({folder_name}_{mode}_sam directories) are preferred over gzip-pickled ones({folder_name}_{mode}_sam.gz).
     Input:
-        1) sampled_save_dir: string; Full path to directory where all sampled datasets are stored as .gz files.
+        1) sampled_save_dir: string; Full path to directory where all sampled datasets are stored.
         2) folder_list: list of strings; List of all raw dataset folder names to load
+        3) mmap: bool; If True, fixed-width datasets are memory-mapped; see load_sampled_packed
+    Returns:
+        1) load_dataset_list: list of datasets; List of all loaded sampled datasets
     '''
     load_dataset_list = []
     for folder_name in folder_list:
-        folder_pattern = rf"^{re.escape(folder_name)}_(\w+)_sam\.gz$"
-        for filename in os.listdir(sampled_save_dir):
+        # Only known mode names, so datasets of folders named "{folder_name}_...", ex) X_px_AVG_sam for folder X, are never opened
+        folder_pattern = rf"^{re.escape(folder_name)}_({'|'.join(SAMPLE_MODES)})_sam(\.gz)?$"
+        mode_files = {}
+        for filename in sorted(os.listdir(sampled_save_dir)):
             match = re.match(folder_pattern, filename)
-            if match:
-                load_data_path = os.path.join(sampled_save_dir, filename)
+            if match and (match.group(1) not in mode_files or not match.group(2)):
+                mode_files[match.group(1)] = filename
+        for filename in mode_files.values():
+            load_data_path = os.path.join(sampled_save_dir, filename)
+            if os.path.isdir(load_data_path):
+                load_dataset = load_sampled_packed(load_data_path, mmap)
+            else:
                 with gzip.open(load_data_path, "rb") as f:
                     load_data = pickle.load(f)
-                    load_dataset = TraceDatasetSampled(load_data["folder_name"], load_data["sampled_dict"])
-                load_dataset_list.append(load_dataset)
-    return load_dataset_list
\ No newline at end of file
+                    load_dataset = TraceDatasetSampled(load_data["folder_name"], load_data["sample_trace_val"],
+                                                       load_data["sample_info"], load_data["digital_values"])
+            load_dataset_list.append(load_dataset)
+    return load_dataset_list
@@ -0,0 +1,207 @@
+import bz2
+import io
+import json
+import lzma
+import os
+import struct
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional codecs; used only if the package is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Start of every compressed array file(.npc); followed by a uint32 header length, the JSON header and the blocks
+MAGIC = b"\x93NPC\x01"
+# Arrays are compressed in independent blocks of this many bytes, so they can be decompressed in parallel
+BLOCK_BYTES = 1 << 22
+
+'''
+Codecs selectable by name: (compress(data, level), decompress(data), default level)
+zlib, lzma and bz2 come with Python; zstd needs the 'zstandard' package and lz4 the 'lz4' package
+'''
+CODECS = {
+    "none": (lambda data, level: data, lambda data: data, None),
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress, 6),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6),
+    "bz2":  (lambda data, level: bz2.compress(data, level), bz2.decompress, 9),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data), 3)
+if lz4_frame is not None:
+    CODECS["lz4"] = (lambda data, level: lz4_frame.compress(data, compression_level=level), lz4_frame.decompress, 0)
+
+# delta: integer difference of consecutive bit patterns; near-uniform float64 times become small integers
+# Exact for any data, since unsigned differences and cumulative sums wrap around the same way
+def delta_encode(flat):
+    bits = flat.view(f"u{flat.dtype.itemsize}")
+    out = np.empty_like(bits)
+    if len(bits):
+        out[0] = bits[0]
+        np.subtract(bits[1:], bits[:-1], out=out[1:])
+    return out.view(flat.dtype)
+
+def delta_decode(flat):
+    bits = flat.view(f"u{flat.dtype.itemsize}")
+    return np.cumsum(bits, dtype=bits.dtype).view(flat.dtype)
+
+# shuffle: byte k of every element stored together; high bytes of similar values become long equal runs
+def shuffle_encode(flat):
+    return flat.view(np.uint8).reshape(-1, flat.dtype.itemsize).T.copy().reshape(-1).view(flat.dtype)
+
+def shuffle_decode(flat):
+    return flat.view(np.uint8).reshape(flat.dtype.itemsize, -1).T.copy().reshape(-1).view(flat.dtype)
+
+# Filters selectable by name: (encode, decode); applied in the given order before compression
+FILTERS = {
+    "delta": (delta_encode, delta_decode),
+    "shuffle": (shuffle_encode, shuffle_decode),
+}
+
+class Codec:
+    '''
+    Class used to select how dataset arrays are stored.
+    The codec "none" without filters keeps the plain, memory-mappable .npy format; anything else writes
+    a compressed .npc file whose header records codec, level, filters, dtype and shape, so load_array
+    needs no settings to read it back.
+    Attributes:
+        1) self.name: string; Key of CODECS
+        2) self.level: int; Compression level; default of the codec if None
+        3) self.filters: tuple of strings; Keys of FILTERS, ex) ("delta", "shuffle") for time columns
+    Input for initialization:
+        1) name, level, filters: see above
+    '''
+    def __init__(self, name="none", level=None, filters=()):
+        if name not in CODECS:
+            raise ValueError(f"ERROR - Unknown or unavailable codec \"{name}\"; choose from {sorted(CODECS)}")
+        for filter_name in filters:
+            if filter_name not in FILTERS:
+                raise ValueError(f"ERROR - Unknown filter \"{filter_name}\"; choose from {sorted(FILTERS)}")
+        self.name = name
+        self.level = CODECS[name][2] if level is None else level
+        self.filters = tuple(filters)
+
+    def __repr__(self):
+        return f"Codec({self.name!r}, level={self.level!r}, filters={self.filters!r})"
+
+    # Same codec and level with other filters, ex) codec.with_filters(("delta", "shuffle")) for time columns
+    def with_filters(self, filters):
+        return Codec(self.name, self.level, filters)
+
+    @property
+    def plain(self):
+        return self.name == "none" and not self.filters
+
+    # Codec from a string "name", "name:level" or "name:level:filter+filter", ex) "zstd:3", "zlib:1:shuffle"
+    @classmethod
+    def parse(cls, spec):
+        parts = spec.split(":")
+        level = int(parts[1]) if len(parts) > 1 and parts[1] else None
+        filters = tuple(parts[2].split("+")) if len(parts) > 2 and parts[2] else ()
+        return cls(parts[0], level, filters)
+
+    # Compressed file contents of array
+    def encode(self, array, workers=None):
+        array = np.ascontiguousarray(array)
+        flat = array.reshape(-1)
+        for filter_name in self.filters:
+            flat = FILTERS[filter_name][0](flat)
+        data = memoryview(flat.view(np.uint8))
+        compress = CODECS[self.name][0]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            blocks = list(executor.map(lambda start: compress(data[start:start + BLOCK_BYTES], self.level),
+                                       range(0, len(data), BLOCK_BYTES)))
+        header = json.dumps({"codec": self.name, "level": self.level, "filters": list(self.filters), "dtype": array.dtype.str,
+                             "shape": list(array.shape), "block_bytes": BLOCK_BYTES, "blocks": [len(block) for block in blocks]}).encode()
+        return b"".join([MAGIC, struct.pack("<I", len(header)), header] + blocks)
+
+# Header dictionary and data offset of a compressed array file
+def read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("ERROR - Not a compressed array file")
+    header_len, = struct.unpack("<I", f.read(4))
+    return json.loads(f.read(header_len)), len(MAGIC) + 4 + header_len
+
+'''
+Function that decodes the contents of a compressed array file written by Codec.encode
+Blocks are decompressed in a thread pool; zlib, lzma, bz2 and zstd release the GIL while decompressing
+Input:
+    1) data: bytes; File contents
+    2) workers: int; Threads; None uses the ThreadPoolExecutor default
+Returns:
+    1) array: np.ndarray; Writable array with the stored dtype and shape
+'''
+def decode(data, workers=None):
+    header, offset = read_header(io.BytesIO(data))
+    data = memoryview(data)
+    if header["codec"] not in CODECS:
+        raise ValueError(f"ERROR - Codec \"{header['codec']}\" of the stored array is not available; install it to load this dataset")
+    decompress = CODECS[header["codec"]][1]
+    dtype = np.dtype(header["dtype"])
+    n_bytes = int(np.prod(header["shape"], dtype=np.int64)) * dtype.itemsize
+    out = np.empty(n_bytes, dtype=np.uint8)
+    starts = np.cumsum([offset] + header["blocks"][:-1]) if header["blocks"] else []
+
+    def decompress_block(index):
+        start = index * header["block_bytes"]
+        block = decompress(data[starts[index]:starts[index] + header["blocks"][index]])
+        out[start:start + len(block)] = np.frombuffer(block, dtype=np.uint8)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(decompress_block, range(len(header["blocks"]))))
+    flat = out.view(dtype)
+    for filter_name in reversed(header["filters"]):
+        flat = FILTERS[filter_name][1](flat)
+    return flat.reshape(header["shape"])
+
+# Codec recorded in a stored array; Codec() for plain .npy files
+def read_codec(path_stem):
+    if not os.path.exists(path_stem + ".npc"):
+        return Codec()
+    with open(path_stem + ".npc", "rb") as f:
+        header, _ = read_header(f)
+    return Codec(header["codec"], header["level"], header["filters"])
+
+'''
+Function that stores an array as {path_stem}.npy, or {path_stem}.npc if codec compresses or filters
+The other file, if left from an earlier save with another codec, is removed
+Input:
+    1) path_stem: string; Full path without extension, ex) {dataset_dir}/times
+    2) array: np.ndarray; Array to store
+    3) codec: Codec; None for plain .npy
+Returns:
+    1) path: string; Full path of the written file
+'''
+def save_array(path_stem, array, codec=None):
+    codec = codec or Codec()
+    path, stale = (path_stem + ".npy", path_stem + ".npc") if codec.plain else (path_stem + ".npc", path_stem + ".npy")
+    if codec.plain:
+        np.save(path, np.ascontiguousarray(array))
+    else:
+        with open(path, "wb") as f:
+            f.write(codec.encode(array))
+    if os.path.exists(stale):
+        os.remove(stale)
+    return path
+
+'''
+Function that loads an array saved by save_array; the codec is read from the file header
+Input:
+    1) path_stem: string; Full path without extension
+    2) mmap_mode: passed to np.load for plain .npy files; compressed files are always read into memory
+Returns:
+    1) array: np.ndarray
+'''
+def load_array(path_stem, mmap_mode=None):
+    if os.path.exists(path_stem + ".npy"):
+        return np.load(path_stem + ".npy", mmap_mode=mmap_mode)
+    with open(path_stem + ".npc", "rb") as f:
+        return decode(f.read())
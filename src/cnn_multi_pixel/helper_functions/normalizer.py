@@ -2,45 +2,112 @@ import numpy as np
 # Change based on CNN pickle implementation
 # ALSO need to change normalization on SAMPLED DATASET
 import json
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from src.cnn_multi_pixel.helper_functions.profiler import profiled
+
+# Number of elements normalized at a time by LogNormalizer.transform; keeps temporaries cache sized
+TRANSFORM_CHUNK = 1 << 16
 
 # Class used to normalize trace arrays
 class LogNormalizer:
     def __init__(self, clip_min=1e-15):
         self.global_min = None
         self.global_max = None
+        # Running raw min/max of partial_fit
+        self.raw_min = None
+        self.raw_max = None
         # Using 1e-15 as clipping np.float64 values
         self.clip_min = clip_min
 
+    # Forget everything seen by partial_fit
+    def reset(self):
+        self.raw_min = None
+        self.raw_max = None
+        self.global_min = None
+        self.global_max = None
+
+    # Update running min/max with one batch; any array shape, including np.memmap chunks of a stored dataset
+    # log10 and clip are monotonic, so only the raw extremes are kept and no log array is ever built
+    def partial_fit(self, values):
+        values = np.asarray(values)
+        if values.size == 0:
+            return self
+        batch_min, batch_max = values.min(), values.max()
+        if self.raw_min is None:
+            self.raw_min, self.raw_max = batch_min, batch_max
+        else:
+            self.raw_min = np.minimum(self.raw_min, batch_min)
+            self.raw_max = np.maximum(self.raw_max, batch_max)
+        log_vals = np.log10(np.clip(np.array([self.raw_min, self.raw_max]), self.clip_min, None))
+        self.global_min = log_vals[0]
+        self.global_max = log_vals[1]
+        return self
+
+    # Fit from scratch over any iterable of arrays, e.g. a generator over a dataset store
+    @profiled("LogNormalizer.fit_iter")
+    def fit_iter(self, arrays):
+        self.reset()
+        for values in arrays:
+            self.partial_fit(values)
+        if self.raw_min is None:
+            raise ValueError("ERROR: no values to fit")
+        return self
+
     def fit_list(self, array_list):
-        all_vals = np.concatenate(array_list)
-        log_vals = np.log10(np.clip(all_vals, self.clip_min, None))
-        self.global_min = log_vals.min()
-        self.global_max = log_vals.max()
+        self.fit_iter(array_list)
         
     def fit_test_train(self, train_dict, test_dict):
-        all_vals = []
-        for trace_values in train_dict.values():
-            all_vals.append(trace_values)
-        for trace_values in test_dict.values():
-            all_vals.append(trace_values)
-        all_vals = np.concatenate(all_vals)
-        log_vals = np.log10(np.clip(all_vals, self.clip_min, None))
-        self.global_min = log_vals.min()
-        self.global_max = log_vals.max()
+        self.fit_iter(chain(train_dict.values(), test_dict.values()))
 
     def transform_list(self, arr):
-        log_arr = np.log10(np.clip(arr, self.clip_min, None))
-        return (log_arr - self.global_min) / (self.global_max - self.global_min + self.clip_min)
+        return self.transform(arr)
     
     def transform_test_train(self, train_dict, test_dict):
         for trace_folder, trace_values in train_dict.items():
-            log_vals = np.log10(np.clip(trace_values, self.clip_min, None))
-            train_dict[trace_folder] = (log_vals - self.global_min) / (self.global_max - self.global_min + self.clip_min)
+            train_dict[trace_folder] = self.transform(trace_values)
         for trace_folder, trace_values in test_dict.items():
-            log_vals = np.log10(np.clip(trace_values, self.clip_min, None))
-            train_dict[trace_folder] = (log_vals - self.global_min) / (self.global_max - self.global_min + self.clip_min)
+            test_dict[trace_folder] = self.transform(trace_values)
         return train_dict, test_dict
 
+    # Normalize arr into out, chunk by chunk across a thread pool; numpy releases the GIL inside ufuncs
+    # out may be arr itself(e.g. a np.memmap opened with mmap_mode="r+") to normalize a stored dataset in place
+    # dtype sets the output dtype when out is not given, e.g. np.float32 for the CNN
+    # Values are identical to (log10(clip(arr)) - global_min) / (global_max - global_min + clip_min) cast to the output dtype
+    # Not profiled: sample_packed_modes calls it once per block; the calling stage(ex. create_training_matrix) covers it
+    def transform(self, arr, out=None, dtype=None, workers=None, chunk_size=TRANSFORM_CHUNK):
+        arr = np.asarray(arr)
+        log_dtype = np.clip(arr.ravel()[:0], self.clip_min, None).dtype
+        calc_dtype = (np.log10(np.clip(arr.ravel()[:0], self.clip_min, None)) - self.global_min).dtype
+        if out is None:
+            out = np.empty(arr.shape, dtype=(dtype or calc_dtype))
+        if out.shape != arr.shape or not out.flags.c_contiguous:
+            raise ValueError("ERROR: out must be a C-contiguous array with the same shape as arr")
+        src = np.ascontiguousarray(arr).reshape(-1)
+        dst = out.reshape(-1)
+        scale = self.global_max - self.global_min + self.clip_min
+
+        def transform_chunk(start):
+            stop = min(start + chunk_size, len(src))
+            dst_chunk = dst[start:stop]
+            log_buf = dst_chunk if dst.dtype == log_dtype else np.empty(stop - start, dtype=log_dtype)
+            np.clip(src[start:stop], self.clip_min, None, out=log_buf)
+            np.log10(log_buf, out=log_buf)
+            calc_buf = dst_chunk if dst.dtype == calc_dtype else np.empty(stop - start, dtype=calc_dtype)
+            np.subtract(log_buf, self.global_min, out=calc_buf)
+            np.divide(calc_buf, scale, out=calc_buf)
+            if calc_buf is not dst_chunk:
+                dst_chunk[...] = calc_buf
+
+        starts = range(0, len(src), chunk_size)
+        if workers == 1 or len(starts) <= 1:
+            for start in starts:
+                transform_chunk(start)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(transform_chunk, starts))
+        return out
+
     def save(self, path):
         if self.global_max is None:
             raise KeyError("ERROR: global_max has not been set")
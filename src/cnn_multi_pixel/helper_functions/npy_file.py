@@ -0,0 +1,52 @@
+import io
+import numpy as np
+from numpy.lib import format as npy_format
+
+'''
+Function that replaces all rows of a .npy file from row 'start' onward, without touching rows before it
+Appending is splice_npy(path, n_rows, new_rows); only the header and the written rows cost I/O
+Input:
+    1) path: string; Full path to C-ordered .npy file
+    2) start: int; First row to replace; 0 <= start <= number of rows in file
+    3) array: np.ndarray; New rows; cast to dtype of file, must match row shape of file
+Returns:
+    1) shape: tuple; New shape of array stored in file
+'''
+def splice_npy(path, start, array):
+    with open(path, "r+b") as f:
+        version = npy_format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = npy_format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = npy_format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        start = int(start)
+        array = np.ascontiguousarray(array, dtype=dtype)
+        if fortran_order or len(shape) == 0 or array.shape[1:] != shape[1:]:
+            raise ValueError(f"ERROR - Cannot splice array of shape {array.shape} into {path} with shape {shape}")
+        if not 0 <= start <= shape[0]:
+            raise ValueError(f"ERROR - Splice start {start} is out of range for {path} with {shape[0]} rows")
+
+        new_shape = (start + int(array.shape[0]),) + tuple(shape[1:])
+        header = io.BytesIO()
+        header_dict = {"descr": npy_format.dtype_to_descr(dtype), "fortran_order": False, "shape": new_shape}
+        if version == (1, 0):
+            npy_format.write_array_header_1_0(header, header_dict)
+        else:
+            npy_format.write_array_header_2_0(header, header_dict)
+
+        # Header padding leaves room for the row count to grow; rewrite the whole file if it does not fit
+        if header.tell() != data_offset:
+            f.seek(data_offset)
+            prefix = np.fromfile(f, dtype=dtype, count=start * int(np.prod(shape[1:], dtype=np.int64))).reshape((start,) + shape[1:])
+            f.seek(0)
+            f.truncate()
+            np.save(f, np.concatenate([prefix, array]))
+            return new_shape
+
+        f.seek(0)
+        f.write(header.getvalue())
+        f.seek(data_offset + start * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+        array.tofile(f)
+        f.truncate()
+    return new_shape
@@ -0,0 +1,283 @@
+import cProfile
+import json
+import os
+import platform
+import resource
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Profiler receiving the records of profiled functions and iterators; None turns instrumentation off
+active_profiler = None
+
+# Bytes read and written by this process so far, from /proc/self/io; None where it does not exist(ex. macOS)
+# Counts every read/write syscall, page cache hits included; np.memmap page faults are not counted
+def io_bytes():
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+# Peak resident memory of this process so far, in MB; ru_maxrss is in KB on Linux, bytes on macOS
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if platform.system() == "Darwin" else peak / 1024
+
+# Peak resident memory since the last reset_hwm(VmHWM of /proc/self/status), in MB; None where it does not exist
+def hwm_mb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+# Resets VmHWM to the current resident memory(Linux); False where that is not possible
+def reset_hwm():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+class Profiler:
+    '''
+    Class used to record per-stage timing of the pipeline.
+    A stage records wall time, CPU time of this process, bytes read and written, item count and peak RSS.
+    Stages may nest(ex. create_and_save_sampled_datasets inside update_datasets); each is recorded on its own.
+    Work done in worker processes(ex. create_raw_traces with workers > 1) shows up as wall time only.
+    On Linux the peak RSS is the peak during the stage: VmHWM is reset when a stage starts, and the peak seen
+    until then is credited to the stages already open. Elsewhere it is the process peak so far(ru_maxrss).
+    Each reset is a write to /proc/self/clear_refs, so functions called once per block or batch should not be profiled.
+    Attributes:
+        1) self.records: list of dictionaries; One per finished stage, in finishing order
+        2) self.cprofile_path: string; File cProfile stats are dumped to by disable(); None to not run cProfile
+        3) self.stage_peaks: bool; True if peak_rss_mb is measured per stage, False if it is the process peak so far
+    Input for initialization:
+        1) cprofile_path: see above
+    '''
+    def __init__(self, cprofile_path=None):
+        self.records = []
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.cprofile_path = cprofile_path
+        self.cprofile = None
+        # open_peaks: token of every open stage -> highest VmHWM seen during it, in MB
+        self.open_peaks = {}
+        self.next_token = 0
+        self.stage_peaks = hwm_mb() is not None and reset_hwm()
+
+    # Makes this the active profiler; profiled functions and iterators report to it until disable()
+    def enable(self):
+        global active_profiler
+        active_profiler = self
+        if self.cprofile_path is not None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        return self
+
+    def disable(self):
+        global active_profiler
+        if active_profiler is self:
+            active_profiler = None
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            self.cprofile = None
+
+    # Starts the peak RSS of a stage; returns the token to pass to peak_end
+    def peak_start(self):
+        if not self.stage_peaks:
+            return None
+        with self.lock:
+            self.credit_peak()
+            reset_hwm()
+            token = self.next_token
+            self.next_token += 1
+            self.open_peaks[token] = hwm_mb() or 0.0
+            return token
+
+    # Peak RSS in MB of the stage started with token; the process peak so far without per-stage peaks
+    def peak_end(self, token):
+        if token is None:
+            return peak_rss_mb()
+        with self.lock:
+            self.credit_peak()
+            return self.open_peaks.pop(token)
+
+    # Raises every open stage to the peak since the last reset
+    def credit_peak(self):
+        current = hwm_mb() or 0.0
+        for token, peak in self.open_peaks.items():
+            self.open_peaks[token] = max(peak, current)
+
+    # Records the enclosed block; set record["items"] inside the block to count what it handled
+    @contextmanager
+    def stage(self, name):
+        depth = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+        io_start = io_bytes()
+        peak_token = self.peak_start()
+        record = {"stage": name, "depth": depth, "thread": threading.get_ident(), "items": None}
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall_end, cpu_end = time.perf_counter(), time.process_time()
+            io_end = io_bytes()
+            self.local.depth = depth
+            record.update({
+                "start_s": wall_start - self.origin,
+                "wall_s": wall_end - wall_start,
+                "cpu_s": cpu_end - cpu_start,
+                "bytes_read": io_end[0] - io_start[0] if io_start and io_end else None,
+                "bytes_written": io_end[1] - io_start[1] if io_start and io_end else None,
+                "peak_rss_mb": self.peak_end(peak_token),
+            })
+            with self.lock:
+                self.records.append(record)
+
+    # Yields the items of iterable; records the time spent fetching them(ex. dataloader batches), not the loop body
+    def iterate(self, iterable, name):
+        depth = getattr(self.local, "depth", 0)
+        record = {"stage": name, "depth": depth, "thread": threading.get_ident(), "items": 0}
+        peak_token = self.peak_start()
+        wall_start, fetch = time.perf_counter(), 0.0
+        cpu_fetch = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                fetch_start, cpu_start = time.perf_counter(), time.process_time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    fetch += time.perf_counter() - fetch_start
+                    cpu_fetch += time.process_time() - cpu_start
+                record["items"] += 1
+                yield item
+        finally:
+            # Span covers the whole loop; wall_s only the fetches
+            record.update({"start_s": wall_start - self.origin, "span_s": time.perf_counter() - wall_start,
+                           "wall_s": fetch, "cpu_s": cpu_fetch, "bytes_read": None, "bytes_written": None,
+                           "peak_rss_mb": self.peak_end(peak_token)})
+            with self.lock:
+                self.records.append(record)
+
+    '''
+    Function that totals the records per stage name
+    Returns:
+        1) totals: dictionary;
+            Key: string; Stage name, in order of first record
+            Value: dictionary; calls, wall_s, cpu_s, bytes_read, bytes_written, items, items_per_s, peak_rss_mb
+    '''
+    def totals(self):
+        totals = {}
+        for record in sorted(self.records, key=lambda record: record["start_s"]):
+            total = totals.setdefault(record["stage"], {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "bytes_read": None,
+                                                        "bytes_written": None, "items": None, "peak_rss_mb": 0.0})
+            total["calls"] += 1
+            total["wall_s"] += record["wall_s"]
+            total["cpu_s"] += record["cpu_s"]
+            for key in ("bytes_read", "bytes_written", "items"):
+                if record[key] is not None:
+                    total[key] = (total[key] or 0) + record[key]
+            total["peak_rss_mb"] = max(total["peak_rss_mb"], record["peak_rss_mb"])
+        for total in totals.values():
+            total["items_per_s"] = total["items"] / total["wall_s"] if total["items"] and total["wall_s"] > 0 else None
+        return totals
+
+    # Table of totals; columns are sized to their widest value and separated by " | "
+    def summary(self):
+        def number(value, scale=1, digits=1):
+            return "-" if value is None else f"{value / scale:,.{digits}f}"
+        header = ["stage", "calls", "wall s", "cpu s", "MB read", "MB written", "items", "items/s",
+                  "peak MB" if self.stage_peaks else "process peak MB so far"]
+        rows = [[name, str(total["calls"]), f"{total['wall_s']:.3f}", f"{total['cpu_s']:.3f}", number(total["bytes_read"], 1 << 20),
+                 number(total["bytes_written"], 1 << 20), number(total["items"], digits=0), number(total["items_per_s"]),
+                 number(total["peak_rss_mb"])] for name, total in self.totals().items()]
+        widths = [max(len(row[column]) for row in [header] + rows) for column in range(len(header))]
+        return "\n".join(" | ".join(cell.ljust(width) if column == 0 else cell.rjust(width)
+                                    for column, (cell, width) in enumerate(zip(row, widths))) for row in [header] + rows)
+
+    # Records and per-stage totals as JSON
+    def save_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"peak_rss": "stage" if self.stage_peaks else "process so far", "records": self.records, "totals": self.totals()}, f, indent=2)
+
+    # Records in the Chrome trace event format; open with chrome://tracing or https://ui.perfetto.dev
+    def save_chrome_trace(self, path):
+        events = []
+        for record in self.records:
+            args = {key: value for key, value in record.items() if key not in ("stage", "thread", "start_s", "depth") and value is not None}
+            events.append({"name": record["stage"], "ph": "X", "pid": os.getpid(), "tid": record["thread"],
+                           "ts": record["start_s"] * 1e6, "dur": record.get("span_s", record["wall_s"]) * 1e6, "args": args})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+'''
+Function that creates a decorator recording every call of a function as a stage of the active profiler
+Without an active profiler the function is called directly.
+Input:
+    1) name: string; Stage name
+    2) items: function; Maps the return value to the number of items handled, ex) files or values; None to not count
+Returns:
+    1) decorator
+'''
+def profiled(name, items=None):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = active_profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            with profiler.stage(name) as record:
+                result = func(*args, **kwargs)
+                if items is not None:
+                    record["items"] = items(result)
+            return result
+        return wrapper
+    return decorator
+
+# Iterable recorded by Profiler.iterate when a profiler is active; the iterable itself otherwise
+def profile_iter(iterable, name):
+    profiler = active_profiler
+    return iterable if profiler is None else profiler.iterate(iterable, name)
+
+'''
+Function that starts py-spy recording this process
+Input:
+    1) output_path: string; Flame graph(.svg) or speedscope(.json) file
+    2) rate: int; Samples per second
+Returns:
+    1) process: subprocess.Popen; pass to stop_py_spy; None if py-spy is not installed
+'''
+def start_py_spy(output_path, rate=100):
+    py_spy = shutil.which("py-spy")
+    if py_spy is None:
+        print("WARNING: py-spy is not installed; skipping py-spy recording")
+        return None
+    output_format = "speedscope" if output_path.endswith(".json") else "flamegraph"
+    return subprocess.Popen([py_spy, "record", "--pid", str(os.getpid()), "--rate", str(rate),
+                             "--format", output_format, "--output", output_path])
+
+# Stops a recording of start_py_spy; py-spy writes its output on SIGINT
+def stop_py_spy(process):
+    if process is None:
+        return
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
@@ -8,8 +8,8 @@
 ###############################################################################
 
 import numpy as np
+from itertools import islice
 import matplotlib.pyplot as plt
-from src.cnn_multi_pixel.dataset.dataset_sampled import TraceDatasetSampled
 
 DTYPE = np.float64
 
@@ -27,6 +27,7 @@ warn = False
 def select_func_gen(mode):
     def bmin(t1, v1, t2, v2, t): return v1
     def bmax(t1, v1, t2, v2, t): return v2
+    def bavg(t1, v1, t2, v2, t): return (v1 + v2) / 2
     def vmin(t1, v1, t2, v2, t): return min(v1, v2)
     def vmax(t1, v1, t2, v2, t): return max(v1, v2)
     def near(t1, v1, t2, v2, t): return v1 if t - t1 > t2 - t else v2
@@ -34,6 +35,7 @@ def select_func_gen(mode):
 
     if mode == "BMIN": return bmin
     elif mode == "BMAX": return bmax
+    elif mode == "BAVG": return bavg
     elif mode == "VMIN": return vmin
     elif mode == "VMAX": return vmax
     elif mode == "NEAREST": return near
@@ -46,108 +48,543 @@ def select_func_gen(mode):
 # - Used when gap between timesteps is too small
 # ------------------------------------------------
 
+# Sample modes accepted by sample_func_gen; also the mode part of sampled dataset names
+SAMPLE_MODES = ("AVG", "MIN", "MAX")
+
 def sample_func_gen(mode):
     if   mode == 'MIN': return lambda x: np.min(x)
     elif mode == 'MAX': return lambda x: np.max(x)
     elif mode == 'AVG': return lambda x: np.average(x)
     else: raise ValueError("Illegal mode selected")
 
-## Main Parsers --------------------------------------------
+## Vectorized Engine --------------------------------------
 
 # ------------------------------------------------
-# func: sample_file
-# - Currently used parser for *subsampled* traces
-# - See paper for rough description of windowed technique
+# func: window_edges
+# - Builds the window boundaries (wtim values)
+# - Uses a running sum so every boundary is the
+#   same float64 the loop parsers got via +=
 # ------------------------------------------------
 
-def sample_file(fpath, sample_interval, max_samples, sample_mode="AVG", column=0):
-    time_col = column << 1
-    valu_col = time_col + 1
+def window_edges(tstart, sample_interval, count):
+    steps = np.full(max(count, 1), sample_interval, dtype=DTYPE)
+    steps[0] = tstart + sample_interval
+    return np.cumsum(steps)
+
+# ------------------------------------------------
+# func: assign_windows
+# - Gives the window index of every sample
+# - Samples landing exactly on a boundary open the
+#   window ending at that boundary unless the
+#   previous sample already sits in it; the choice
+#   carries over runs of boundary-aligned samples
+# - Assumes non-decreasing times (ngspice output)
+# ------------------------------------------------
 
-    f = sample_func_gen(sample_mode)
-    l = select_func_gen(f'B{sample_mode}')
+def assign_windows(times, edges):
+    right = np.searchsorted(edges, times, side="right")
+    on_edge = edges[np.maximum(right - 1, 0)] == times
+    first = np.zeros(len(times), dtype=bool)
+    first[0] = True
+    return resolve_windows(right, on_edge, first)
 
-    tstart = 0
-    tstop  = 1
+# ------------------------------------------------
+# func: resolve_windows
+# - Shared by assign_windows and sample_packed
+# - right: boundaries <= each sample, on_edge:
+#   sample equals a boundary, first: first sample
+#   of each trace (always window 0)
+# ------------------------------------------------
 
-    with open(fpath, 'r') as file:
-        header = file.readline()
-
-        tim_arr = [] # For debugging
-        val_arr = []
-        val_win = []
-
-        stim, value = file.readline().strip().split()
-        stim = DTYPE(stim)
-        tstart = stim
-        value = DTYPE(value)
-        ptim = stim
-        wtim = stim + sample_interval
-        val_win.append(value)
-        val_arr.append(value)
-        tim_arr.append(ptim)
+def resolve_windows(right, on_edge, first):
+    right   = np.where(first, 0, right)
+    on_edge = on_edge & ~first
+    left    = right - on_edge
 
-        for line in file.readlines():
-            if len(val_arr) == max_samples: break
-            stim, value = line.strip().split()
-            stim  = DTYPE(stim)
-            value = DTYPE(value)
-
-            if stim >= wtim:
-                nval = f(val_win)
-                if nval > HIWARN and warn: print(f"High value: Standard, {val_win}")
-                val_arr.append(nval)
-                tim_arr.append(wtim - sample_interval/2)
-
-                # if time is too big a gap:
-                wtim += sample_interval
-                while stim > wtim:
-                    nval = l(ptim, val_arr[-1], stim, value, (len(val_arr)+0.5)*sample_interval)
-                    if nval > HIWARN and warn: print(f"High value: Large Timegap, l({ptim}, {val_arr[-1]}, {stim}, {value}, {(len(val_arr)+0.5)*sample_interval})")
-                    val_arr.append(nval)
-                    tim_arr.append(wtim - sample_interval/2)
-                    wtim += sample_interval
-
-                val_win = [value]
+    prev_right = np.empty_like(right)
+    prev_right[0] = 0
+    prev_right[1:] = right[:-1]
+    # take_left: sample opens window 'left' instead of 'right'
+    # inherit: decision depends on the previous sample's decision
+    take_left = on_edge & (prev_right < left)
+    inherit   = on_edge & (prev_right == left)
 
-            else:
-                val_win.append(value)
+    source = np.where(inherit, 0, np.arange(len(right)))
+    np.maximum.accumulate(source, out=source)
+    return right - take_left[source]
+
+# ------------------------------------------------
+# func: reduce_windows
+# - Applies MIN/MAX/AVG to every window at once
+# - AVG groups windows by length so each sum uses
+#   the same pairwise summation as np.average
+# ------------------------------------------------
+
+def reduce_windows(values, starts, sample_mode):
+    if sample_mode == "MIN":
+        return np.minimum.reduceat(values, starts)
+    if sample_mode == "MAX":
+        return np.maximum.reduceat(values, starts)
+    if sample_mode != "AVG":
+        raise ValueError("Illegal mode selected")
+
+    lengths = np.diff(np.append(starts, len(values)))
+    result  = np.empty(len(starts), dtype=DTYPE)
+    for length in np.unique(lengths):
+        sel = np.flatnonzero(lengths == length)
+        win = values[starts[sel, None] + np.arange(length)]
+        result[sel] = win.sum(axis=1) / length
+    return result
+
+# ------------------------------------------------
+# func: fill_gaps
+# - Array version of select_func_gen for every run
+#   of empty windows
+# - prev_val: value of the window closed before the
+#   gap, (t1, t2, v2): samples bounding the gap,
+#   first: index of the gap's first empty window
+# - Returns (window index, fill value) per empty window
+# ------------------------------------------------
+
+def fill_gaps(fill_mode, prev_val, t1, t2, v2, first, counts, sample_interval):
+    offset = np.cumsum(counts) - counts
+    gap_id = np.repeat(np.arange(len(counts)), counts)
+    step   = np.arange(len(gap_id)) - offset[gap_id]
+    slots  = first[gap_id] + step
+
+    if fill_mode == "BMIN":
+        return slots, prev_val[gap_id]
+    if fill_mode == "BMAX":
+        return slots, v2[gap_id]
+    if fill_mode == "VMIN":
+        return slots, np.where(v2 < prev_val, v2, prev_val)[gap_id]
+    if fill_mode == "VMAX":
+        return slots, np.where(v2 > prev_val, v2, prev_val)[gap_id]
+    if fill_mode == "NEAREST":
+        # Decision for the first empty window holds for the whole gap
+        t = (first + 1 + 0.5) * sample_interval
+        return slots, np.where(t - t1 > t2 - t, prev_val, v2)[gap_id]
+    if fill_mode not in ("BAVG", "LINEAR"):
+        raise ValueError("Illegal mode selected")
+
+    # Recursive fills depend on the previous fill; step through all gaps together
+    values = np.empty(len(gap_id), dtype=DTYPE)
+    last   = prev_val.copy()
+    for j in range(counts.max(initial=0)):
+        live = np.flatnonzero(counts > j)
+        if fill_mode == "BAVG":
+            last[live] = (last[live] + v2[live]) / 2
+        else:
+            t = (first[live] + j + 1 + 0.5) * sample_interval
+            last[live] = (t - t1[live])/(t2[live] - t1[live]) * (v2[live] - last[live]) + last[live]
+        values[offset[live] + j] = last[live]
+    return slots, values
+
+# ------------------------------------------------
+# func: sample_trace
+# - Vectorized windowed subsampler for one trace
+# - Matches the loop parsers value for value,
+#   including the max_samples cutoff and the
+#   linear tail extrapolation
+# - Returns (val_arr, tstart, tstop) like sample_file
+# ------------------------------------------------
+
+def sample_trace(times, values, sample_interval, max_samples, sample_mode="AVG", fill_mode=None):
+    times  = np.asarray(times, dtype=DTYPE)
+    values = np.asarray(values, dtype=DTYPE)
+    fill_mode = fill_mode or f"B{sample_mode}"
+    tstart = times[0]
+
+    # max_samples + 1 boundaries cover every trace that stops at the cutoff;
+    # only a gap jumping over the cutoff needs boundaries for the whole trace
+    edges   = window_edges(tstart, sample_interval, max_samples + 1)
+    n_used  = np.searchsorted(times, edges[-1], side="left")
+    windows = assign_windows(times[:n_used], edges)
+    cutoff  = np.flatnonzero(windows[:len(times) - 1] == max_samples - 1)
+    if len(cutoff) == 0 and n_used < len(times):
+        count = int((times[-1] - tstart) / sample_interval) + 2
+        edges = window_edges(tstart, sample_interval, count)
+        while edges[-1] <= times[-1]:
+            count *= 2
+            edges = window_edges(tstart, sample_interval, count)
+        windows = assign_windows(times, edges)
+        cutoff  = np.flatnonzero(windows[:-1] == max_samples - 1)
+        n_used  = len(times)
+
+    if len(cutoff) > 0:
+        n_used = cutoff[0] + 1
+    times, values, windows = times[:n_used], values[:n_used], windows[:n_used]
+    last_win = windows[-1]
+
+    # val_arr[0] is the first raw value, val_arr[1 + k] belongs to window k
+    starts  = np.flatnonzero(np.diff(windows, prepend=-1))
+    reduced = reduce_windows(values, starts, sample_mode)
+    val_arr = np.empty(last_win + 1, dtype=DTYPE)
+    val_arr[0] = values[0]
+    val_arr[1 + windows[starts[:-1]]] = reduced[:-1]
+
+    gap_counts = np.diff(windows[starts]) - 1
+    gaps = np.flatnonzero(gap_counts)
+    if len(gaps) > 0:
+        after = starts[gaps + 1]
+        slots, filled = fill_gaps(fill_mode, reduced[gaps], times[after - 1], times[after], values[after],
+                                  windows[starts[gaps]] + 1, gap_counts[gaps], sample_interval)
+        val_arr[1 + slots] = filled
+
+    tstop = edges[last_win]
+    if len(val_arr) < max_samples:
+        val_arr = np.append(val_arr, reduced[-1])
+
+    if len(val_arr) < max_samples:
+        # Window list exhausted; extrapolate from the last two points
+        x0 = tstart if last_win == 0 else edges[last_win - 1] - sample_interval/2
+        x1 = times[-1]
+        y0, y1 = val_arr[-2:]
+        m = (y1 - y0)/(x1 - x0)
+
+        n_tail = max_samples - len(val_arr)
+        tail = np.full(n_tail + 1, sample_interval, dtype=DTYPE)
+        tail[0] = tstop + sample_interval/2
+        tail = np.cumsum(tail)
+        steps = (tail[:-1] - np.append(x1, tail[:-2])) * m
+        val_arr = np.append(val_arr, np.cumsum(np.append(y1, steps))[1:])
+        tstop = tail[-1]
+
+    return val_arr, tstart, tstop
+
+# ------------------------------------------------
+# func: sample_packed
+# - Batched version of sample_trace for a whole
+#   folder packed by pack_raw_dict
+# - times/values: all traces concatenated,
+#   offsets: trace i is [offsets[i], offsets[i+1])
+# - Returns (n_files, max_samples) float32 matrix;
+#   rows match sample_trace cut to max_samples
+# ------------------------------------------------
+
+def sample_packed(times, values, offsets, sample_interval, max_samples, sample_mode="AVG", fill_mode=None, block_points=None):
+    return sample_packed_modes(times, values, offsets, sample_interval, max_samples,
+                               [sample_mode], [fill_mode], block_points)[0]
+
+# ------------------------------------------------
+# func: sample_packed_modes
+# - sample_packed for several sample modes at once
+# - Window assignment, cutoff and gaps are shared;
+#   only reductions and fills run once per mode
+# - Traces are handled in blocks of about
+#   block_points samples so each block stays in cache
+# - Returns (n_modes, n_files, max_samples) float32,
+#   written into out if given
+# - normalizer: fitted LogNormalizer applied to each
+#   block right after sampling, while still in cache
+# ------------------------------------------------
+
+BLOCK_POINTS = 1 << 17
+
+def sample_packed_modes(times, values, offsets, sample_interval, max_samples, sample_modes, fill_modes=None, block_points=None, out=None, normalizer=None):
+    times   = np.asarray(times, dtype=DTYPE)
+    values  = np.asarray(values, dtype=DTYPE)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    fill_modes = [fill or f"B{mode}" for mode, fill in zip(sample_modes, fill_modes or [None] * len(sample_modes))]
+    block_points = block_points or BLOCK_POINTS
+    n_files = len(offsets) - 1
+    result  = np.empty((len(sample_modes), n_files, max_samples), dtype=np.float32) if out is None else out
+    if result.shape != (len(sample_modes), n_files, max_samples) or result.dtype != np.float32:
+        raise ValueError(f"out must be a float32 array of shape {(len(sample_modes), n_files, max_samples)}")
+    if n_files == 0 or max_samples == 0:
+        return result
+
+    first = 0
+    while first < n_files:
+        last = max(np.searchsorted(offsets, offsets[first] + block_points, side="right") - 1, first + 1)
+        last = min(last, n_files)
+        block = slice(offsets[first], offsets[last])
+        sample_block(times[block], values[block], offsets[first:last + 1] - offsets[first],
+                     sample_interval, max_samples, sample_modes, fill_modes, result[:, first:last])
+        if normalizer is not None:
+            for rows in result[:, first:last]:
+                normalizer.transform(rows, out=rows, workers=1)
+        first = last
+    return result
+
+# ------------------------------------------------
+# func: sample_block
+# - Does the work of sample_packed_modes for one
+#   block of traces, writing rows into result
+# ------------------------------------------------
 
-            ptim = stim
+def sample_block(times, values, offsets, sample_interval, max_samples, sample_modes, fill_modes, result):
+    n_files = len(offsets) - 1
+
+    # Traces usually share tstart, so boundaries are built once per distinct tstart
+    file_id = np.repeat(np.arange(n_files), np.diff(offsets))
+    tstarts = times[offsets[:-1]]
+    edge_sets, edge_row = np.unique(tstarts, return_inverse=True)
+    edges = np.empty((len(edge_sets), max_samples + 1), dtype=DTYPE)
+    for row, tstart in enumerate(edge_sets):
+        edges[row] = window_edges(tstart, sample_interval, max_samples + 1)
+
+    # Samples past the last boundary can only reach columns beyond the matrix;
+    # keep the first of them per trace since it still closes the last window
+    inside = times < edges[edge_row, -1][file_id]
+    keep = inside.copy()
+    keep[1:] |= inside[:-1] & (file_id[1:] == file_id[:-1])
+    if not keep.all():
+        times, values, file_id = times[keep], values[keep], file_id[keep]
+        offsets = np.searchsorted(file_id, np.arange(n_files + 1))
+
+    # Samples past the last boundary land in window max_samples + 1
+    right   = np.empty(len(times), dtype=np.int64)
+    on_edge = np.empty(len(times), dtype=bool)
+    for row in range(len(edge_sets)):
+        sel = np.flatnonzero(edge_row[file_id] == row) if len(edge_sets) > 1 else slice(None)
+        right[sel]   = np.searchsorted(edges[row], times[sel], side="right")
+        on_edge[sel] = edges[row][np.maximum(right[sel] - 1, 0)] == times[sel]
+    first = np.zeros(len(times), dtype=bool)
+    first[offsets[:-1]] = True
+    windows = resolve_windows(right, on_edge, first)
+
+    # Stop each trace at the first sample found while max_samples is reached
+    last = np.zeros(len(times), dtype=bool)
+    last[offsets[1:] - 1] = True
+    hits = np.flatnonzero((windows == max_samples - 1) & ~last)
+    hit_files, hit_first = np.unique(file_id[hits], return_index=True)
+    ends = offsets[1:].copy()
+    ends[hit_files] = hits[hit_first] + 1
+    used = np.arange(len(times)) < ends[file_id]
+    times, values, windows, file_id = times[used], values[used], windows[used], file_id[used]
+
+    # One start per (trace, window); the last start of every trace is its open window
+    first   = first[used]
+    starts  = np.flatnonzero((np.diff(windows, prepend=-1) != 0) | first)
+    start_file = file_id[starts]
+    start_win  = windows[starts]
+    is_open = np.append(start_file[1:] != start_file[:-1], True)
+    closed  = ~is_open & (start_win + 1 < max_samples)
+
+    gap_counts = np.where(is_open, 0, np.diff(start_win, append=0) - 1)
+    gaps  = np.flatnonzero(gap_counts > 0)
+    after = starts[gaps + 1]
+
+    open_idx  = np.flatnonzero(is_open)
+    last_win  = start_win[open_idx]
+    short     = np.flatnonzero(last_win + 1 < max_samples)
+    tail_file = np.flatnonzero(last_win + 2 < max_samples)
+    if len(tail_file) > 0:
+        # Same running sums as sample_trace, one row per trace
+        tail_win  = last_win[tail_file]
+        tail_open = open_idx[tail_file]
+        tail_row  = edge_row[tail_file]
+        x0 = np.where(tail_win == 0, tstarts[tail_file],
+                      edges[tail_row, np.maximum(tail_win - 1, 0)] - sample_interval/2)
+        x1 = times[np.cumsum(ends - offsets[:-1])[tail_file] - 1]
+        n_tail = max_samples - tail_win - 2
+        steps  = np.full((len(tail_file), n_tail.max() + 1), sample_interval, dtype=DTYPE)
+        steps[:, 0] = edges[tail_row, tail_win] + sample_interval/2
+        tail_times = np.cumsum(steps, axis=1)
+        prev_times = np.concatenate([x1[:, None], tail_times[:, :-2]], axis=1)
+        tail_dt    = tail_times[:, :-1] - prev_times
+
+        cols = np.arange(tail_dt.shape[1])
+        tail_keep = cols[None, :] < n_tail[:, None]
+        tail_rows = np.broadcast_to(tail_file[:, None], tail_keep.shape)[tail_keep]
+        tail_cols = (tail_win[:, None] + 2 + cols[None, :])[tail_keep]
+
+    for mode_result, sample_mode, fill_mode in zip(result, sample_modes, fill_modes):
+        reduced = reduce_windows(values, starts, sample_mode)
+        mode_result[:, 0] = values[first]
+        mode_result[start_file[closed], start_win[closed] + 1] = reduced[closed]
+
+        # gap_last: float64 value of the last empty window of each gap, needed by the tail
+        gap_last = np.zeros(len(starts), dtype=DTYPE)
+        if len(gaps) > 0:
+            slots, filled = fill_gaps(fill_mode, reduced[gaps], times[after - 1], times[after], values[after],
+                                      start_win[gaps] + 1, gap_counts[gaps], sample_interval)
+            slot_file = np.repeat(start_file[gaps], gap_counts[gaps])
+            keep = slots + 1 < max_samples
+            mode_result[slot_file[keep], slots[keep] + 1] = filled[keep]
+            gap_last[gaps] = filled[np.cumsum(gap_counts[gaps]) - 1]
+
+        # Traces that ran out of samples: last (open) window, then linear tail
+        mode_result[short, last_win[short] + 1] = reduced[open_idx[short]]
+        if len(tail_file) > 0:
+            prev = tail_open - 1
+            y0 = np.where(gap_counts[prev] > 0, gap_last[prev], reduced[prev])
+            y0 = np.where(tail_win == 0, values[first][tail_file], y0)
+            y1 = reduced[tail_open]
+            m  = (y1 - y0)/(x1 - x0)
+            tail_vals = np.cumsum(np.concatenate([y1[:, None], tail_dt * m[:, None]], axis=1), axis=1)[:, 1:]
+            mode_result[tail_rows, tail_cols] = tail_vals[tail_keep]
+
+## Streaming Engine ----------------------------------------
 
-        if (len(val_arr) < max_samples) and val_win:
-            nval = f(val_win)
-            if nval > HIWARN and warn: print(f"High value: Normal Timegap, {val_win}")
-            val_arr.append(nval)
-            tim_arr.append(ptim)
+# ------------------------------------------------
+# class: StreamingSubsampler
+# - Stateful windowed subsampler fed chunk by chunk
+# - Same windows, gap fills and tail extrapolation
+#   as the loop parsers, so values match
+#   sample_trace cut to max_samples
+# - Only the open window's samples are kept;
+#   memory is O(window) however long the trace
+# - feed() returns the values of every window
+#   closed by the chunk; finish() returns the last
+#   window and the extrapolated tail
+# - Assumes non-decreasing times (ngspice output)
+# ------------------------------------------------
 
-        if len(val_arr) < max_samples:
-            # val_win is empty, latest wtim is handled
-            x0, x1 = tim_arr[-2:]
-            y0, y1 = val_arr[-2:]
+class StreamingSubsampler:
+    def __init__(self, sample_interval, max_samples, sample_mode="AVG", fill_mode=None):
+        self.sample_interval = sample_interval
+        self.max_samples = max_samples
+        self.reduce = sample_func_gen(sample_mode)
+        self.fill   = select_func_gen(fill_mode or f"B{sample_mode}")
+        self.tstart = None
+        self.tstop  = None
+        self.wtim   = None
+        self.ptim   = None
+        self.win    = []    # arrays of samples in the open window
+        self.count  = 0     # values emitted so far
+        self.last   = []    # last two (time, value) emitted, for the tail
+        self.pending = []
+
+    @property
+    def full(self):
+        return self.count >= self.max_samples
+
+    def emit(self, tim, val):
+        if self.full:
+            return
+        self.pending.append(val)
+        self.last = self.last[-1:] + [(tim, val)]
+        self.count += 1
+
+    def flush(self):
+        out = np.array(self.pending, dtype=DTYPE)
+        self.pending = []
+        return out
+
+    # One sample at or past the current boundary: closes the open window and fills any gap
+    def cross(self, stim, value):
+        self.emit(self.wtim - self.sample_interval/2, self.reduce(np.concatenate(self.win)))
+        self.wtim += self.sample_interval
+        while stim > self.wtim and not self.full:
+            nval = self.fill(self.ptim, self.last[-1][1], stim, value, (self.count + 0.5)*self.sample_interval)
+            self.emit(self.wtim - self.sample_interval/2, nval)
+            self.wtim += self.sample_interval
+        self.win = [np.array([value], dtype=DTYPE)]
+        self.ptim = stim
+
+    # Returns the values of the windows closed by this chunk as a float64 array
+    def feed(self, times, values):
+        times  = np.asarray(times, dtype=DTYPE).reshape(-1)
+        values = np.asarray(values, dtype=DTYPE).reshape(-1)
+        i = 0
+        if self.wtim is None and len(times) > 0:
+            self.tstart = self.ptim = times[0]
+            self.wtim = times[0] + self.sample_interval
+            self.win = [values[:1]]
+            self.emit(times[0], values[0])
+            i = 1
+        while i < len(times) and not self.full:
+            # Samples before the next boundary join the open window in one step
+            j = i + np.searchsorted(times[i:], self.wtim, side="left")
+            if j > i:
+                self.win.append(values[i:j])
+                self.ptim = times[j - 1]
+            if j == len(times):
+                break
+            self.cross(times[j], values[j])
+            i = j + 1
+        return self.flush()
+
+    # Closes the trace; returns the last window and the linear tail up to max_samples
+    def finish(self):
+        if self.wtim is None:
+            raise ValueError("ERROR: no samples were fed")
+        if not self.full:
+            self.emit(self.ptim, self.reduce(np.concatenate(self.win)))
+        self.win = []
+        tstop = self.wtim
+        if not self.full:
+            # Window list exhausted; extrapolate from the last two points
+            (x0, y0), (x1, y1) = self.last
             m = (y1 - y0)/(x1 - x0)
+            tstop = self.wtim + self.sample_interval/2
+            while not self.full:
+                y1 = (tstop - x1)*m + y1
+                self.emit(tstop, y1)
+                x1 = tstop
+                tstop += self.sample_interval
+        self.tstop = tstop
+        return self.flush()
+
+    # Generator over (times, values) chunks; yields each non-empty array of finished values
+    def stream(self, chunks):
+        for times, values in chunks:
+            out = self.feed(times, values)
+            if len(out) > 0:
+                yield out
+            if self.full:
+                break
+        out = self.finish()
+        if len(out) > 0:
+            yield out
+
+# ------------------------------------------------
+# func: read_trace_chunks
+# - Reads an ngspice output file chunk_lines lines
+#   at a time instead of all at once
+# - Skips the header line like sample_file
+# - Yields (times, values) float64 arrays
+# ------------------------------------------------
+
+STREAM_CHUNK_LINES = 1 << 16
+
+def read_trace_chunks(fpath, chunk_lines=STREAM_CHUNK_LINES, column=0):
+    time_col = column << 1
+    valu_col = time_col + 1
 
-            wtim = wtim + sample_interval/2
-            for i in range(max_samples - len(val_arr)):
-                val_arr.append(y1:=((wtim - x1)*m+y1))
-                if y1 > HIWARN and warn: print(f"High Value: Win empty, {wtim} {x1} {m} {y1}")
-                tim_arr.append(x1:=wtim)
-                wtim += sample_interval
+    with open(fpath, 'r') as file:
+        file.readline()
+        while True:
+            lines = list(islice(file, chunk_lines))
+            if not lines:
+                return
+            data = np.loadtxt(lines, dtype=DTYPE, ndmin=2)
+            yield data[:, time_col], data[:, valu_col]
 
-        if len(val_arr) < max_samples:
-            for i in range(40):
-                print(i, tim_arr[i], val_arr[i], sep="\t")
-            for i in range(40, 0, -1):
-                print(-i, tim_arr[-i], val_arr[-i], sep="\t")
-            exit()
+# ------------------------------------------------
+# func: sample_file_stream
+# - Bounded-memory version of sample_file
+# - Yields float64 arrays of finished window values
+#   while the file is still being read; together
+#   they are the first max_samples values of
+#   sample_file
+# ------------------------------------------------
 
-        tstop = wtim
+def sample_file_stream(fpath, sample_interval, max_samples, sample_mode="AVG", column=0, chunk_lines=STREAM_CHUNK_LINES):
+    subsampler = StreamingSubsampler(sample_interval, max_samples, sample_mode)
+    yield from subsampler.stream(read_trace_chunks(fpath, chunk_lines, column))
 
-        return val_arr, tstart, tstop
+## Main Parsers --------------------------------------------
+
+# ------------------------------------------------
+# func: sample_file
+# - Currently used parser for *subsampled* traces
+# - See paper for rough description of windowed technique
+# ------------------------------------------------
+
+def sample_file(fpath, sample_interval, max_samples, sample_mode="AVG", column=0):
+    time_col = column << 1
+    valu_col = time_col + 1
+
+    data = np.loadtxt(fpath, dtype=DTYPE, skiprows=1, ndmin=2)
+    return sample_trace(data[:, time_col], data[:, valu_col], sample_interval, max_samples, sample_mode)
 
 '''
     Author: Calvin(Hyunsoo) Yang
     Function used to sample a raw dataset
+    All traces of the folder are sampled together via sample_packed
     Inputs:
         1) raw_dataset: TraceDatasetRaw; Raw trace dataset to sample
         2) sample_interval: float; Standard interval between sampled trace values
@@ -158,100 +595,36 @@ def sample_file(fpath, sample_interval, max_samples, sample_mode="AVG", column=0
     '''
 
 def sample_raw_dataset(raw_dataset, sample_interval, sample_duration, sample_mode):
-    f = sample_func_gen(sample_mode)
-    l = select_func_gen(f'B{sample_mode}')
+    return sample_raw_dataset_modes(raw_dataset, sample_interval, sample_duration, [sample_mode])[0]
 
-    # Get rid of tstart, tstop?
+'''
+    Function used to sample a raw dataset with several sample modes in a single pass
+    Raw traces are packed and windowed once; each mode only adds its own reduction
+    Inputs:
+        1) raw_dataset: TraceDatasetRaw; Raw trace dataset to sample
+        2) sample_interval: float; Standard interval between sampled trace values
+        3) sample_duration: float; Total time to be sampled
+        4) sample_modes: list of strings; Sample modes, ex) ["AVG", "MIN", "MAX"]
+    Returns:
+        1) new_sampled_datasets: list of TraceDatasetSampled; One dataset per sample mode, same order
+    '''
+
+def sample_raw_dataset_modes(raw_dataset, sample_interval, sample_duration, sample_modes):
+    # Imported here to avoid a circular import with dataset_sampled
+    from src.cnn_multi_pixel.dataset.dataset_sampled import TraceDatasetSampled
 
-    tstart = 0
-    tstop  = 1
-    
     folder_name = raw_dataset.get_folder_name()
-    raw_dict    = raw_dataset.get_raw_dict()
     max_samples = int(sample_duration / sample_interval)
-    sample_info = (sample_interval, sample_duration, sample_mode)
-
-    for digital_value, time_val_tuple_list in raw_dict.items():
-        # Variables used to go through all values in given time_val tuple list
-        digital_len = len(time_val_tuple_list)
-        counter = 1
-        tim_arr = [] # For debugging
-        val_arr = []
-        val_win = []
-        
-        # Get first value
-        stim, value = time_val_tuple_list[0][0], time_val_tuple_list[0][1]
-        stim = DTYPE(stim)
-        tstart = stim
-        value = DTYPE(value)
-        ptim = stim
-        wtim = stim + sample_interval
-        val_win.append(value)
-        val_arr.append(value)
-        tim_arr.append(ptim)
-
-        # Go through all values in given time_val tuple list
-        while counter != digital_len:
-            if len(val_arr) == max_samples: break
-            stim, value = time_val_tuple_list[counter][0], time_val_tuple_list[counter][1]
-            stim  = DTYPE(stim)
-            value = DTYPE(value)
-
-            if stim >= wtim:
-                nval = f(val_win)
-                if nval > HIWARN and warn: print(f"High value: Standard, {val_win}")
-                val_arr.append(nval)
-                tim_arr.append(wtim - sample_interval/2)
-
-                # if time is too big a gap:
-                wtim += sample_interval
-                while stim > wtim:
-                    nval = l(ptim, val_arr[-1], stim, value, (len(val_arr)+0.5)*sample_interval)
-                    if nval > HIWARN and warn: print(f"High value: Large Timegap, l({ptim}, {val_arr[-1]}, {stim}, {value}, {(len(val_arr)+0.5)*sample_interval})")
-                    val_arr.append(nval)
-                    tim_arr.append(wtim - sample_interval/2)
-                    wtim += sample_interval
-
-                val_win = [value]
 
-            else:
-                val_win.append(value)
-
-            ptim = stim
-            counter += 1
-
-        if (len(val_arr) < max_samples) and val_win:
-            nval = f(val_win)
-            if nval > HIWARN and warn: print(f"High value: Normal Timegap, {val_win}")
-            val_arr.append(nval)
-            tim_arr.append(ptim)
-
-        if len(val_arr) < max_samples:
-            # val_win is empty, latest wtim is handled
-            x0, x1 = tim_arr[-2:]
-            y0, y1 = val_arr[-2:]
-            m = (y1 - y0)/(x1 - x0)
+    times, values, offsets, digital_values = raw_dataset.get_packed_traces()
+    sample_matrices = sample_packed_modes(times, values, offsets, sample_interval, max_samples, sample_modes)
 
-            wtim = wtim + sample_interval/2
-            for i in range(max_samples - len(val_arr)):
-                val_arr.append(y1:=((wtim - x1)*m+y1))
-                if y1 > HIWARN and warn: print(f"High Value: Win empty, {wtim} {x1} {m} {y1}")
-                tim_arr.append(x1:=wtim)
-                wtim += sample_interval
-
-        if len(val_arr) < max_samples:
-            for i in range(40):
-                print(i, tim_arr[i], val_arr[i], sep="\t")
-            for i in range(40, 0, -1):
-                print(-i, tim_arr[-i], val_arr[-i], sep="\t")
-            exit()
-
-        tstop = wtim
-        
-        # Create new sampled dataset
-        new_sampled_dataset = TraceDatasetSampled(folder_name, val_arr, sample_info)
-
-        return new_sampled_dataset
+    # Create new sampled datasets
+    new_sampled_datasets = []
+    for sample_mode, sample_matrix in zip(sample_modes, sample_matrices):
+        sample_info = (sample_interval, sample_duration, sample_mode)
+        new_sampled_datasets.append(TraceDatasetSampled(folder_name, sample_matrix, sample_info, digital_values))
+    return new_sampled_datasets
 
 # ------------------------------------------------
 # func: do_parse
@@ -2,6 +2,8 @@ import numpy as np
 import re
 import os
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from src.cnn_multi_pixel.helper_functions.profiler import profiled
 
 from torch import norm
 
@@ -43,6 +45,117 @@ def convert_file(file_path):
             trace_array.append(time_val_tuple)
     return trace_array
 
+''' 
+Bulk version of convert_file; reads the whole file at once and tokenizes it with numpy
+Same rules as convert_file: optional "time -i(vdd)" header, lines with fewer than 2 columns
+and non-scientific values are skipped
+Input:
+    1) file_path: string; full path to file
+Returns:
+    1) time_arr: np.ndarray; np.float64; time values
+    2) value_arr: np.ndarray; np.float64; trace values
+'''
+def convert_file_bulk(file_path):
+    first_line_pattern = re.compile(r'^\s*time\s+-i\(vdd\)\s*$')
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    first_end = data.find(b'\n')
+    first_line = data if first_end == -1 else data[:first_end + 1]
+    if first_line_pattern.match(first_line.decode(errors='replace')):
+        data = data[len(first_line):]
+
+    try:
+        numbers = np.fromstring(data, dtype=np.float64, sep=' ')
+    except ValueError:
+        numbers = None
+
+    # Token boundaries (whitespace = bytes <= 32) and line number of every token
+    buf = np.frombuffer(data, dtype=np.uint8)
+    edge = np.diff((buf <= 32).view(np.int8), prepend=1, append=1)
+    starts = np.flatnonzero(edge == -1)
+    ends   = np.flatnonzero(edge == 1)
+    line_of = np.searchsorted(np.flatnonzero(buf == ord('\n')), starts)
+
+    # Fast path for regular ngspice output: every token parsed, one 'e' per token, and exactly two tokens
+    # on every non-empty line(token pairs share a line, consecutive pairs do not)
+    if (numbers is not None and len(numbers) == len(starts) and len(starts) % 2 == 0
+            and data.count(b'e') == len(numbers) and (line_of[0::2] == line_of[1::2]).all()
+            and (line_of[2::2] > line_of[1:-1:2]).all()):
+        return numbers[0::2].copy(), numbers[1::2].copy()
+
+    # First two tokens of every line that has at least two
+    line_start = np.flatnonzero(np.diff(line_of, prepend=-1))
+    line_count = np.diff(np.append(line_start, len(starts)))
+    time_idx  = line_start[line_count >= 2]
+    value_idx = time_idx + 1
+
+    # Check if obtained values are in valid scientific form
+    has_e = np.zeros(len(starts), dtype=bool)
+    has_e[np.searchsorted(starts, np.flatnonzero(buf == ord('e')), side='right') - 1] = True
+    scientific = has_e[value_idx]
+    if not scientific.all():
+        for value_str in token_strings(token_matrix(buf, starts[value_idx[~scientific]], ends[value_idx[~scientific]])):
+            print(f"Skipping non-scientific value '{value_str.decode()}' in {file_path}")
+        time_idx, value_idx = time_idx[scientific], value_idx[scientific]
+
+    # Cast both columns to np.float64 for best possible accuracy
+    if numbers is not None and len(numbers) == len(starts):
+        return numbers[time_idx], numbers[value_idx]
+    try:
+        time_arr  = token_strings(token_matrix(buf, starts[time_idx], ends[time_idx])).astype(np.float64)
+        value_arr = token_strings(token_matrix(buf, starts[value_idx], ends[value_idx])).astype(np.float64)
+    except ValueError as e:
+        raise ValueError(f"Invalid format in {file_path}: Cannot store as np.float64. ({e})")
+    return time_arr, value_arr
+
+# Gathers tokens [starts, ends) of buf into a zero-padded (n_tokens, width) uint8 matrix
+def token_matrix(buf, starts, ends):
+    width = int((ends - starts).max(initial=1))
+    cols = np.arange(width)
+    tok = buf[np.minimum(starts[:, None] + cols, len(buf) - 1)] if len(buf) else np.zeros((0, width), np.uint8)
+    tok[cols >= (ends - starts)[:, None]] = 0
+    return tok
+
+# Views a token matrix as fixed-width byte strings
+def token_strings(tok):
+    return np.ascontiguousarray(tok).view(f'S{tok.shape[1]}').ravel()
+
+'''
+Function that returns a trace as (time_arr, value_arr) np.float64 arrays
+Accepts both the list of (time, value) tuples from convert_file and the array pair from convert_file_bulk
+'''
+def trace_to_arrays(trace):
+    if isinstance(trace, tuple) and len(trace) == 2 and isinstance(trace[0], np.ndarray):
+        return trace
+    trace_arr = np.asarray(trace, dtype=np.float64).reshape(-1, 2)
+    return np.ascontiguousarray(trace_arr[:, 0]), np.ascontiguousarray(trace_arr[:, 1])
+
+''' 
+Function that finds all trace files of a single trace folder and their labels(digital values)
+Files are sorted by digital value and file name so the resulting folder_dict is deterministic
+Input:
+    1) trace_root: string; Full path to trace folder directory
+    2) folder_name: string; Name of target folder
+    3) file_name_pattern: string; RegEx expression for correct file naming convention
+    4) file_label_function: string; Function used to get label(digital value) from file name
+Returns:
+    1) folder_files: list of tuples; (digital value, full path to file)
+'''
+def list_folder_files(trace_root, folder_name, file_name_pattern, file_label_function):
+    folder_files = []
+    folder_path = os.path.join(trace_root, folder_name)
+    if os.path.exists(folder_path):
+        print(f"\tHandling folder \"{folder_name}\"...")
+        label_function = eval((file_label_function or "lambda gs: int(gs[0])"), globals(), {})
+        for file in sorted(os.listdir(folder_path)):
+            match = re.search(file_name_pattern, file)
+            if match:
+                folder_files.append((label_function(match.groups()), os.path.join(folder_path, file)))
+    else:
+        raise FileNotFoundError(f"ERROR - The following trace folder is missing: {folder_name} ")
+    folder_files.sort(key=lambda file: file[0])
+    return folder_files
+
 ''' 
 Function that extracts all trace files from a single trace folder and stores them into a dictionary
 Does NOT normalize the values; stores RAW traces
@@ -51,33 +164,30 @@ Input:
     2) folder_name: string; Name of target folder
     3) file_name_pattern: string; RegEx expression for correct file naming convention
     4) file_label_function: string; Function used to get label(digital value) from file name
+    5) bulk: bool; If True, files are parsed by convert_file_bulk into (time_arr, value_arr) arrays
 Returns:
     1) folder_name: string; Name of converted folder
-    2) folder_dict: dictionary; Each entry represents a single file within the folder
+    2) folder_dict: dictionary; Each entry represents a single file within the folder, ordered by digital value
     Key: int; Digital value of file
     Value: list of tuples; list of time_val_tuple tuples of converted files
     time_val_tuple[0]: np.float64; time value
     time_val_tuple[1]: np.float64; trace value
+    If bulk, Value: tuple of np.ndarray; (time_arr, value_arr)
 '''
-def convert_folder(trace_root, folder_name, file_name_pattern, file_label_function):
+def convert_folder(trace_root, folder_name, file_name_pattern, file_label_function, bulk=False):
+    convert = convert_file_bulk if bulk else convert_file
     folder_dict = {}
-    folder_path = os.path.join(trace_root, folder_name)
-    if os.path.exists(folder_path):
-        print(f"\tHandling folder \"{folder_name}\"...")
-        for file in os.listdir(folder_path):
-            match = re.search(file_name_pattern, file)
-            if match:
-                label_function = eval((file_label_function or "lambda gs: int(gs[0])"), globals(), {})
-                digital_val = label_function(match.groups())
-                folder_dict[digital_val] = convert_file(os.path.join(folder_path, file))
-    else:
-        raise FileNotFoundError(f"ERROR - The following trace folder is missing: {folder_name} ")
+    for digital_val, file_path in list_folder_files(trace_root, folder_name, file_name_pattern, file_label_function):
+        folder_dict[digital_val] = convert(file_path)
     return folder_dict
 
 
-def create_raw_traces(trace_root, target_dict):
+@profiled("create_raw_traces", items=lambda trace_dict: sum(len(folder_dict) for folder_dict in trace_dict.values()))
+def create_raw_traces(trace_root, target_dict, bulk=False, workers=1):
     ''' 
     Function that gets traces from all training/testing folders
+    With workers > 1, files of all folders are parsed by convert_file_bulk in a process pool;
+    workers only receive file paths and send back (time_arr, value_arr) arrays
     Input:
         1) trace_root: string; Full path to trace folder directory
         2) target_dict: dictionary;
@@ -86,16 +196,34 @@ def create_raw_traces(trace_root, target_dict):
         Contains information of given folder
             folder_dict["file_name_pattern"]: string; RegEx pattern for correct file name with group(s)
             folder_dict["file_label_function"]: string; RegEx pattern for correct label function to get digital value from file name
+        3) bulk: bool; If True, files are parsed by convert_file_bulk into (time_arr, value_arr) arrays
+        4) workers: int; Number of worker processes; None uses all cores, 1 parses in this process
     Returns:
         1) trace_dict: dictionary;
         Key: string; Training folder name
-        Value: dictionary; Each entry represents a file within the target folder
+        Value: dictionary; Each entry represents a file within the target folder, ordered by digital value
             Key: int; Digital value of file
             Value: list of tuples; list of time_val_tuple tuples of converted files
                 time_val_tuple[0]: np.float64; time value
                 time_val_tuple[1]: np.float64; trace value
+            If bulk or workers > 1, Value: tuple of np.ndarray; (time_arr, value_arr)
     '''
+    workers = workers or os.cpu_count()
     trace_dict = {}
+    if workers <= 1:
+        for folder_name, folder_dict in target_dict.items():
+            trace_dict[folder_name] = convert_folder(trace_root, folder_name, folder_dict["file_name_pattern"], folder_dict["file_label_function"], bulk)
+        return trace_dict
+
+    # Labels are resolved here; the pool only parses files
+    jobs = []
     for folder_name, folder_dict in target_dict.items():
-        trace_dict[folder_name] = convert_folder(trace_root, folder_name, folder_dict["file_name_pattern"], folder_dict["file_label_function"])
+        trace_dict[folder_name] = {}
+        for digital_val, file_path in list_folder_files(trace_root, folder_name, folder_dict["file_name_pattern"], folder_dict["file_label_function"]):
+            jobs.append((folder_name, digital_val, file_path))
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        traces = executor.map(convert_file_bulk, [file_path for _, _, file_path in jobs], chunksize=chunksize)
+        for (folder_name, digital_val, _), trace in zip(jobs, traces):
+            trace_dict[folder_name][digital_val] = trace
     return trace_dict
\ No newline at end of file
@@ -0,0 +1,43 @@
+import numpy as np
+from src.cnn_multi_pixel.helper_functions.subsampler import sample_packed_modes
+from src.cnn_multi_pixel.helper_functions.profiler import profiled
+
+@profiled("create_training_matrix", items=lambda result: len(result[0]))
+def create_training_matrix(raw_datasets, sample_interval, sample_duration, sample_mode, normalizer):
+    '''
+    Function that subsamples and log-normalizes raw datasets in one pass, straight into a float32 training matrix
+    Each block of raw traces is sampled and then normalized while still in cache; no separate sampled or
+    normalized copy of the dataset is made. Rows are identical to sampling with sample_raw_dataset and then
+    normalizing the sample matrix with normalizer.transform, cast to np.float32.
+    torch.from_numpy(train_matrix) shares memory with the result.
+    Input:
+        1) raw_datasets: list of TraceDatasetRaw; Raw datasets to stack, in order
+        2) sample_interval: float; Standard interval between sampled trace values
+        3) sample_duration: float; Total time to be sampled
+        4) sample_mode: string; SINGLE sample mode
+        5) normalizer: LogNormalizer; Already fitted, ex) by fit_iter over stored sampled datasets
+    Returns:
+        1) train_matrix: np.ndarray; np.float32; (n_traces, n_samples) normalized sampled traces of all datasets
+        2) digital_values: np.ndarray; np.int64; Digital value of each row
+        3) folder_rows: dictionary;
+            Key: string; Folder name
+            Value: slice; Rows of train_matrix holding the traces of the folder
+    '''
+    if normalizer.global_min is None or normalizer.global_max is None:
+        raise KeyError("ERROR: normalizer has not been fitted")
+    max_samples = int(sample_duration / sample_interval)
+    packed_list = [raw_dataset.get_packed_traces() for raw_dataset in raw_datasets]
+    n_traces = sum(len(packed[3]) for packed in packed_list)
+    train_matrix = np.empty((n_traces, max_samples), dtype=np.float32)
+    digital_values = np.empty(n_traces, dtype=np.int64)
+
+    folder_rows = {}
+    first = 0
+    for raw_dataset, (times, values, offsets, folder_values) in zip(raw_datasets, packed_list):
+        rows = slice(first, first + len(folder_values))
+        sample_packed_modes(times, values, offsets, sample_interval, max_samples, [sample_mode],
+                            out=train_matrix[rows][None], normalizer=normalizer)
+        digital_values[rows] = folder_values
+        folder_rows[raw_dataset.get_folder_name()] = rows
+        first = rows.stop
+    return train_matrix, digital_values, folder_rows
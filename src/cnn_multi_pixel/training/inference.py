@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+from src.cnn_multi_pixel.helper_functions.profiler import profile_iter
+from src.cnn_multi_pixel.training.models import MultiHeadCNN, create_backbone, create_bit_model, use_batch_stats_if_untracked
+
+'''
+Function that assembles digital values from predicted bits
+Inverse of compute_bit_labels; column adc * adc_bits + bit holds bit 'bit' of ADC 'adc'
+Input:
+    1) bits: np.ndarray; (N, adc_num * adc_bits) predicted bits
+    2) adc_num, adc_bits: number of ADCs and bits per ADC
+Returns:
+    1) adc_values: np.ndarray; np.int64; (N, adc_num) digital value of each ADC; column 0 = ADC storing LSB
+    2) digital_values: np.ndarray; np.int64; (N,) combined digital value of all ADCs
+'''
+def bits_to_digital(bits, adc_num, adc_bits):
+    bits = np.asarray(bits, dtype=np.int64).reshape(len(bits), adc_num, adc_bits)
+    adc_values = (bits << np.arange(adc_bits, dtype=np.int64)).sum(-1)
+    digital_values = (adc_values << (np.arange(adc_num, dtype=np.int64) * adc_bits)).sum(-1)
+    return adc_values, digital_values
+
+# Forward pre-hook that hands 4D inputs to the first Conv2d in channels-last memory format
+def to_channels_last(module, args):
+    x = args[0]
+    if x.dim() == 4:
+        x = x.contiguous(memory_format=torch.channels_last)
+    return (x,) + tuple(args[1:])
+
+class InferenceEngine:
+    '''
+    Class used to predict every ADC bit of a batch of traces with already loaded models.
+    Each batch goes through every model once; a test dataloader is read once for all bits,
+    instead of once per bit model.
+    Models are either the 40 single-bit models of the notebook workflow, or multi-head models; the
+    outputs of all models, in order, are the adc_num * adc_bits bit columns of compute_bit_labels.
+    Attributes:
+        1) self.models: list of models; Each returns (B, 2) or (B, n_heads, 2) logits for (B, L) traces
+        2) self.adc_num, self.adc_bits: number of ADCs and bits per ADC
+    Input for initialization:
+        1) models: list of models; see above
+        2) adc_num, adc_bits: number of ADCs and bits per ADC
+        3) channels_last: if True, Conv2d models(resnet18) run in channels-last memory format
+        4) quantize: if True, Linear layers are dynamically quantized to int8
+    '''
+    def __init__(self, models, adc_num=5, adc_bits=8, channels_last=False, quantize=False):
+        self.adc_num  = adc_num
+        self.adc_bits = adc_bits
+        self.models   = []
+        for model in models:
+            model.eval()
+            if channels_last:
+                conv = next((module for module in model.modules() if isinstance(module, nn.Conv2d)), None)
+                if conv is not None:
+                    model.to(memory_format=torch.channels_last)
+                    conv.register_forward_pre_hook(to_channels_last)
+            if quantize:
+                model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+            self.models.append(model)
+
+    # Load every per-bit checkpoint {model_name}_checkpoint_adc_{adc}_bit_{bit}.pth of checkpoint_dir once
+    # Notebook checkpoints trained without running stats predict with batch statistics; see use_batch_stats_if_untracked
+    @classmethod
+    def from_bit_checkpoints(cls, checkpoint_dir, model_name="resnet18", adc_num=5, adc_bits=8,
+                             channels_last=False, quantize=False, **model_kwargs):
+        # Weights come from the checkpoints; no pretrained weights are needed
+        if model_name == "resnet18":
+            model_kwargs.setdefault("weights", None)
+        models = []
+        for adc in range(adc_num):
+            for bit in range(adc_bits):
+                checkpoint_path = os.path.join(checkpoint_dir, f"{model_name}_checkpoint_adc_{adc}_bit_{bit}.pth")
+                model = create_bit_model(model_name, **model_kwargs)
+                model.load_state_dict(torch.load(checkpoint_path, map_location="cpu")['cnn_state_dict'])
+                use_batch_stats_if_untracked(model)
+                models.append(model)
+        return cls(models, adc_num, adc_bits, channels_last, quantize)
+
+    # Load multi-head checkpoints of train_multi_head; one path for head_mode "all", adc_num paths for "adc"
+    @classmethod
+    def from_multi_head_checkpoints(cls, checkpoint_paths, backbone="resnet18", adc_num=5, adc_bits=8,
+                                    channels_last=False, quantize=False, **backbone_kwargs):
+        if backbone == "resnet18":
+            backbone_kwargs.setdefault("weights", None)
+        n_heads = adc_num * adc_bits // len(checkpoint_paths)
+        models = []
+        for checkpoint_path in checkpoint_paths:
+            model = MultiHeadCNN(*create_backbone(backbone, **backbone_kwargs), n_heads)
+            model.load_state_dict(torch.load(checkpoint_path, map_location="cpu")['cnn_state_dict'])
+            use_batch_stats_if_untracked(model)
+            models.append(model)
+        return cls(models, adc_num, adc_bits, channels_last, quantize)
+
+    # True if every trace gets the same prediction whatever else is in its batch; BatchNorm layers without
+    # running buffers(nn.BatchNorm1d(track_running_stats=False)) normalize with batch statistics even in eval()
+    @property
+    def batch_independent(self):
+        return all(not module.training and not (isinstance(module, nn.modules.batchnorm._BatchNorm) and module.running_mean is None)
+                   for model in self.models for module in model.modules())
+
+    # True if a BatchNorm layer normalizes with running buffers that training never updated(num_batches_tracked == 0),
+    # ex) a model built but never trained; its eval() output reflects no learned statistics
+    @property
+    def untrained_batch_norm(self):
+        return any(isinstance(module, nn.modules.batchnorm._BatchNorm) and module.num_batches_tracked is not None
+                   and module.num_batches_tracked.item() == 0
+                   for model in self.models for module in model.modules())
+
+    # (B, L) traces -> (B, adc_num * adc_bits) predicted bits as torch.uint8
+    def predict_bits(self, traces):
+        traces = torch.as_tensor(traces, dtype=torch.float32)
+        with torch.inference_mode():
+            outputs = [model(traces).view(len(traces), -1, 2) for model in self.models]
+            return torch.cat(outputs, dim=1).argmax(-1).to(torch.uint8)
+
+    # (B, L) traces -> (B, adc_num) per ADC values and (B,) combined values; see bits_to_digital
+    def predict(self, traces):
+        return bits_to_digital(self.predict_bits(traces).numpy(), self.adc_num, self.adc_bits)
+
+    def run(self, dataloader):
+        '''
+        Function that predicts every trace of a dataloader in a single pass
+        Input:
+            1) dataloader: yields (traces, labels), ex) TraceDatasetBuilder.dataloader or bit_dataloader
+        Returns:
+            1) bits: np.ndarray; np.uint8; (N, adc_num * adc_bits) predicted bits
+            2) adc_values: np.ndarray; np.int64; (N, adc_num) predicted value of each ADC
+            3) digital_values: np.ndarray; np.int64; (N,) predicted combined value
+            4) labels: np.ndarray; Labels of the dataloader, concatenated in the same order
+        '''
+        bits = []
+        labels = []
+        for batch_traces, batch_labels in profile_iter(dataloader, "inference dataloader"):
+            bits.append(self.predict_bits(batch_traces).numpy())
+            labels.append(np.asarray(batch_labels))
+        bits = np.concatenate(bits) if bits else np.empty((0, self.adc_num * self.adc_bits), dtype=np.uint8)
+        labels = np.concatenate(labels) if labels else np.empty(0)
+        adc_values, digital_values = bits_to_digital(bits, self.adc_num, self.adc_bits)
+        return bits, adc_values, digital_values, labels
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import re
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from src.cnn_multi_pixel.helper_functions.normalizer import LogNormalizer
+from src.cnn_multi_pixel.helper_functions.subsampler import StreamingSubsampler
+from src.cnn_multi_pixel.training.inference import InferenceEngine
+
+# Header line of ngspice output; skipped like convert_file does
+FIRST_LINE_PATTERN = re.compile(r'^\s*time\s+-i\(vdd\)\s*$')
+
+class TraceStream:
+    '''
+    Class used to window one raw trace sent point by point.
+    Points are handed to a StreamingSubsampler every chunk_points points, so only the open window
+    and the sampled row are kept, however long the trace is.
+    Attributes:
+        1) self.subsampler: StreamingSubsampler; same windowing as sample_raw_dataset
+        2) self.row: np.ndarray; np.float32; (max_samples,) sampled values so far
+        3) self.filled: int; Number of values of self.row already written
+    Input for initialization:
+        1) sample_interval: float; Standard interval between sampled trace values
+        2) max_samples: int; Number of sampled values
+        3) sample_mode: string; Sample mode
+        4) chunk_points: int; Points buffered before they are windowed
+    '''
+    def __init__(self, sample_interval, max_samples, sample_mode="AVG", chunk_points=4096):
+        self.subsampler = StreamingSubsampler(sample_interval, max_samples, sample_mode)
+        self.row = np.empty(max_samples, dtype=np.float32)
+        self.filled = 0
+        self.n_points = 0
+        self.chunk_points = chunk_points
+        self.times = []
+        self.values = []
+
+    def __len__(self):
+        return self.n_points
+
+    def add(self, time_val, value):
+        self.n_points += 1
+        if self.subsampler.full:
+            return
+        self.times.append(time_val)
+        self.values.append(value)
+        if len(self.times) >= self.chunk_points:
+            self.write(self.subsampler.feed(self.times, self.values))
+
+    def write(self, values):
+        self.times = []
+        self.values = []
+        self.row[self.filled:self.filled + len(values)] = values
+        self.filled += len(values)
+
+    # Windowed (max_samples,) float32 row of the whole trace; same values as sample_packed
+    def sample(self):
+        if self.times:
+            self.write(self.subsampler.feed(self.times, self.values))
+        self.write(self.subsampler.finish())
+        return self.row
+
+class MicroBatcher:
+    '''
+    Class used to group traces of concurrent requests into batches for the inference engine.
+    A batch is run as soon as batch_size traces are waiting, or max_wait seconds after its first trace arrived;
+    batch_size bounds latency under load, max_wait bounds latency of a lone request.
+    Batches run in a single worker thread, so the event loop keeps reading other requests meanwhile.
+    Attributes:
+        1) self.engine: InferenceEngine
+        2) self.batch_size: int; Largest batch
+        3) self.max_wait: float; Seconds a trace waits for more traces to join its batch
+        4) self.stats: dictionary; batches, traces and busy seconds so far
+    Input for initialization:
+        1) engine, batch_size, max_wait: see above
+    '''
+    def __init__(self, engine, batch_size=64, max_wait=0.005):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {"batches": 0, "traces": 0, "busy_seconds": 0.0}
+
+    # (max_samples,) normalized trace -> (adc_values, digital_value) once its batch has run
+    async def submit(self, trace):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((trace, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            traces = np.stack([trace for trace, _ in batch])
+            start = time.perf_counter()
+            try:
+                adc_values, digital_values = await loop.run_in_executor(self.executor, self.engine.predict, traces)
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.stats["busy_seconds"] += time.perf_counter() - start
+            self.stats["batches"] += 1
+            self.stats["traces"] += len(batch)
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result((adc_values[i], digital_values[i]))
+
+class InferenceServer:
+    '''
+    Class of a long-running local server that decodes ADC outputs from raw ngspice traces.
+    Protocol, one trace per request, any number of requests per connection:
+        - Client sends "time value" lines as ngspice writes them; the "time -i(vdd)" header is skipped
+        - An empty line ends the trace
+        - Server answers one JSON line: {"adc_values": [...], "digital_value": int}, or {"error": "..."}
+    Traces are windowed as they arrive with the same windowing as sample_raw_dataset, normalized with
+    LogNormalizer.transform_list, and micro-batched with the traces of other connections.
+    Micro-batching mixes traces of unrelated clients, so the engine must be batch independent(see
+    InferenceEngine.batch_independent); otherwise one client's answer would depend on the other clients.
+    BatchNorm running statistics must also come from training(see InferenceEngine.untrained_batch_norm).
+    Attributes:
+        1) self.batcher: MicroBatcher
+        2) self.normalizer: LogNormalizer; Fitted on the training data
+        3) self.sample_interval, self.sample_duration, self.sample_mode: sampling of the training data
+    Input for initialization:
+        1) engine: InferenceEngine; ex) InferenceEngine.from_bit_checkpoints(...)
+        2) normalizer: LogNormalizer; Fitted, ex) LogNormalizer().load(path)
+        3) sample_interval, sample_duration, sample_mode: see sample_raw_dataset
+        4) batch_size, max_wait: see MicroBatcher
+    '''
+    def __init__(self, engine, normalizer, sample_interval, sample_duration, sample_mode="AVG", batch_size=64, max_wait=0.005):
+        if normalizer.global_min is None or normalizer.global_max is None:
+            raise KeyError("ERROR: normalizer has not been fitted")
+        if not engine.batch_independent:
+            raise ValueError("ERROR - Engine predictions depend on the batch(BatchNorm without running buffers or a model in train mode); "
+                             "the server cannot micro-batch traces of different clients with it")
+        if engine.untrained_batch_norm:
+            raise ValueError("ERROR - BatchNorm running statistics of the engine were never updated by training; "
+                             "its predictions would not reflect the trained model")
+        self.batcher = MicroBatcher(engine, batch_size, max_wait)
+        self.normalizer = normalizer
+        self.sample_interval = sample_interval
+        self.sample_duration = sample_duration
+        self.sample_mode = sample_mode
+        self.max_samples = int(sample_duration / sample_interval)
+
+    # Windowed and normalized float32 row of a finished stream
+    def prepare(self, stream):
+        row = stream.sample()
+        return self.normalizer.transform_list(row).astype(np.float32)
+
+    async def decode(self, stream):
+        adc_values, digital_value = await self.batcher.submit(self.prepare(stream))
+        return {"adc_values": adc_values.tolist(), "digital_value": int(digital_value)}
+
+    async def handle(self, reader, writer):
+        try:
+            stream = TraceStream(self.sample_interval, self.max_samples, self.sample_mode)
+            error = None
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode(errors="replace")
+                parts = line.split()
+                if not parts:
+                    # End of trace
+                    if error is not None:
+                        response = {"error": error}
+                    elif len(stream) == 0:
+                        response = {"error": "empty trace"}
+                    else:
+                        try:
+                            response = await self.decode(stream)
+                        except Exception as exc:
+                            response = {"error": str(exc)}
+                    writer.write((json.dumps(response) + "\n").encode())
+                    await writer.drain()
+                    stream = TraceStream(self.sample_interval, self.max_samples, self.sample_mode)
+                    error = None
+                    continue
+                if error is not None or (len(stream) == 0 and FIRST_LINE_PATTERN.match(line)):
+                    continue
+                try:
+                    stream.add(np.float64(parts[0]), np.float64(parts[1]))
+                except (ValueError, IndexError):
+                    error = f"invalid line: {line.strip()}"
+        finally:
+            writer.close()
+
+    '''
+    Function that serves until cancelled
+    Input:
+        1) socket_path: string; Unix socket to listen on; if None, TCP on host:port is used
+        2) host, port: TCP address used when socket_path is None
+    '''
+    async def serve(self, socket_path=None, host="127.0.0.1", port=8765):
+        batcher_task = asyncio.create_task(self.batcher.run())
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+            self.batcher.executor.shutdown(wait=False)
+
+'''
+Function that decodes one raw trace through a running InferenceServer
+Input:
+    1) points: iterable of (time, value); ex) zip(*convert_file_bulk(path))
+    2) socket_path, host, port: address of the server, see InferenceServer.serve
+Returns:
+    1) response: dictionary; {"adc_values": [...], "digital_value": int} or {"error": "..."}
+'''
+async def request_decode(points, socket_path=None, host="127.0.0.1", port=8765):
+    if socket_path is not None:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write("".join(f"{t:.17g} {v:.17g}\n" for t, v in points).encode() + b"\n")
+        await writer.drain()
+        return json.loads(await reader.readline())
+    finally:
+        writer.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser(prog="inference_server.py", description="Decode ADC outputs from streamed ngspice traces")
+    argparser.add_argument("checkpoint_dir", type=str, help="Folder holding {model}_checkpoint_adc_{i}_bit_{j}.pth")
+    argparser.add_argument("normalizer", type=str, help="JSON file saved by LogNormalizer.save")
+    argparser.add_argument("-m", "--model", type=str, default="resnet18", help="Per-bit model name, see create_bit_model")
+    argparser.add_argument("-i", "--interval", type=float, required=True, help="Sample interval of the training data")
+    argparser.add_argument("-d", "--duration", type=float, required=True, help="Sample duration of the training data")
+    argparser.add_argument("--mode", type=str, default="AVG", help="Sample mode of the training data")
+    argparser.add_argument("--adc-num", type=int, default=5, help="Number of ADCs")
+    argparser.add_argument("--adc-bits", type=int, default=8, help="Bits per ADC")
+    argparser.add_argument("-s", "--socket", type=str, default=None, help="Unix socket path; TCP on --host/--port if not given")
+    argparser.add_argument("--host", type=str, default="127.0.0.1", help="TCP host")
+    argparser.add_argument("--port", type=int, default=8765, help="TCP port")
+    argparser.add_argument("-b", "--batch-size", type=int, default=64, help="Largest micro-batch")
+    argparser.add_argument("-w", "--max-wait", type=float, default=0.005, help="Seconds a trace waits for its batch to fill")
+    argparser.add_argument("-q", "--quantize", action="store_true", help="Dynamically quantize Linear layers to int8")
+    argparser.add_argument("--channels-last", action="store_true", help="Run Conv2d models in channels-last format")
+
+    args = argparser.parse_args()
+    engine = InferenceEngine.from_bit_checkpoints(args.checkpoint_dir, args.model, args.adc_num, args.adc_bits,
+                                                  channels_last=args.channels_last, quantize=args.quantize)
+    normalizer = LogNormalizer()
+    normalizer.load(args.normalizer)
+    server = InferenceServer(engine, normalizer, args.interval, args.duration, args.mode, args.batch_size, args.max_wait)
+    asyncio.run(server.serve(args.socket, args.host, args.port))
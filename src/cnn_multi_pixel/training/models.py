@@ -0,0 +1,217 @@
+import torch.nn as nn
+from torchvision.models import resnet18, ResNet18_Weights
+
+'''
+Function that creates the ResNet18 used by the per-bit notebook workflow
+conv1 takes a single channel (B, 1, L, 1) trace "image"; BatchNorm layers track running stats, so eval() uses learned statistics
+Inputs:
+    1) num_outputs: number of output logits; 2 for a single bit
+    2) weights: torchvision weights to start from, current default=ResNet18_Weights.DEFAULT
+    3) freeze_layers: if True, freeze all pretrained layers
+Returns:
+    1) cnn: ResNet18 model
+'''
+def create_resnet18(num_outputs=2, weights=ResNet18_Weights.DEFAULT, freeze_layers=False):
+    cnn = resnet18(weights=weights)
+    if freeze_layers:
+        # Freeze all layers
+        for param in cnn.parameters():
+            param.requires_grad = False
+    cnn.conv1 = nn.Conv2d(1, 64, kernel_size=7, stride=2, padding=3, bias=False)
+    cnn.fc = nn.Linear(cnn.fc.in_features, num_outputs)
+    return cnn
+
+'''
+Function that makes BatchNorm layers whose running buffers were never updated normalize with batch statistics
+The notebook workflow trained with track_running_stats=False, so its checkpoints keep the ImageNet or initial
+buffers(num_batches_tracked == 0); eval() with those buffers does not give what the model learned.
+Input:
+    1) model: model with a loaded state_dict
+Returns:
+    1) n_untracked: int; Number of BatchNorm layers switched to batch statistics
+'''
+def use_batch_stats_if_untracked(model):
+    n_untracked = 0
+    for module in model.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.num_batches_tracked is not None \
+                and module.num_batches_tracked.item() == 0:
+            module.track_running_stats = False
+            module.running_mean = None
+            module.running_var = None
+            module.num_batches_tracked = None
+            n_untracked += 1
+    return n_untracked
+
+# Reshapes (B, L) traces into the (B, 1, L, 1) input of the 2D ResNet18
+class TraceTo2D(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x.unsqueeze(1).unsqueeze(-1))
+
+'''
+Function that creates a ResNet18 feature extractor for MultiHeadCNN
+Inputs:
+    1) weights, freeze_layers: see create_resnet18
+Returns:
+    1) backbone: model mapping (B, L) traces to (B, feature_dim) features
+    2) feature_dim: number of features
+'''
+def create_resnet18_backbone(weights=ResNet18_Weights.DEFAULT, freeze_layers=False):
+    cnn = create_resnet18(weights=weights, freeze_layers=freeze_layers)
+    feature_dim = cnn.fc.in_features
+    cnn.fc = nn.Identity()
+    return TraceTo2D(cnn), feature_dim
+
+class BasicBlock1d(nn.Module):
+    '''
+    Class of a ResNet basic block with 1D convolutions.
+    Input: (B, in_channels, L)
+    Output: (B, channels, ceil(L / stride))
+    Input for initialization:
+        1) in_channels: number of input channels
+        2) channels: number of output channels
+        3) stride: stride of the first convolution and of the shortcut
+        4) track_running_stats: passed to every nn.BatchNorm1d
+    '''
+    def __init__(self, in_channels, channels, stride=1, track_running_stats=True):
+        super().__init__()
+        self.conv1 = nn.Conv1d(in_channels, channels, kernel_size=3, stride=stride, padding=1, bias=False)
+        self.bn1   = nn.BatchNorm1d(channels, track_running_stats=track_running_stats)
+        self.conv2 = nn.Conv1d(channels, channels, kernel_size=3, stride=1, padding=1, bias=False)
+        self.bn2   = nn.BatchNorm1d(channels, track_running_stats=track_running_stats)
+        self.relu  = nn.ReLU(inplace=True)
+        self.downsample = None
+        if stride != 1 or in_channels != channels:
+            self.downsample = nn.Sequential(
+                nn.Conv1d(in_channels, channels, kernel_size=1, stride=stride, bias=False),
+                nn.BatchNorm1d(channels, track_running_stats=track_running_stats))
+
+    def forward(self, x):
+        identity = x if self.downsample is None else self.downsample(x)
+        out = self.relu(self.bn1(self.conv1(x)))
+        out = self.bn2(self.conv2(out))
+        return self.relu(out + identity)
+
+class ResNet1D(nn.Module):
+    '''
+    Class of a ResNet for 1D traces; same stem, stages and widths as ResNet18 with Conv1d instead of Conv2d.
+    Takes (B, L) traces directly, ex) rows of TraceDatasetSampled.get_sample_matrix() or of create_training_matrix,
+    so no (B, 1, L, 1) reshape and no convolution work on a width-1 dimension.
+    Input: (B, L) or (B, 1, L) traces
+    Output: (B, num_outputs) logits; (B, feature_dim) features if num_outputs is None
+    Input for initialization:
+        1) num_outputs: number of output logits; 2 for a single bit, None for a feature extractor
+        2) layers: number of BasicBlock1d per stage; default (2, 2, 2, 2) as ResNet18
+        3) widths: channels per stage
+        4) track_running_stats: passed to every nn.BatchNorm1d; with True, eval() normalizes with the running
+           statistics learned in training, so eval() output does not depend on the batch
+    '''
+    def __init__(self, num_outputs=2, layers=(2, 2, 2, 2), widths=(64, 128, 256, 512), track_running_stats=True):
+        super().__init__()
+        self.stem = nn.Sequential(
+            nn.Conv1d(1, widths[0], kernel_size=7, stride=2, padding=3, bias=False),
+            nn.BatchNorm1d(widths[0], track_running_stats=track_running_stats),
+            nn.ReLU(inplace=True),
+            nn.MaxPool1d(kernel_size=3, stride=2, padding=1))
+        stages = []
+        in_channels = widths[0]
+        for stage, (blocks, channels) in enumerate(zip(layers, widths)):
+            for block in range(blocks):
+                stride = 2 if stage > 0 and block == 0 else 1
+                stages.append(BasicBlock1d(in_channels, channels, stride, track_running_stats))
+                in_channels = channels
+        self.stages = nn.Sequential(*stages)
+        self.pool = nn.AdaptiveAvgPool1d(1)
+        self.feature_dim = in_channels
+        self.fc = nn.Identity() if num_outputs is None else nn.Linear(in_channels, num_outputs)
+
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.unsqueeze(1)
+        x = self.pool(self.stages(self.stem(x))).flatten(1)
+        return self.fc(x)
+
+'''
+Function that creates a single-bit ResNet1D, the 1D counterpart of create_resnet18
+Inputs:
+    1) num_outputs: number of output logits; 2 for a single bit
+    2) kwargs: passed to ResNet1D, ex) layers, widths
+Returns:
+    1) cnn: ResNet1D model
+'''
+def create_resnet1d(num_outputs=2, **kwargs):
+    return ResNet1D(num_outputs=num_outputs, **kwargs)
+
+'''
+Function that creates a ResNet1D feature extractor for MultiHeadCNN
+Inputs:
+    1) kwargs: passed to ResNet1D, ex) layers, widths
+Returns:
+    1) backbone: model mapping (B, L) traces to (B, feature_dim) features
+    2) feature_dim: number of features
+'''
+def create_resnet1d_backbone(**kwargs):
+    backbone = ResNet1D(num_outputs=None, **kwargs)
+    return backbone, backbone.feature_dim
+
+# Forward pre-hook of create_bit_model; reshapes (B, L) traces to (B, 1, L, 1) without wrapping the model,
+# so state_dict keys stay those of the notebook checkpoints
+def reshape_trace_input(module, args):
+    x = args[0]
+    if x.dim() == 2:
+        x = x.unsqueeze(1).unsqueeze(-1)
+    return (x,) + tuple(args[1:])
+
+# Single-bit models selectable by name; both take (B, L) traces and return (B, num_outputs) logits
+def create_bit_model(name, num_outputs=2, **kwargs):
+    if name == "resnet18":
+        cnn = create_resnet18(num_outputs=num_outputs, **kwargs)
+        cnn.register_forward_pre_hook(reshape_trace_input)
+        return cnn
+    if name == "resnet1d":
+        return create_resnet1d(num_outputs=num_outputs, **kwargs)
+    raise ValueError(f"ERROR - Unknown model \"{name}\"; choose from \"resnet18\", \"resnet1d\"")
+
+# Backbones selectable by name from the training entry points
+# resnet18: pretrained 2D ResNet18 on (B, 1, L, 1) reshaped traces, as the notebook workflow
+# resnet1d: ResNet18-shaped Conv1d network on (B, L) traces
+BACKBONES = {
+    "resnet18": create_resnet18_backbone,
+    "resnet1d": create_resnet1d_backbone,
+}
+
+'''
+Function that creates a backbone by name
+Inputs:
+    1) name: key of BACKBONES
+    2) kwargs: passed to the backbone function
+Returns:
+    1) backbone, feature_dim: see create_resnet18_backbone
+'''
+def create_backbone(name, **kwargs):
+    if name not in BACKBONES:
+        raise ValueError(f"ERROR - Unknown backbone \"{name}\"; choose from {sorted(BACKBONES)}")
+    return BACKBONES[name](**kwargs)
+
+class MultiHeadCNN(nn.Module):
+    '''
+    Class of a shared backbone with one binary classification head per bit.
+    All heads are computed by a single linear layer on the shared features.
+    Input: (B, L) traces
+    Output: (B, n_heads, 2) logits; head k predicts column k of the bit label matrix
+    Input for initialization:
+        1) backbone: model mapping (B, L) traces to (B, feature_dim) features
+        2) feature_dim: number of backbone features
+        3) n_heads: number of bits predicted; adc_num * adc_bits for all bits, adc_bits for a single ADC
+    '''
+    def __init__(self, backbone, feature_dim, n_heads):
+        super().__init__()
+        self.backbone = backbone
+        self.n_heads  = n_heads
+        self.heads    = nn.Linear(feature_dim, n_heads * 2)
+
+    def forward(self, x):
+        return self.heads(self.backbone(x)).view(-1, self.n_heads, 2)
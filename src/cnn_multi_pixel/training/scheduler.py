@@ -0,0 +1,131 @@
+import os
+import queue
+import torch
+import torch.multiprocessing as torch_mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from torch.utils.data import TensorDataset
+from src.cnn_multi_pixel.dataloader.dataloader import create_batch_dataloader
+from src.cnn_multi_pixel.training.models import create_bit_model
+from src.cnn_multi_pixel.training.train import train_model
+
+# Shared tensors and progress callback of a worker process; set once by init_worker
+worker_state = {}
+
+'''
+Function that initializes a worker process of train_bitwise_parallel
+traces and bit_labels arrive as shared memory handles, not copies.
+Input:
+    1) traces: torch.Tensor; (N, L) traces in shared memory
+    2) bit_labels: torch.Tensor; (N, adc_num * adc_bits) bit labels in shared memory
+    3) threads: int; torch intra-op threads of this worker
+    4) progress_queue: queue for per-epoch progress; None to not report
+'''
+def init_worker(traces, bit_labels, threads, progress_queue):
+    torch.set_num_threads(threads)
+    worker_state["traces"] = traces
+    worker_state["bit_labels"] = bit_labels
+    worker_state["progress"] = progress_queue.put if progress_queue is not None else None
+
+'''
+Function that trains the model of a single (adc, bit) pair, resuming from its checkpoint
+Input:
+    1) job: tuple; (adc, bit, column, checkpoint_path, model_name, params, loader_kwargs, model_kwargs)
+        column: column of bit_labels holding the labels of the bit
+Returns:
+    1) adc, bit: int; Job identity
+    2) reached_acc: float; Accuracy of the last epoch, or of the checkpoint if already reached
+'''
+def train_bit_job(job):
+    adc, bit, column, checkpoint_path, model_name, params, loader_kwargs, model_kwargs = job
+    dataset = TensorDataset(worker_state["traces"], worker_state["bit_labels"][:, column])
+    dataloader = create_batch_dataloader(dataset, **loader_kwargs)
+    model = create_bit_model(model_name, **model_kwargs)
+    report = worker_state["progress"]
+
+    def progress(epoch, loss, head_acc):
+        if report is not None:
+            report((adc, bit, epoch, loss, head_acc.min().item()))
+
+    reached_acc, _ = train_model(model, dataloader, checkpoint_path, params, verbose=False, progress=progress)
+    return adc, bit, reached_acc
+
+'''
+Function that trains the separate per-bit models of the notebook workflow concurrently in a process pool
+Jobs run in the notebook order, MSB ADC and MSB bit first; a job resumes from
+{model_name}_checkpoint_adc_{adc}_bit_{bit}.pth, i.e. resnet18_checkpoint_adc_{i}_bit_{j}.pth,
+and is skipped if its checkpoint already reached params["target_acc"].
+The trace tensor and bit labels are moved to shared memory once; workers index them without copying.
+Each worker is pinned to threads_per_worker torch intra-op threads, so workers do not oversubscribe the cores.
+Input:
+    1) traces: torch.Tensor; (N, L) traces, ex) TraceDatasetBuilder.traces
+    2) bit_labels: torch.Tensor; (N, adc_num * adc_bits) bit labels, ex) TraceDatasetBuilder.bit_labels
+    3) checkpoint_dir: string; Folder holding per-bit checkpoints
+    4) adc_num, adc_bits: number of ADCs and bits per ADC
+    5) workers: int; Number of worker processes; default os.cpu_count(). 1 trains in this process.
+    6) threads_per_worker: int; torch intra-op threads per worker; default os.cpu_count() // workers
+    7) model_name: string; "resnet18" or "resnet1d"; see models.create_bit_model
+    8) params: dictionary; see train.param_init
+    9) loader_kwargs: dictionary; passed to create_batch_dataloader, ex) batch_size, shuffle
+    10) bits: list of (adc, bit); Jobs to run; default every bit
+    11) verbose: if True, print progress of every job every epoch
+    12) model_kwargs: passed to create_bit_model, ex) weights=None
+Returns:
+    1) results: dictionary;
+        Key: tuple; (adc, bit)
+        Value: float; Reached accuracy
+'''
+def train_bitwise_parallel(traces, bit_labels, checkpoint_dir, adc_num=5, adc_bits=8, workers=None, threads_per_worker=None,
+                           model_name="resnet18", params=None, loader_kwargs=None, bits=None, verbose=True, **model_kwargs):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    cpu_count = os.cpu_count() or 1
+    if bits is None:
+        bits = [(adc, bit) for adc in range(adc_num - 1, -1, -1) for bit in range(adc_bits - 1, -1, -1)]
+    workers = min(workers or cpu_count, len(bits)) or 1
+    threads_per_worker = threads_per_worker or max(1, cpu_count // workers)
+    loader_kwargs = loader_kwargs or {}
+    jobs = [(adc, bit, adc * adc_bits + bit,
+             os.path.join(checkpoint_dir, f"{model_name}_checkpoint_adc_{adc}_bit_{bit}.pth"),
+             model_name, params, loader_kwargs, model_kwargs) for adc, bit in bits]
+
+    def report(item):
+        adc, bit, epoch, loss, acc = item
+        if verbose:
+            print(f"[adc {adc} bit {bit}] Epoch {epoch + 1}, Loss: {loss:.4f}, Accuracy: {acc:.4f}")
+
+    def drain(progress_queue):
+        while True:
+            try:
+                report(progress_queue.get_nowait())
+            except queue.Empty:
+                return
+
+    results = {}
+    if workers == 1:
+        # Trains in this process; torch thread setting of this process is left unchanged
+        worker_state.update(traces=traces, bit_labels=bit_labels, progress=report)
+        for job in jobs:
+            adc, bit, reached_acc = train_bit_job(job)
+            results[(adc, bit)] = reached_acc
+            if verbose:
+                print(f"DONE: adc {adc} bit {bit}, Accuracy: {reached_acc:.4f} ({len(results)}/{len(jobs)})")
+        return results
+
+    # Pretrained weights are downloaded once here instead of by every worker at the same time
+    create_bit_model(model_name, **model_kwargs)
+    traces.share_memory_()
+    bit_labels.share_memory_()
+    context = torch_mp.get_context("spawn")
+    progress_queue = context.Queue()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(traces, bit_labels, threads_per_worker, progress_queue)) as executor:
+        pending = {executor.submit(train_bit_job, job) for job in jobs}
+        while pending:
+            done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            drain(progress_queue)
+            for future in done:
+                adc, bit, reached_acc = future.result()
+                results[(adc, bit)] = reached_acc
+                if verbose:
+                    print(f"DONE: adc {adc} bit {bit}, Accuracy: {reached_acc:.4f} ({len(results)}/{len(jobs)})")
+    drain(progress_queue)
+    return results
@@ -0,0 +1,247 @@
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset
+from src.cnn_multi_pixel.dataloader.dataloader import compute_bit_labels, create_batch_dataloader
+from src.cnn_multi_pixel.training.models import MultiHeadCNN, create_backbone, use_batch_stats_if_untracked
+from src.cnn_multi_pixel.helper_functions.profiler import profile_iter
+
+'''
+Function that returns default training parameters of the notebook workflow
+Returns:
+    1) params: dictionary; num_epochs, max_grad_norm, lr, target_acc
+'''
+def param_init():
+    return {"num_epochs": 1000, "max_grad_norm": 1.0, "lr": 1e-4, "target_acc": 0.925}
+
+'''
+Function that loads a training checkpoint into a model and optimizer
+BatchNorm layers of notebook checkpoints, trained without running stats, keep using batch statistics; see use_batch_stats_if_untracked
+Input:
+    1) checkpoint_path: string; Full path to checkpoint; missing file starts from scratch
+    2) model, optimizer: model and optimizer to load into
+Returns:
+    1) start_epoch: int; First epoch still to be trained
+    2) reached_acc: float; Accuracy reached by the checkpoint; 0 if there is none
+'''
+def load_checkpoint(checkpoint_path, model, optimizer):
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return 0, 0.0
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    model.load_state_dict(checkpoint['cnn_state_dict'])
+    use_batch_stats_if_untracked(model)
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    return checkpoint['epoch'] + 1, checkpoint['reached_acc']
+
+'''
+Function that computes per-head accuracy of a model over a dataloader
+Runs the model in eval(), so BatchNorm layers use the running statistics learned in training
+Input:
+    1) model: model returning (B, n_heads, 2) or (B, 2) logits
+    2) dataloader: yields (traces, labels); labels are (B, n_heads) or (B,)
+Returns:
+    1) head_acc: torch.Tensor; (n_heads,) accuracy of each head
+'''
+def evaluate(model, dataloader):
+    model.eval()
+    correct = None
+    total = 0
+    with torch.no_grad():
+        for inputs, labels in profile_iter(dataloader, "evaluate dataloader"):
+            outputs = model(inputs.float())
+            predicted = outputs.argmax(-1).view(len(labels), -1)
+            batch_correct = (predicted == labels.long().view(len(labels), -1)).sum(0)
+            correct = batch_correct if correct is None else correct + batch_correct
+            total += len(labels)
+    if correct is None:
+        return torch.zeros(0)
+    return correct.double() / total
+
+'''
+Function that trains a model until the worst head reaches the target accuracy
+Outputs are flattened to (-1, 2) so one cross entropy covers every head; a single-head model is also accepted.
+Every epoch is checkpointed with the keys used by the notebook workflow.
+Input:
+    1) model: model returning (B, n_heads, 2) or (B, 2) logits
+    2) dataloader: yields (traces, labels); labels are (B, n_heads) or (B,)
+    3) checkpoint_path: string; Full path to checkpoint; None to not save
+    4) params: dictionary; see param_init
+    5) verbose: if True, print progress every epoch
+    6) progress: callable(epoch, loss, head_acc); called after every epoch, ex) to report progress from a worker process
+Returns:
+    1) reached_acc: float; Lowest head accuracy of the last epoch
+    2) head_acc: torch.Tensor; (n_heads,) accuracy of each head in the last epoch; None if skipped
+'''
+def train_model(model, dataloader, checkpoint_path=None, params=None, verbose=True, progress=None):
+    params = param_init() if params is None else params
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=params["lr"])
+    start_epoch, reached_acc = load_checkpoint(checkpoint_path, model, optimizer)
+    if reached_acc >= params["target_acc"]:
+        if verbose:
+            print(f"SKIP: {checkpoint_path} already reached {reached_acc:.4f}")
+        return reached_acc, None
+
+    head_acc = None
+    for epoch in range(start_epoch, params["num_epochs"]):
+        model.train()
+        running_loss = 0.0
+        correct = None
+        total = 0
+        nan_found = False
+        for inputs, labels in profile_iter(dataloader, "train dataloader"):
+            inputs = inputs.float()
+            labels = labels.long().view(len(labels), -1)
+            if torch.isnan(inputs).any():
+                print("ERROR: NaN found in inputs")
+                nan_found = True
+                break
+            optimizer.zero_grad()
+            outputs = model(inputs).view(len(labels), -1, 2)
+            loss = criterion(outputs.reshape(-1, 2), labels.reshape(-1))
+            if torch.isnan(loss):
+                print("ERROR: NaN found in loss")
+                nan_found = True
+                break
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), params["max_grad_norm"])
+            optimizer.step()
+
+            running_loss += loss.item() * len(labels)
+            batch_correct = (outputs.argmax(-1) == labels).sum(0)
+            correct = batch_correct if correct is None else correct + batch_correct
+            total += len(labels)
+        if nan_found or total == 0:
+            break
+
+        head_acc = correct.double() / total
+        reached_acc = head_acc.min().item()
+        if checkpoint_path is not None:
+            torch.save({
+                'cnn_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'epoch': epoch,
+                'reached_acc': reached_acc,
+            }, checkpoint_path)
+        if verbose:
+            print(f"Epoch [{epoch + 1}/{params['num_epochs']}], Loss: {running_loss / total:.4f}, "
+                  f"Min head accuracy: {reached_acc:.4f}, Mean head accuracy: {head_acc.mean().item():.4f}")
+        if progress is not None:
+            progress(epoch, running_loss / total, head_acc)
+        if reached_acc >= params["target_acc"]:
+            break
+    return reached_acc, head_acc
+
+'''
+Function that trains one MultiHeadCNN per training job
+Input:
+    1) jobs: list of (dataloader, n_heads, checkpoint_name)
+    2) checkpoint_dir: string; Folder to save checkpoints in; None to not save
+    3) backbone: string; Key of models.BACKBONES
+    4) params: dictionary; see param_init
+    5) verbose: if True, print progress every epoch
+    6) backbone_kwargs: dictionary; passed to the backbone function
+Returns:
+    1) models: list of MultiHeadCNN; One per job
+    2) head_acc: list of torch.Tensor; Accuracy of each head of each model
+'''
+def train_head_jobs(jobs, checkpoint_dir, backbone, params, verbose, backbone_kwargs):
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    models = []
+    head_acc = []
+    for dataloader, n_heads, checkpoint_name in jobs:
+        model = MultiHeadCNN(*create_backbone(backbone, **backbone_kwargs), n_heads)
+        checkpoint_path = os.path.join(checkpoint_dir, checkpoint_name) if checkpoint_dir is not None else None
+        if verbose:
+            print(f"Training {checkpoint_name}: {n_heads} heads")
+        _, acc = train_model(model, dataloader, checkpoint_path, params, verbose)
+        models.append(model)
+        head_acc.append(acc)
+    return models, head_acc
+
+'''
+Function that creates one dataloader per ADC from column slices of a bit label matrix
+Input:
+    1) traces: torch.Tensor; (N, L) traces
+    2) bit_labels: torch.Tensor; (N, adc_num * adc_bits) bit labels, see compute_bit_labels
+    3) adc_num, adc_bits: number of ADCs and bits per ADC
+    4) backbone: string; Used in checkpoint names
+    5) loader_kwargs: dictionary; passed to create_batch_dataloader
+Returns:
+    1) jobs: list of (dataloader, adc_bits, checkpoint_name); see train_head_jobs
+'''
+def create_adc_jobs(traces, bit_labels, adc_num, adc_bits, backbone, loader_kwargs):
+    jobs = []
+    for adc in range(adc_num):
+        dataset = TensorDataset(traces, bit_labels[:, adc * adc_bits:(adc + 1) * adc_bits])
+        jobs.append((create_batch_dataloader(dataset, **loader_kwargs), adc_bits,
+                     f"{backbone}_multihead_checkpoint_adc_{adc}.pth"))
+    return jobs
+
+'''
+Function that trains shared-backbone multi-head models on the bit labels of a built TraceDatasetBuilder
+Every trace goes through the backbone once per epoch for all bits, instead of once per (adc, bit) model.
+Head k of the "all" model predicts builder.bit_labels[:, k], i.e. adc = k // adc_bits, bit = k % adc_bits,
+the same order as builder.dataloaders.
+Input:
+    1) builder: TraceDatasetBuilder; build() already called
+    2) checkpoint_dir: string; Folder to save checkpoints in; None to not save
+    3) head_mode: string;
+        "all": one model with adc_num * adc_bits heads
+        "adc": one model per ADC with adc_bits heads each, trained from column slices of the bit labels
+    4) backbone: string; Key of models.BACKBONES; "resnet18" or "resnet1d"
+    5) params: dictionary; see param_init
+    6) loader_kwargs: dictionary; Dataloader arguments, ex) batch_size, shuffle; "all" mode uses builder.bit_dataloader if already built
+    7) verbose: if True, print progress every epoch
+    8) backbone_kwargs: passed to the backbone function, ex) weights=None
+Returns:
+    1) models: list of MultiHeadCNN; One model for "all", adc_num models for "adc"
+    2) head_acc: list of torch.Tensor; Accuracy of each head of each model
+'''
+def train_multi_head(builder, checkpoint_dir=None, head_mode="all", backbone="resnet18", params=None,
+                     loader_kwargs=None, verbose=True, **backbone_kwargs):
+    if builder.bit_labels is None:
+        raise ValueError("ERROR - TraceDatasetBuilder.build() must be called before training")
+    loader_kwargs = loader_kwargs or {}
+    if head_mode == "all":
+        if builder.bit_dataloader is None:
+            builder.build_dataloaders(**loader_kwargs)
+        jobs = [(builder.bit_dataloader, builder.bit_labels.shape[1], f"{backbone}_multihead_checkpoint.pth")]
+    elif head_mode == "adc":
+        jobs = create_adc_jobs(builder.traces, builder.bit_labels, builder.adc_num, builder.adc_bits, backbone, loader_kwargs)
+    else:
+        raise ValueError(f"ERROR - Unknown head_mode \"{head_mode}\"; choose from \"all\", \"adc\"")
+    return train_head_jobs(jobs, checkpoint_dir, backbone, params, verbose, backbone_kwargs)
+
+'''
+Function that trains shared-backbone multi-head models directly on a sampled trace matrix
+Takes the (n_traces, n_samples) matrix of create_training_matrix, or TraceDatasetSampled.get_sample_matrix(),
+with its digital values; no trace files or TraceDatasetBuilder are needed.
+Input:
+    1) traces: np.ndarray or torch.Tensor; (N, L) sampled, normalized traces; read-only arrays(ex. np.memmap) are copied
+    2) digital_values: np.ndarray; (N,) combined digital values, or (N, adc_num) per ADC values if split_digital
+    3) checkpoint_dir, head_mode: see train_multi_head
+    4) backbone: string; Key of models.BACKBONES; default "resnet1d"
+    5) adc_num, adc_bits, split_digital: see compute_bit_labels
+    6) params, loader_kwargs, verbose, backbone_kwargs: see train_multi_head
+Returns:
+    1) models, head_acc: see train_multi_head
+'''
+def train_multi_head_matrix(traces, digital_values, checkpoint_dir=None, head_mode="all", backbone="resnet1d",
+                            adc_num=5, adc_bits=8, split_digital=False, params=None, loader_kwargs=None,
+                            verbose=True, **backbone_kwargs):
+    if not isinstance(traces, torch.Tensor):
+        traces = torch.from_numpy(np.require(traces, np.float32, ["C", "W"]))
+    digital_values = np.asarray(digital_values, dtype=np.int64).reshape(len(traces), -1)
+    bit_labels = torch.from_numpy(compute_bit_labels(digital_values, adc_num, adc_bits, split_digital))
+    loader_kwargs = loader_kwargs or {}
+    if head_mode == "all":
+        jobs = [(create_batch_dataloader(TensorDataset(traces, bit_labels), **loader_kwargs), bit_labels.shape[1],
+                 f"{backbone}_multihead_checkpoint.pth")]
+    elif head_mode == "adc":
+        jobs = create_adc_jobs(traces, bit_labels, adc_num, adc_bits, backbone, loader_kwargs)
+    else:
+        raise ValueError(f"ERROR - Unknown head_mode \"{head_mode}\"; choose from \"all\", \"adc\"")
+    return train_head_jobs(jobs, checkpoint_dir, backbone, params, verbose, backbone_kwargs)
@@ -0,0 +1,34 @@
+import json
+import sys
+from benchmarks import bench_pipeline
+
+STAGES = ["generate", "ingest", "save_raw", "load_raw", "sample_and_save", "load_sampled",
+          "normalize", "fused_matrix", "builder", "dataloader", "train"]
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["bench_pipeline.py", "--folders", "2", "--files", "4", "--points", "400", "--duration", "20e-6",
+                                      "--interval", "1e-6", "--adc-num", "2", "--batch-size", "4", *args])
+    bench_pipeline.main()
+
+def test_benchmark_smoke_run(tmp_path, monkeypatch, capsys):
+    output = tmp_path / "result.json"
+    run_main(monkeypatch, "--work-dir", str(tmp_path / "work"), "-o", str(output))
+    with open(output, "r") as f:
+        report = json.load(f)
+    assert [stage["stage"] for stage in report["stages"]] == STAGES
+    for stage in report["stages"]:
+        assert stage["wall_s"] > 0 and any(key.endswith("_per_s") for key in stage)
+    assert report["stages"][0]["files"] == 8
+    assert "create_raw_traces" in report["totals"]
+
+    compressed = tmp_path / "compressed.json"
+    run_main(monkeypatch, "--codec", "zlib:1", "-o", str(compressed), "--compare", str(output))
+    assert "Compared to" in capsys.readouterr().out
+
+def test_benchmark_adc_bits(tmp_path, monkeypatch):
+    output = tmp_path / "result.json"
+    run_main(monkeypatch, "--adc-bits", "4", "--modes", "AVG", "-o", str(output))
+    with open(output, "r") as f:
+        report = json.load(f)
+    assert report["config"]["adc_bits"] == 4
+    assert [stage["stage"] for stage in report["stages"]] == STAGES
@@ -0,0 +1,90 @@
+import itertools
+import os
+import numpy as np
+import pytest
+from src.cnn_multi_pixel.dataset.dataset_raw import TIME_FILTERS, TraceDatasetRaw, load_raw_packed, save_raw_packed, upsert_raw_packed
+from src.cnn_multi_pixel.dataset.dataset_sampled import TraceDatasetSampled, load_sampled_packed, save_sampled_packed, upsert_sampled_packed
+from src.cnn_multi_pixel.helper_functions import codec as codec_module
+from src.cnn_multi_pixel.helper_functions.codec import CODECS, FILTERS, Codec, decode, load_array, read_codec, save_array
+
+FILTER_CHAINS = [()] + [chain for n in range(1, len(FILTERS) + 1) for chain in itertools.permutations(FILTERS, n)]
+
+def arrays():
+    rng = np.random.default_rng(0)
+    times = np.cumsum(rng.lognormal(size=1001)) * 1e-9
+    return {
+        "times": times,
+        "values": rng.normal(size=(37, 3)).astype(np.float32),
+        "int64": rng.integers(-2**62, 2**62, size=333),
+        "uint8": rng.integers(0, 256, size=17, dtype=np.uint8),
+        "special": np.array([np.nan, np.inf, -np.inf, -0.0, 0.0, np.finfo(np.float64).max, 5e-324]),
+        "empty": np.empty((0, 4), dtype=np.float64),
+    }
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+@pytest.mark.parametrize("filters", FILTER_CHAINS)
+def test_round_trip(name, filters, monkeypatch):
+    # Small blocks, so arrays span several blocks
+    monkeypatch.setattr(codec_module, "BLOCK_BYTES", 256)
+    codec = Codec(name, filters=filters)
+    for key, array in arrays().items():
+        decoded = decode(codec.encode(array))
+        assert decoded.dtype == array.dtype and decoded.shape == array.shape, key
+        assert decoded.tobytes() == array.tobytes(), key
+        assert decoded.flags.writeable
+
+def test_parse():
+    codec = Codec.parse("zlib:1:delta+shuffle")
+    assert (codec.name, codec.level, codec.filters) == ("zlib", 1, ("delta", "shuffle"))
+    assert Codec.parse("none").plain
+    with pytest.raises(ValueError):
+        Codec.parse("unknown")
+    with pytest.raises(ValueError):
+        Codec("zlib", filters=("unknown",))
+
+def test_save_array_switches_format(tmp_path):
+    stem = str(tmp_path / "array")
+    array = np.arange(100, dtype=np.float64)
+    assert save_array(stem, array, Codec("zlib")).endswith(".npc")
+    assert read_codec(stem).name == "zlib"
+    np.testing.assert_array_equal(load_array(stem), array)
+    assert save_array(stem, array).endswith(".npy")
+    assert not os.path.exists(stem + ".npc") and read_codec(stem).plain
+    assert isinstance(load_array(stem, mmap_mode="r"), np.memmap)
+
+def make_raw_dict(digital_values, seed):
+    rng = np.random.default_rng(seed)
+    return {dv: (np.cumsum(rng.random(n)) * 1e-9, rng.random(n)) for dv, n in zip(digital_values, rng.integers(5, 20, len(digital_values)))}
+
+def assert_raw_equal(dataset, raw_dict):
+    assert sorted(int(dv) for dv in dataset.get_raw_dict()) == sorted(raw_dict)
+    for dv, (times, values) in raw_dict.items():
+        np.testing.assert_array_equal(dataset[dv][0], times)
+        np.testing.assert_array_equal(dataset[dv][1], values)
+
+@pytest.mark.parametrize("codec", [None, Codec("zlib", 1), Codec("lzma", 0, ("shuffle",))])
+def test_upsert_raw_store(tmp_path, codec):
+    stored = make_raw_dict([5, 3, 8], seed=0)
+    dataset_dir = save_raw_packed(str(tmp_path), TraceDatasetRaw("folder", dict(stored)), codec)
+    changed = make_raw_dict([3, 11], seed=1)
+    updated = upsert_raw_packed(dataset_dir, changed)
+    expected = {**stored, **changed}
+    assert_raw_equal(updated, expected)
+    assert_raw_equal(load_raw_packed(dataset_dir, mmap=False), expected)
+    assert read_codec(os.path.join(dataset_dir, "values")).name == (codec.name if codec else "none")
+    if codec is not None:
+        assert read_codec(os.path.join(dataset_dir, "times")).filters == TIME_FILTERS
+
+@pytest.mark.parametrize("codec", [None, Codec("zlib", 1), Codec("bz2", 1, ("shuffle",))])
+def test_upsert_sampled_store(tmp_path, codec):
+    rng = np.random.default_rng(0)
+    sample_info = (1e-6, 8e-6, "AVG")
+    stored = TraceDatasetSampled("folder", rng.random((3, 8)).astype(np.float32), sample_info, [5, 3, 8])
+    dataset_dir = save_sampled_packed(str(tmp_path), stored, codec)
+    changed = TraceDatasetSampled("folder", rng.random((2, 8)).astype(np.float32), sample_info, [3, 11])
+    updated = upsert_sampled_packed(dataset_dir, changed)
+    np.testing.assert_array_equal(updated.get_digital_values(), [5, 3, 8, 11])
+    for dv, expected in [(5, stored[5]), (8, stored[8]), (3, changed[3]), (11, changed[11])]:
+        np.testing.assert_array_equal(updated[dv], expected)
+    np.testing.assert_array_equal(load_sampled_packed(dataset_dir, mmap=False).get_sample_matrix(), updated.get_sample_matrix())
+    assert read_codec(os.path.join(dataset_dir, "samples")).name == (codec.name if codec else "none")
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic_traces import file_pattern, generate_trace_folder
+from src.cnn_multi_pixel.dataloader.dataloader import TraceDataset, TraceDatasetBuilder, compute_bit_labels, process_value
+from src.cnn_multi_pixel.dataloader.trace_cache import TraceCache
+
+def write_trace(path, lines):
+    with open(path, "w") as f:
+        f.write("time -i(vdd)\n" + "".join(lines))
+    return str(path)
+
+def load(path):
+    return TraceDataset([], avg_exp=4, cache=False).load_trace("trace", path)
+
+def test_load_trace_matches_process_value(tmp_path):
+    rng = np.random.default_rng(0)
+    values = [f"{value:.8e}" for value in rng.uniform(-1e-3, 1e-3, 200)]
+    path = write_trace(tmp_path / "trace.txt", [f"{i * 1e-9:.8e}\t{value}\n" for i, value in enumerate(values)])
+    expected = [process_value(value, 4) for value in values]
+    np.testing.assert_array_equal(load(path), np.array([value for value in expected if value is not None], dtype=np.float32))
+
+def test_load_trace_without_final_newline(tmp_path):
+    path = write_trace(tmp_path / "trace.txt", ["1.00000000e-09 2.17498915e-03\n", "2.00000000e-09 -1.50000000e-04"])
+    assert len(load(path)) == 2
+
+@pytest.mark.parametrize("lines", [
+    ["1.00000000e-09\n", "2.00000000e-09 2.17498915e-03 3.00000000e-09\n"],
+    ["1.00000000e-09 2.17498915e-03\n", "\n", "2.00000000e-09 2.17498915e-03\n"],
+    ["1.00000000e-09 2.17498915e-03 4.00000000e-09\n"],
+])
+def test_load_trace_rejects_lines_without_two_tokens(tmp_path, lines):
+    with pytest.raises(ValueError):
+        load(write_trace(tmp_path / "trace.txt", lines))
+
+def test_compute_bit_labels_reports_adc_num():
+    with pytest.raises(ValueError, match="adc_num 5 for labels with 3 values"):
+        compute_bit_labels(np.zeros((2, 3), dtype=np.int64), 5, 8, True)
+
+def test_builder_keeps_one_copy_of_the_traces(tmp_path, monkeypatch):
+    generate_trace_folder(str(tmp_path), "folder", 4, 300, adc_num=2)
+    puts = []
+    monkeypatch.setattr(TraceCache, "put", lambda self, key, trace: puts.append(key))
+    builder = TraceDatasetBuilder(adc_num=2, normalized_digital=True)
+    builder.add_files(str(tmp_path / "folder"), file_pattern(2), None)
+    builder.build()
+    assert puts == []
+    assert tuple(builder.traces.shape) == (4, 300)
+    for dataset in [builder.dataset, builder.bit_dataset] + builder.datasets:
+        assert dataset.trace_cache is None and dataset.traces is builder.traces
+    np.testing.assert_array_equal(builder.dataset[1][0], load(builder.file_list[1][1]))
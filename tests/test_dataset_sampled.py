@@ -0,0 +1,56 @@
+import os
+import numpy as np
+from benchmarks.synthetic_traces import generate_trace_folder
+from src.cnn_multi_pixel.dataset import dataset_sampled
+from src.cnn_multi_pixel.dataset.dataset_cache import update_datasets
+from src.cnn_multi_pixel.dataset.dataset_sampled import (TraceDatasetSampled, load_sampled_dataset, load_sampled_packed,
+                                                         save_sampled_packed, upsert_sampled_packed)
+
+SAMPLE_INFO = (1e-6, 8e-6, "AVG")
+
+def make_dataset(digital_values, seed=0, folder_name="folder"):
+    rng = np.random.default_rng(seed)
+    samples = rng.random((len(digital_values), 8)).astype(np.float32)
+    return TraceDatasetSampled(folder_name, samples, SAMPLE_INFO, digital_values)
+
+def test_upsert_plain_store_patches_rows_without_reading_samples(tmp_path, monkeypatch):
+    stored = make_dataset([3, 1, 2])
+    dataset_dir = save_sampled_packed(str(tmp_path), stored)
+    changed = make_dataset([1, 7], seed=1)
+
+    loads = []
+    load_array = dataset_sampled.load_array
+    monkeypatch.setattr(dataset_sampled, "load_array", lambda path, mmap_mode=None: loads.append(mmap_mode) or load_array(path, mmap_mode))
+    updated = upsert_sampled_packed(dataset_dir, changed)
+    assert None not in loads
+
+    np.testing.assert_array_equal(updated.get_digital_values(), [3, 1, 2, 7])
+    np.testing.assert_array_equal(updated[3], stored[3])
+    np.testing.assert_array_equal(updated[1], changed[1])
+    np.testing.assert_array_equal(updated[7], changed[7])
+    np.testing.assert_array_equal(load_sampled_packed(dataset_dir, mmap=False).get_sample_matrix(), updated.get_sample_matrix())
+
+def test_load_sampled_dataset_keeps_folders_with_a_common_prefix_apart(tmp_path, monkeypatch):
+    save_sampled_packed(str(tmp_path), make_dataset([1, 2], folder_name="X"))
+    save_sampled_packed(str(tmp_path), make_dataset([3], folder_name="X_px"))
+    (tmp_path / "X_px_MAX_sam.gz").write_bytes(b"not opened")
+    opened = []
+    load_packed = dataset_sampled.load_sampled_packed
+    monkeypatch.setattr(dataset_sampled, "load_sampled_packed", lambda path, mmap=True: opened.append(os.path.basename(path)) or load_packed(path, mmap))
+    loaded = load_sampled_dataset(str(tmp_path), ["X"])
+    assert opened == ["X_AVG_sam"]
+    os.remove(tmp_path / "X_px_MAX_sam.gz")
+    assert [(dataset.get_folder_name(), dataset.sample_mode) for dataset in loaded] == [("X", "AVG")]
+    loaded = load_sampled_dataset(str(tmp_path), ["X", "X_px"])
+    assert sorted(dataset.get_folder_name() for dataset in loaded) == ["X", "X_px"]
+
+def test_update_datasets_with_prefix_folder_names(tmp_path):
+    trace_root = tmp_path / "traces"
+    target_dict = {}
+    for seed, folder_name in enumerate(["X", "X_px"]):
+        target_dict[folder_name] = generate_trace_folder(str(trace_root), folder_name, 3, 400, duration=20e-6, adc_num=2, seed=seed)
+        target_dict[folder_name].update({"sample_modes": ["AVG", "MAX"], "sample_interval": 1e-6, "sample_duration": 20e-6})
+    raw_datasets, sampled_datasets = update_datasets(str(trace_root), str(tmp_path / "raw"), str(tmp_path / "sampled"), target_dict)
+    assert sorted(dataset.get_folder_name() for dataset in raw_datasets) == ["X", "X_px"]
+    assert sorted((dataset.get_folder_name(), dataset.sample_mode) for dataset in sampled_datasets) == \
+        [("X", "AVG"), ("X", "MAX"), ("X_px", "AVG"), ("X_px", "MAX")]
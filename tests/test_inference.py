@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+import torch.nn as nn
+from src.cnn_multi_pixel.training.inference import InferenceEngine
+from src.cnn_multi_pixel.training.models import MultiHeadCNN, create_backbone, create_bit_model
+from tests.test_models import fit, toy_task
+
+def save_checkpoint(model, path):
+    torch.save({'cnn_state_dict': model.state_dict()}, path)
+    return str(path)
+
+def bit_accuracy(engine, traces, labels):
+    return (engine.predict_bits(traces).numpy() == labels.numpy().reshape(len(labels), -1)).mean()
+
+def test_bit_checkpoints_predict_known_labels(tmp_path):
+    traces, labels = toy_task()
+    model = fit(create_bit_model("resnet18", weights=None), traces, labels)
+    save_checkpoint(model, tmp_path / "resnet18_checkpoint_adc_0_bit_0.pth")
+    engine = InferenceEngine.from_bit_checkpoints(str(tmp_path), "resnet18", adc_num=1, adc_bits=1)
+    assert engine.batch_independent
+    test_traces, test_labels = toy_task(seed=1)
+    assert bit_accuracy(engine, test_traces, test_labels) > 0.95
+    assert bit_accuracy(engine, test_traces[:1], test_labels[:1]) == 1.0
+
+def test_multi_head_checkpoints_predict_known_labels(tmp_path):
+    traces, labels = toy_task(n_heads=2)
+    kwargs = {"layers": (1, 1), "widths": (8, 16)}
+    model = fit(MultiHeadCNN(*create_backbone("resnet1d", **kwargs), 2), traces, labels)
+    path = save_checkpoint(model, tmp_path / "resnet1d_multihead_checkpoint_all.pth")
+    engine = InferenceEngine.from_multi_head_checkpoints([path], "resnet1d", adc_num=1, adc_bits=2, **kwargs)
+    test_traces, test_labels = toy_task(n_heads=2, seed=1)
+    adc_values, digital_values = engine.predict(test_traces)
+    expected = test_labels[:, 0] + 2 * test_labels[:, 1]
+    assert (digital_values == expected.numpy()).mean() > 0.9
+    np.testing.assert_array_equal(adc_values[:, 0], digital_values)
+
+def test_notebook_checkpoints_predict_with_batch_statistics(tmp_path):
+    # Checkpoints of the notebook workflow: BatchNorm switched to batch statistics after construction,
+    # so the running buffers in the checkpoint were never updated
+    traces, labels = toy_task()
+    model = create_bit_model("resnet18", weights=None)
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.track_running_stats = False
+    save_checkpoint(fit(model, traces, labels), tmp_path / "resnet18_checkpoint_adc_0_bit_0.pth")
+    engine = InferenceEngine.from_bit_checkpoints(str(tmp_path), "resnet18", adc_num=1, adc_bits=1)
+    assert not engine.batch_independent
+    test_traces, test_labels = toy_task(seed=1)
+    assert bit_accuracy(engine, test_traces, test_labels) > 0.95
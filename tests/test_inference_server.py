@@ -0,0 +1,91 @@
+import asyncio
+import contextlib
+import os
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from src.cnn_multi_pixel.helper_functions.normalizer import LogNormalizer
+from src.cnn_multi_pixel.helper_functions.subsampler import sample_trace
+from src.cnn_multi_pixel.training.inference import InferenceEngine
+from src.cnn_multi_pixel.training.inference_server import InferenceServer, request_decode
+from src.cnn_multi_pixel.training.models import create_bit_model
+
+ADC_NUM, ADC_BITS = 2, 4
+INTERVAL, DURATION = 1e-6, 260e-6
+MAX_SAMPLES = int(DURATION / INTERVAL)
+
+def make_traces(n_traces, seed=0):
+    # One level per clock edge, high for a 1 bit; edges run MSB ADC first and MSB first, as in generate_trace
+    rng = np.random.default_rng(seed)
+    traces, digital_values = [], []
+    for _ in range(n_traces):
+        values = [int(value) for value in rng.integers(0, 1 << ADC_BITS, ADC_NUM)]
+        bits = np.array([(value >> bit) & 1 for value in values for bit in range(ADC_BITS - 1, -1, -1)])
+        times = np.sort(rng.uniform(0, DURATION, 3000))
+        times[0] = 0.0
+        edge = np.minimum((times / DURATION * len(bits)).astype(np.int64), len(bits) - 1)
+        traces.append((times, np.where(bits[edge], 3e-4, 1e-4) * rng.uniform(0.95, 1.05, len(times))))
+        digital_values.append(values)
+    return traces, digital_values
+
+class EdgeDecoder(nn.Module):
+    # Fixed model for make_traces: a bit is set if the mean of the windows inside its clock edge passes threshold
+    # Head k (column k of compute_bit_labels) reads edge n_edges - 1 - k
+    def __init__(self, threshold):
+        super().__init__()
+        n_edges = ADC_NUM * ADC_BITS
+        bounds = [int(edge * DURATION / n_edges / INTERVAL) + 1 for edge in range(n_edges + 1)]
+        self.segments = [(bounds[edge] + 1, bounds[edge + 1] - 1) for edge in reversed(range(n_edges))]
+        self.threshold = threshold
+
+    def forward(self, x):
+        levels = torch.stack([x[:, start:stop].mean(1) for start, stop in self.segments], 1) - self.threshold
+        return torch.stack([torch.zeros_like(levels), levels], -1)
+
+def make_engine(normalizer):
+    return InferenceEngine([EdgeDecoder(normalizer.transform(np.array([2e-4])).item())], ADC_NUM, ADC_BITS)
+
+async def decode_all(server, socket_path, traces):
+    serve_task = asyncio.create_task(server.serve(socket_path))
+    while not os.path.exists(socket_path):
+        await asyncio.sleep(0.01)
+    try:
+        return await asyncio.gather(*(request_decode(zip(times, values), socket_path) for times, values in traces))
+    finally:
+        serve_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await serve_task
+
+def test_socket_round_trip_decodes_known_values(tmp_path):
+    traces, digital_values = make_traces(6)
+    rows = np.stack([sample_trace(times, values, INTERVAL, MAX_SAMPLES)[0][:MAX_SAMPLES].astype(np.float32)
+                     for times, values in traces])
+    normalizer = LogNormalizer().fit_iter([rows])
+
+    server = InferenceServer(make_engine(normalizer), normalizer, INTERVAL, DURATION, batch_size=8, max_wait=0.5)
+    responses = asyncio.run(decode_all(server, str(tmp_path / "server.sock"), traces))
+
+    # adc_values column 0 is the ADC storing the LSB
+    assert [response["adc_values"] for response in responses] == [values[::-1] for values in digital_values]
+    assert [response["digital_value"] for response in responses] == \
+        [sum(value << (ADC_BITS * (ADC_NUM - 1 - adc)) for adc, value in enumerate(values)) for values in digital_values]
+    # Traces of the concurrent clients were batched together
+    assert server.batcher.stats["batches"] < len(traces)
+
+def test_server_rejects_batch_dependent_engine():
+    model = nn.Sequential(nn.Unflatten(1, (1, -1)), nn.Conv1d(1, 4, 3), nn.BatchNorm1d(4, track_running_stats=False),
+                          nn.AdaptiveAvgPool1d(1), nn.Flatten(), nn.Linear(4, 2))
+    engine = InferenceEngine([model] * (ADC_NUM * ADC_BITS), ADC_NUM, ADC_BITS)
+    normalizer = LogNormalizer().fit_iter([np.array([1e-6, 1e-3])])
+    assert not engine.batch_independent
+    assert make_engine(normalizer).batch_independent
+    with pytest.raises(ValueError, match="depend on the batch"):
+        InferenceServer(engine, normalizer, INTERVAL, DURATION)
+
+def test_server_rejects_untrained_batch_norm():
+    models = [create_bit_model("resnet1d", layers=(1, 1), widths=(8, 16)) for _ in range(ADC_NUM * ADC_BITS)]
+    engine = InferenceEngine(models, ADC_NUM, ADC_BITS)
+    assert engine.batch_independent and engine.untrained_batch_norm
+    with pytest.raises(ValueError, match="never updated"):
+        InferenceServer(engine, LogNormalizer().fit_iter([np.array([1e-6, 1e-3])]), INTERVAL, DURATION)
@@ -0,0 +1,69 @@
+import torch
+import torch.nn as nn
+from src.cnn_multi_pixel.training.models import MultiHeadCNN, create_backbone, create_bit_model
+
+def toy_task(n_traces=256, length=64, n_heads=1, seed=0):
+    # Label k is 1 if segment k of the trace has a step in its second half; separable by the mean of that half
+    # Offset and scale are far from 0 and 1, so eval() with untrained BatchNorm buffers would fail
+    generator = torch.Generator().manual_seed(seed)
+    labels = torch.randint(0, 2, (n_traces, n_heads), generator=generator)
+    traces = 20.0 + torch.randn(n_traces, length, generator=generator)
+    segment = length // n_heads
+    for head in range(n_heads):
+        traces[:, head * segment + segment // 2:(head + 1) * segment] += 3.0 * labels[:, head:head + 1].float()
+    return traces, labels.squeeze(1) if n_heads == 1 else labels
+
+def fit(model, traces, labels, steps=60, batch_size=32):
+    torch.manual_seed(0)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+    model.train()
+    for step in range(steps):
+        index = torch.randint(0, len(traces), (batch_size,))
+        optimizer.zero_grad()
+        loss = nn.functional.cross_entropy(model(traces[index]).view(batch_size, -1, 2).reshape(-1, 2),
+                                           labels[index].view(batch_size, -1).reshape(-1))
+        loss.backward()
+        optimizer.step()
+    return model
+
+def eval_accuracy(model, traces, labels):
+    model.eval()
+    with torch.inference_mode():
+        return (model(traces).argmax(-1).view(-1) == labels.view(-1)).double().mean().item()
+
+def test_resnet1d_eval_uses_learned_running_stats():
+    traces, labels = toy_task()
+    model = fit(create_bit_model("resnet1d", layers=(1, 1), widths=(8, 16)), traces, labels)
+    test_traces, test_labels = toy_task(seed=1)
+    assert eval_accuracy(model, test_traces, test_labels) > 0.95
+    # Also for single traces, where batch statistics would be meaningless
+    assert eval_accuracy(model, test_traces[:1], test_labels[:1]) == 1.0
+
+def split_batches(model, traces, sizes):
+    return torch.cat([model(chunk) for chunk in torch.split(traces, sizes)])
+
+def test_resnet1d_eval_output_does_not_depend_on_batch():
+    torch.manual_seed(0)
+    model = create_bit_model("resnet1d")
+    model.train()
+    model(torch.rand(8, 256))
+    model.eval()
+    traces = torch.rand(6, 256)
+    with torch.inference_mode():
+        whole = model(traces)
+        assert torch.allclose(whole, split_batches(model, traces, [4, 2]), atol=1e-5)
+        assert torch.allclose(whole, split_batches(model, traces, [1] * 6), atol=1e-5)
+
+def test_resnet1d_multi_head_eval_output_does_not_depend_on_batch():
+    torch.manual_seed(0)
+    model = MultiHeadCNN(*create_backbone("resnet1d"), 8).eval()
+    traces = torch.rand(5, 256)
+    with torch.inference_mode():
+        assert torch.allclose(model(traces), split_batches(model, traces, [3, 2]), atol=1e-5)
+
+def test_resnet18_eval_output_does_not_depend_on_batch():
+    torch.manual_seed(0)
+    model = create_bit_model("resnet18", weights=None).eval()
+    traces = torch.rand(6, 256)
+    with torch.inference_mode():
+        assert torch.allclose(model(traces), split_batches(model, traces, [4, 2]), atol=1e-5)
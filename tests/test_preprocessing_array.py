@@ -0,0 +1,44 @@
+import numpy as np
+from src.cnn_multi_pixel.preprocessing.preprocessing_array import convert_file, convert_file_bulk, trace_to_arrays
+
+HEADER = "time -i(vdd)\n"
+
+def token(rng, scientific=0.9):
+    value = rng.uniform(-1e-3, 1e-3)
+    return f"{value:.6e}" if rng.random() < scientific else f"{value:.6f}"
+
+def write_file(path, lines, header=True):
+    with open(path, "w") as f:
+        f.write((HEADER if header else "") + "".join(lines))
+    return str(path)
+
+def assert_same_as_convert_file(path):
+    times, values = convert_file_bulk(path)
+    expected_times, expected_values = trace_to_arrays(convert_file(path))
+    np.testing.assert_array_equal(times, expected_times)
+    np.testing.assert_array_equal(values, expected_values)
+
+def test_regular_file(tmp_path):
+    rng = np.random.default_rng(0)
+    path = write_file(tmp_path / "regular.txt", [f"{token(rng, 1)}\t{token(rng, 1)}\n" for _ in range(100)])
+    assert_same_as_convert_file(path)
+    assert len(convert_file_bulk(path)[0]) == 100
+
+def test_one_and_three_token_lines_do_not_shift_columns(tmp_path):
+    path = write_file(tmp_path / "shifted.txt", ["1.0e-9 2.0e-5\n", "3.0e-9\n", "4.0e-9 5.0e-5 6.0e-9\n", "7.0e-9 8.0e-5\n"])
+    times, values = convert_file_bulk(path)
+    np.testing.assert_array_equal(times, [1.0e-9, 4.0e-9, 7.0e-9])
+    np.testing.assert_array_equal(values, [2.0e-5, 5.0e-5, 8.0e-5])
+
+def test_fuzzed_malformed_files_match_convert_file(tmp_path, capsys):
+    rng = np.random.default_rng(1)
+    for index in range(300):
+        lines = []
+        for _ in range(rng.integers(1, 30)):
+            n_tokens = rng.choice([0, 1, 2, 2, 2, 3, 4])
+            separator = "\t" if rng.random() < 0.5 else " "
+            lines.append(separator.join(token(rng) for _ in range(n_tokens)) + "\n")
+        if rng.random() < 0.3:
+            lines[-1] = lines[-1].rstrip("\n")
+        assert_same_as_convert_file(write_file(tmp_path / f"fuzz_{index}.txt", lines, header=rng.random() < 0.5))
+    capsys.readouterr()
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from src.cnn_multi_pixel.dataset.dataset_raw import TraceDatasetRaw
+from src.cnn_multi_pixel.helper_functions import subsampler
+from src.cnn_multi_pixel.helper_functions.normalizer import LogNormalizer
+from src.cnn_multi_pixel.helper_functions.profiler import Profiler
+from src.cnn_multi_pixel.preprocessing.preprocessing_pipeline import create_training_matrix
+
+def test_summary_columns_are_separated():
+    profiler = Profiler()
+    with profiler.stage("load") as record:
+        record["items"] = 2_000_000
+    profiler.records[-1]["wall_s"] = 0.0202
+    summary = profiler.summary()
+    header, row = summary.splitlines()
+    assert header.count(" | ") == row.count(" | ") == 8
+    assert "2,000,000 | " in row
+
+def test_peak_rss_is_measured_per_stage():
+    profiler = Profiler()
+    if not profiler.stage_peaks:
+        pytest.skip("per-stage peak RSS needs /proc/self/clear_refs")
+    with profiler.stage("outer"):
+        with profiler.stage("large"):
+            array = np.ones(50_000_000)
+            del array
+        with profiler.stage("small"):
+            array = np.ones(1000)
+    peaks = {record["stage"]: record["peak_rss_mb"] for record in profiler.records}
+    assert peaks["large"] > peaks["small"] + 300
+    assert peaks["outer"] >= peaks["large"]
+
+def test_iterate_records_items():
+    profiler = Profiler()
+    assert list(profiler.iterate(range(5), "loop")) == list(range(5))
+    assert profiler.totals()["loop"]["items"] == 5
+
+def test_fused_matrix_is_one_stage(monkeypatch):
+    # Normalizing block by block inside create_training_matrix adds no records of its own
+    monkeypatch.setattr(subsampler, "BLOCK_POINTS", 64)
+    rng = np.random.default_rng(0)
+    raw_dict = {dv: (np.cumsum(rng.random(50)) * 1e-7, rng.random(50) * 1e-3 + 1e-5) for dv in range(8)}
+    normalizer = LogNormalizer().fit_iter([values for _, values in raw_dict.values()])
+    profiler = Profiler().enable()
+    try:
+        matrix, _, _ = create_training_matrix([TraceDatasetRaw("folder", raw_dict)], 1e-7, 2e-6, "AVG", normalizer)
+    finally:
+        profiler.disable()
+    assert matrix.shape == (8, 20)
+    assert [record["stage"] for record in profiler.records] == ["create_training_matrix"]
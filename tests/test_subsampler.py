@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic_traces import generate_trace
+from src.cnn_multi_pixel.helper_functions.subsampler import (DTYPE, StreamingSubsampler, sample_func_gen, sample_packed_modes,
+                                                             sample_trace, select_func_gen)
+
+MODES = ["AVG", "MIN", "MAX"]
+INTERVAL = 1e-6
+
+# Windowed loop of the original sample_file, over arrays instead of a file
+def loop_sample(times, values, sample_interval, max_samples, sample_mode):
+    f = sample_func_gen(sample_mode)
+    l = select_func_gen(f"B{sample_mode}")
+    tstart = ptim = DTYPE(times[0])
+    wtim = tstart + sample_interval
+    val_win = [DTYPE(values[0])]
+    val_arr = [DTYPE(values[0])]
+    tim_arr = [ptim]
+    for stim, value in zip(times[1:], values[1:]):
+        if len(val_arr) == max_samples:
+            break
+        if stim >= wtim:
+            val_arr.append(f(val_win))
+            tim_arr.append(wtim - sample_interval/2)
+            wtim += sample_interval
+            while stim > wtim:
+                val_arr.append(l(ptim, val_arr[-1], stim, value, (len(val_arr) + 0.5)*sample_interval))
+                tim_arr.append(wtim - sample_interval/2)
+                wtim += sample_interval
+            val_win = [value]
+        else:
+            val_win.append(value)
+        ptim = stim
+    if len(val_arr) < max_samples:
+        val_arr.append(f(val_win))
+        tim_arr.append(ptim)
+    tstop = wtim
+    if len(val_arr) < max_samples:
+        x0, x1 = tim_arr[-2:]
+        y0, y1 = val_arr[-2:]
+        m = (y1 - y0)/(x1 - x0)
+        tstop = wtim + sample_interval/2
+        while len(val_arr) < max_samples:
+            y1 = (tstop - x1)*m + y1
+            val_arr.append(y1)
+            x1 = tstop
+            tstop += sample_interval
+    return np.array(val_arr, dtype=DTYPE), tstart, tstop
+
+def traces():
+    rng = np.random.default_rng(0)
+    # Dense traces, traces with long gaps and short traces needing a tail
+    for n_points, duration, max_samples in [(4000, 30e-6, 24), (300, 40e-6, 48), (50, 5e-6, 16), (2, 3e-6, 8)]:
+        for _ in range(4):
+            yield (*generate_trace(rng.integers(0, 256, 2), n_points, duration, rng), max_samples)
+    # Samples landing exactly on window boundaries
+    times = np.cumsum(np.full(200, INTERVAL / 4))
+    yield times, rng.random(200), 40
+    gaps = np.cumsum(rng.choice([INTERVAL / 2, INTERVAL, 3 * INTERVAL], 100))
+    yield gaps, rng.random(100), 120
+
+@pytest.mark.parametrize("mode", MODES)
+def test_sample_trace_matches_loop(mode):
+    for times, values, max_samples in traces():
+        val_arr, tstart, tstop = sample_trace(times, values, INTERVAL, max_samples, mode)
+        expected, expected_tstart, expected_tstop = loop_sample(times, values, INTERVAL, max_samples, mode)
+        np.testing.assert_array_equal(val_arr, expected)
+        assert (tstart, tstop) == (expected_tstart, expected_tstop)
+
+@pytest.mark.parametrize("block_points", [None, 64])
+def test_sample_packed_modes_matches_loop(block_points):
+    listed = list(traces())
+    max_samples = 32
+    offsets = np.cumsum([0] + [len(times) for times, _, _ in listed])
+    result = sample_packed_modes(np.concatenate([times for times, _, _ in listed]), np.concatenate([values for _, values, _ in listed]),
+                                 offsets, INTERVAL, max_samples, MODES, block_points=block_points)
+    for rows, mode in zip(result, MODES):
+        for row, (times, values, _) in zip(rows, listed):
+            np.testing.assert_array_equal(row, loop_sample(times, values, INTERVAL, max_samples, mode)[0][:max_samples].astype(np.float32))
+
+@pytest.mark.parametrize("mode", MODES)
+def test_streaming_subsampler_matches_loop(mode):
+    rng = np.random.default_rng(1)
+    for times, values, max_samples in traces():
+        subsampler = StreamingSubsampler(INTERVAL, max_samples, mode)
+        bounds = np.sort(rng.integers(0, len(times), 5))
+        chunks = zip(np.split(times, bounds), np.split(values, bounds))
+        streamed = np.concatenate(list(subsampler.stream(chunks)))
+        np.testing.assert_array_equal(streamed, loop_sample(times, values, INTERVAL, max_samples, mode)[0][:max_samples])
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic_traces import generate_trace_folder
+from src.cnn_multi_pixel.dataloader.dataloader import TraceDatasetBuilder
+from src.cnn_multi_pixel.preprocessing.preprocessing_array import list_folder_files
+
+@pytest.mark.parametrize("adc_num, adc_bits", [(5, 8), (3, 4), (2, 12)])
+def test_file_labels_match_generated_values(tmp_path, adc_num, adc_bits):
+    folder_dict = generate_trace_folder(str(tmp_path), "folder", 6, 50, adc_num=adc_num, adc_bits=adc_bits, seed=3)
+    expected = np.random.default_rng(3).choice(1 << min(adc_num * adc_bits, 62), size=6, replace=False)
+    labels = [label for label, _ in list_folder_files(str(tmp_path), "folder", folder_dict["file_name_pattern"], folder_dict["file_label_function"])]
+    assert sorted(labels) == sorted(int(value) for value in expected)
+
+@pytest.mark.parametrize("adc_num, adc_bits", [(5, 8), (3, 4)])
+def test_builder_labels_match_file_labels(tmp_path, adc_num, adc_bits):
+    folder_dict = generate_trace_folder(str(tmp_path), "folder", 6, 50, adc_num=adc_num, adc_bits=adc_bits, seed=3)
+    labels = dict((path, label) for label, path in list_folder_files(str(tmp_path), "folder", folder_dict["file_name_pattern"], folder_dict["file_label_function"]))
+    builder = TraceDatasetBuilder(adc_bitwidth=adc_bits, adc_num=adc_num, normalized_digital=True)
+    builder.add_files(str(tmp_path / "folder"), folder_dict["file_name_pattern"], 0)
+    assert {fpath: dvalue[0] for _, fpath, dvalue in builder.file_list} == labels
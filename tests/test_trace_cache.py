@@ -0,0 +1,24 @@
+import numpy as np
+from src.cnn_multi_pixel.dataloader.trace_cache import TraceCache
+
+def test_replaced_trace_is_spilled_again(tmp_path):
+    cache = TraceCache(max_bytes=4 * 8, spill_path=str(tmp_path / "spill.bin"))
+    old_trace, new_trace = np.zeros(8, dtype=np.float32), np.ones(8, dtype=np.float32)
+    cache.put("a", old_trace)
+    cache.put("b", old_trace)
+    np.testing.assert_array_equal(cache.get("a"), old_trace)
+
+    cache.put("a", new_trace)
+    np.testing.assert_array_equal(cache.get("a"), new_trace)
+    cache.put("b", old_trace)
+    assert "a" not in cache.entries
+    np.testing.assert_array_equal(cache.get("a"), new_trace)
+
+def test_evicted_traces_are_served_from_spill(tmp_path):
+    cache = TraceCache(max_bytes=64, spill_path=str(tmp_path / "spill.bin"))
+    traces = {f"trace_{i}": np.full(16, i, dtype=np.float32) for i in range(4)}
+    for key, trace in traces.items():
+        cache.put(key, trace)
+    for key, trace in traces.items():
+        np.testing.assert_array_equal(cache.get(key), trace)
+    assert cache.stats()["spill_hits"] == 3
@@ -0,0 +1,37 @@
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+from src.cnn_multi_pixel.training.models import MultiHeadCNN, create_backbone
+from src.cnn_multi_pixel.training.train import evaluate, load_checkpoint, param_init, train_model
+from tests.test_models import fit, toy_task
+
+KWARGS = {"layers": (1, 1), "widths": (8, 16)}
+
+def toy_loader(seed, shuffle=False):
+    return DataLoader(TensorDataset(*toy_task(n_heads=2, seed=seed)), batch_size=32, shuffle=shuffle)
+
+def test_evaluate_reports_learned_accuracy():
+    torch.manual_seed(0)
+    model = MultiHeadCNN(*create_backbone("resnet1d", **KWARGS), 2)
+    # Every epoch runs, so the BatchNorm running statistics settle
+    params = dict(param_init(), num_epochs=12, lr=1e-2, target_acc=1.01)
+    train_acc, _ = train_model(model, toy_loader(0, shuffle=True), params=params, verbose=False)
+    assert train_acc > 0.95
+    head_acc = evaluate(model, toy_loader(1))
+    assert head_acc.shape == (2,) and head_acc.min().item() > 0.95
+
+def test_evaluate_notebook_checkpoint(tmp_path):
+    # Checkpoint trained with BatchNorm switched to batch statistics after construction, as the notebook did
+    model = MultiHeadCNN(*create_backbone("resnet1d", **KWARGS), 2)
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm1d):
+            module.track_running_stats = False
+    fit(model, *toy_task(n_heads=2))
+    checkpoint_path = str(tmp_path / "checkpoint.pth")
+    optimizer = torch.optim.Adam(model.parameters())
+    torch.save({'cnn_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict(),
+                'epoch': 0, 'reached_acc': 1.0}, checkpoint_path)
+
+    loaded = MultiHeadCNN(*create_backbone("resnet1d", **KWARGS), 2)
+    assert load_checkpoint(checkpoint_path, loaded, torch.optim.Adam(loaded.parameters())) == (1, 1.0)
+    assert evaluate(loaded, toy_loader(1)).min().item() > 0.95